@@ -17,6 +17,9 @@ class RecurringReservation(db.Model):
     start_time = db.Column(db.String(4), nullable=False)  # Format: "1400" for 2:00 PM
     end_time = db.Column(db.String(4), nullable=False)  # Format: "1600" for 4:00 PM
     is_active = db.Column(db.Boolean, default=True)
+    fallback_room_ids = db.Column(db.JSON, nullable=True)  # Room ids tried in order when the room is taken
+    fallback_partition = db.Column(db.String(64), nullable=True)  # Then any piano room of this partition
+    contiguous = db.Column(db.Boolean, default=False)  # All segments or none: roll back a partial booking
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     def __repr__(self):
@@ -45,6 +48,9 @@ class OneTimeReservation(db.Model):
     end_time = db.Column(db.String(4), nullable=False)
     is_cancellation = db.Column(db.Boolean, default=False)
     status = db.Column(db.String(20), default='pending')  # pending, successful, failed
+    fallback_room_ids = db.Column(db.JSON, nullable=True)  # Room ids tried in order when the room is taken
+    fallback_partition = db.Column(db.String(64), nullable=True)  # Then any piano room of this partition
+    contiguous = db.Column(db.Boolean, default=False)  # All segments or none: roll back a partial booking
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     def __repr__(self):
@@ -61,6 +67,16 @@ class OneTimeReservation(db.Model):
 
 class ReservationHistory(db.Model):
     __tablename__ = 'reservation_history'
+    __table_args__ = (
+        # Daily limit check, dashboard upcoming list, history filtered by status
+        db.Index('ix_reservation_history_user_status_date', 'user_id', 'status', 'reservation_date'),
+        # User history ordered by date and start time
+        db.Index('ix_reservation_history_user_date', 'user_id', 'reservation_date', 'start_time'),
+        # Admin history and bulk notifications ordered/filtered by creation time
+        db.Index('ix_reservation_history_created_at', 'created_at'),
+        # Admin date-range filters and per-date digests
+        db.Index('ix_reservation_history_date', 'reservation_date'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -75,4 +91,114 @@ class ReservationHistory(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     def __repr__(self):
-        return f'<ReservationHistory {self.id}: {self.room.name} {self.reservation_date} {self.start_time}-{self.end_time} {self.status}>'
\ No newline at end of file
+        return f'<ReservationHistory {self.id}: {self.room.name} {self.reservation_date} {self.start_time}-{self.end_time} {self.status}>'
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'username': self.user.username if self.user else None,
+            'room_id': self.room_id,
+            'room_name': self.room.name if self.room else None,
+            'room_instruments': self.room.instruments if self.room else None,
+            'reservation_date': self.reservation_date.isoformat(),
+            'start_time': self.start_time,
+            'end_time': self.end_time,
+            'status': self.status,
+            'message': self.message,
+            'source_type': self.source_type,
+            'source_id': self.source_id,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+class RoomContention(db.Model):
+    """Running contention statistics for one room and start time, refreshed after each nightly run"""
+    __tablename__ = 'room_contention'
+    __table_args__ = (db.UniqueConstraint('room_id', 'start_time', name='uq_room_contention_slot'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    room_id = db.Column(db.Integer, db.ForeignKey('rooms.id'), nullable=False)
+    start_time = db.Column(db.String(4), nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    failures = db.Column(db.Integer, default=0, nullable=False)
+    failure_rate = db.Column(db.Float, default=0.0, nullable=False)  # Exponentially weighted, recent runs count most
+    lost_after_ms = db.Column(db.Float, nullable=True)  # Weighted time after the window opened at which requests lost
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<RoomContention {self.room_id} {self.start_time}: {self.failure_rate:.2f}>'
+
+
+class UserReservationStats(db.Model):
+    """Per-user reservation statistics, maintained whenever history entries are written"""
+    __tablename__ = 'user_reservation_stats'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    successful_count = db.Column(db.Integer, default=0, nullable=False)
+    failed_count = db.Column(db.Integer, default=0, nullable=False)
+    room_counts = db.Column(db.JSON, nullable=True)  # {room_id: successful reservations}
+    weekday_counts = db.Column(db.JSON, nullable=True)  # Successful reservations per weekday, 0=Monday
+    most_used_room_id = db.Column(db.Integer, db.ForeignKey('rooms.id'), nullable=True)
+    most_used_day = db.Column(db.Integer, nullable=True)  # 0=Monday, 6=Sunday
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    most_used_room = db.relationship('Room', lazy='joined')
+
+    def __repr__(self):
+        return f'<UserReservationStats {self.user_id}: {self.successful_count}/{self.failed_count}>'
+
+    @property
+    def success_rate(self):
+        total = self.successful_count + self.failed_count
+        return self.successful_count / total * 100 if total > 0 else 0
+
+    def add(self, status, room_id, reservation_date):
+        """Count one more history entry"""
+        if status == 'successful':
+            self.successful_count = (self.successful_count or 0) + 1
+
+            # JSON columns only notice reassignment, so build new containers
+            room_counts = dict(self.room_counts or {})
+            room_counts[str(room_id)] = room_counts.get(str(room_id), 0) + 1
+            self.room_counts = room_counts
+
+            weekday_counts = list(self.weekday_counts or [0] * 7)
+            weekday_counts[reservation_date.weekday()] += 1
+            self.weekday_counts = weekday_counts
+
+            self.most_used_room_id = int(max(room_counts, key=room_counts.get))
+            self.most_used_day = max(range(7), key=lambda day: weekday_counts[day]) if any(weekday_counts) else None
+        else:
+            self.failed_count = (self.failed_count or 0) + 1
+        self.updated_at = datetime.utcnow()
+
+
+class ReservationRun(db.Model):
+    """Results and per-request timing of one reservation run, kept for the timeline report"""
+    __tablename__ = 'reservation_runs'
+    __table_args__ = (db.Index('ix_reservation_runs_started_at', 'started_at'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    target_date = db.Column(db.Date, nullable=False)
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    total_processed = db.Column(db.Integer, default=0, nullable=False)
+    total_successful = db.Column(db.Integer, default=0, nullable=False)
+    total_failed = db.Column(db.Integer, default=0, nullable=False)
+    results = db.Column(db.JSON, nullable=True)  # Per-source counters, concurrency, dispatch and racing stats
+    trace = db.Column(db.JSON, nullable=True)  # RunTrace.to_dict(): per-request timing and its summary
+
+    def __repr__(self):
+        return f'<ReservationRun {self.id}: {self.target_date} {self.total_successful}/{self.total_processed}>'
+
+    def to_results(self):
+        """Rebuild the results dict of the run as rendered by admin/reservation_results.html"""
+        results = dict(self.results or {})
+        results.update({
+            'run_id': self.id,
+            'target_date': self.target_date,
+            'executed_at': self.started_at,
+            'total_processed': self.total_processed,
+            'total_successful': self.total_successful,
+            'total_failed': self.total_failed
+        })
+        return results
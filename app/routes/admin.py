@@ -3,15 +3,26 @@
 @Date: 2025/4/26
 @Description:
 """
-from flask import Blueprint, render_template, redirect, url_for, flash, request, current_app, jsonify
+from flask import Blueprint, render_template, redirect, url_for, flash, request, current_app, jsonify, Response, \
+    stream_with_context
 from flask_login import login_required, current_user
 from app import db
 from app.models.user import User
 from app.models.room import Room
-from app.models.reservation import RecurringReservation, OneTimeReservation, ReservationHistory
+from app.models.reservation import ReservationHistory, ReservationRun
 from app.services.reservation_service import ReservationService
+from app.services.reservation_plan import ReservationPlanner, get_current_plan
 from app.utils.time_utils import ServerTimeHelper
 from app.services.notification_service import NotificationService
+from app.services.notification_outbox import NotificationOutbox
+from app.services.system_summary import SystemSummary
+from app.services.history_export import HistoryExporter, EXPORT_FORMATS
+from app.services.room_scanner import RoomScanner
+from app.services.run_trace import build_timeline
+from app.services.async_ccom_client import AsyncCCOMClient
+from app.utils.slot_bitmap import mask_to_ranges
+from app.utils.pagination import keyset_paginate
+from sqlalchemy.orm import joinedload
 from datetime import datetime, timedelta, date
 from functools import wraps
 import os
@@ -38,15 +49,7 @@ def admin_required(f):
 def index():
     """管理员控制面板"""
     # 获取系统统计数据
-    stats = {
-        'user_count': User.query.count(),
-        'room_count': Room.query.count(),
-        'recurring_count': RecurringReservation.query.count(),
-        'one_time_count': OneTimeReservation.query.count(),
-        'history_count': ReservationHistory.query.count(),
-        'success_count': ReservationHistory.query.filter_by(status='successful').count(),
-        'failure_count': ReservationHistory.query.filter_by(status='failed').count()
-    }
+    stats = SystemSummary.get()
 
     # 获取最近历史记录
     recent_history = ReservationHistory.query.order_by(
@@ -161,11 +164,8 @@ def import_rooms():
     return render_template('admin/import_rooms.html')
 
 
-@admin_bp.route('/history')
-@login_required
-@admin_required
-def history():
-    """查看所有预约历史"""
+def _history_query():
+    """按请求参数构建全部用户的历史查询，返回 (查询, 筛选条件)"""
     # 获取筛选参数
     user_id = request.args.get('user_id')
     status = request.args.get('status')
@@ -173,7 +173,7 @@ def history():
     date_to = request.args.get('date_to')
 
     # 构建查询
-    query = ReservationHistory.query
+    query = ReservationHistory.query.options(joinedload(ReservationHistory.user), joinedload(ReservationHistory.room))
 
     if user_id:
         query = query.filter_by(user_id=user_id)
@@ -187,29 +187,89 @@ def history():
     if date_to:
         query = query.filter(ReservationHistory.reservation_date <= datetime.strptime(date_to, '%Y-%m-%d').date())
 
-    # 使用分页获取历史条目
-    page = request.args.get('page', 1, type=int)
-    per_page = 20
+    return query, {
+        'user_id': user_id,
+        'status': status,
+        'date_from': date_from,
+        'date_to': date_to
+    }
+
 
-    pagination = query.order_by(
-        ReservationHistory.created_at.desc()
-    ).paginate(page=page, per_page=per_page)
+# 按创建时间倒序排列，id 保证游标唯一
+HISTORY_KEYS = (
+    (ReservationHistory.created_at, True),
+    (ReservationHistory.id, True)
+)
 
-    history_items = pagination.items
+
+@admin_bp.route('/history')
+@login_required
+@admin_required
+def history():
+    """查看所有预约历史"""
+    query, filters = _history_query()
+
+    # 使用游标分页获取历史条目，翻到深处的页面与第一页开销相同
+    cursor = request.args.get('cursor')
+    page = keyset_paginate(query, HISTORY_KEYS, cursor, current_app.config.get('ADMIN_HISTORY_PAGE_SIZE', 20))
 
     # 获取下拉菜单的所有用户
     users = User.query.order_by(User.username).all()
 
     return render_template('admin/history.html',
-                           history_items=history_items,
-                           pagination=pagination,
+                           history_items=page.items,
+                           next_cursor=page.next_cursor,
+                           is_first_page=not cursor,
                            users=users,
-                           filters={
-                               'user_id': user_id,
-                               'status': status,
-                               'date_from': date_from,
-                               'date_to': date_to
-                           })
+                           filters=filters)
+
+
+@admin_bp.route('/history/data')
+@login_required
+@admin_required
+def history_data():
+    """所有预约历史的 JSON 分页接口，使用上一页返回的 next_cursor 获取下一页"""
+    query, _ = _history_query()
+    page = keyset_paginate(query, HISTORY_KEYS, request.args.get('cursor'),
+                           current_app.config.get('ADMIN_HISTORY_PAGE_SIZE', 20))
+
+    return jsonify({
+        'items': [item.to_dict() for item in page.items],
+        'next_cursor': page.next_cursor
+    })
+
+
+@admin_bp.route('/history/export')
+@login_required
+@admin_required
+def export_history():
+    """以 CSV 或 JSON Lines 流式导出预约历史（支持与历史页面相同的筛选参数）"""
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        flash('不支持的导出格式', 'danger')
+        return redirect(url_for('admin.history'))
+
+    date_from = request.args.get('date_from')
+    date_to = request.args.get('date_to')
+    try:
+        date_from = datetime.strptime(date_from, '%Y-%m-%d').date() if date_from else None
+        date_to = datetime.strptime(date_to, '%Y-%m-%d').date() if date_to else None
+    except ValueError:
+        flash('日期格式无效，请使用 YYYY-MM-DD', 'danger')
+        return redirect(url_for('admin.history'))
+
+    exporter = HistoryExporter(
+        user_id=request.args.get('user_id') or None,
+        status=request.args.get('status') or None,
+        date_from=date_from,
+        date_to=date_to
+    )
+
+    # 生成器响应：边查询边发送，导出大量数据时内存占用保持不变
+    filename = f"reservation_history_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{export_format}"
+    return Response(stream_with_context(exporter.chunks(export_format)),
+                    mimetype=EXPORT_FORMATS[export_format],
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
 
 
 @admin_bp.route('/system')
@@ -217,7 +277,19 @@ def history():
 @admin_required
 def system():
     """系统设置和操作"""
-    return render_template('admin/system.html')
+    runs = ReservationRun.query.order_by(ReservationRun.started_at.desc()).limit(5).all()
+    return render_template('admin/system.html', outbox=NotificationOutbox.get().stats(), runs=runs)
+
+
+@admin_bp.route('/system/runs/<int:id>')
+@login_required
+@admin_required
+def run_results(id):
+    """查看已保存的预约处理结果及每个请求的时间线"""
+    run = ReservationRun.query.get_or_404(id)
+    results = run.to_results()
+    results['timeline'] = build_timeline(run.trace)
+    return render_template('admin/reservation_results.html', results=results)
 
 
 @admin_bp.route('/system/test-reservation', methods=['POST'])
@@ -226,8 +298,8 @@ def system():
 def test_reservation():
     """Test run reservation processing - notifications are now sent directly during processing"""
     try:
-        # Execute reservations - notifications will be sent directly in the process
-        results = ReservationService.execute_reservations()
+        # Build a separate plan and order lists so the state prepared for the scheduled run stays intact
+        results = ReservationService.execute_reservations(use_prepared=False)
 
         # Log the results for debugging
         current_app.logger.info(f"Reservation test results: {results}")
@@ -301,6 +373,58 @@ def test_admin_notification():
         flash(f'发送测试通知时出错：{str(e)}', 'danger')
         return redirect(url_for('admin.system'))
 
+@admin_bp.route('/system/plan')
+@login_required
+@admin_required
+def reservation_plan():
+    """查看预登录阶段生成的预约计划，preview=1 时即时生成明天的计划（不保存）"""
+    try:
+        if request.args.get('preview'):
+            plan = ReservationPlanner.build_plan()
+        else:
+            plan = get_current_plan()
+
+        if plan is None:
+            return jsonify({'error': '当前没有已生成的预约计划'}), 404
+
+        return jsonify(plan.to_dict())
+
+    except Exception as e:
+        current_app.logger.error(f"Error building reservation plan: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+
+@admin_bp.route('/system/scan-rooms', methods=['POST'])
+@login_required
+@admin_required
+def scan_rooms():
+    """使用当前管理员的 CCOM 账号并发扫描所有琴房的空闲时段，返回有变化的琴房"""
+    try:
+        client = AsyncCCOMClient(current_user.username, current_user.get_ccom_password(), current_user.ccom_token)
+        if not client.pool.run(client.soft_login()):
+            return jsonify({'error': '无法登录 CCOM，请检查账号密码'}), 401
+
+        if client.token != current_user.ccom_token:
+            current_user.ccom_token = client.token
+            db.session.commit()
+
+        snapshot, changes = RoomScanner.scan(client)
+        return jsonify({
+            'rooms': len(snapshot.rooms),
+            'errors': snapshot.errors,
+            'elapsed_ms': round(snapshot.elapsed_ms, 1),
+            'changed': {
+                ccom_id: {day: {'before': mask_to_ranges(old), 'after': mask_to_ranges(new)}
+                          for day, (old, new) in days.items()}
+                for ccom_id, days in changes.items()
+            }
+        })
+
+    except Exception as e:
+        current_app.logger.error(f"Error scanning rooms: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+
 @admin_bp.route('/system/server-time')
 @login_required
 @admin_required
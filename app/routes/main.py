@@ -5,11 +5,10 @@
 """
 from flask import Blueprint, render_template, redirect, url_for, flash, current_app
 from flask_login import login_required, current_user
-from app.models.reservation import RecurringReservation, OneTimeReservation, ReservationHistory
-from app.models.room import Room
+from app.models.reservation import RecurringReservation, OneTimeReservation, ReservationHistory, UserReservationStats
+from app.services.system_summary import SystemSummary
 from datetime import datetime, timedelta, date
 from app.utils.time_utils import get_day_of_week, get_day_name
-from sqlalchemy import func
 import pytz
 
 main_bp = Blueprint('main', __name__)
@@ -51,37 +50,8 @@ def dashboard():
         status='pending'
     ).order_by(OneTimeReservation.reservation_date, OneTimeReservation.start_time).all()
 
-    # 获取预约统计
-    total_successful = ReservationHistory.query.filter_by(
-        user_id=current_user.id,
-        status='successful'
-    ).count()
-
-    total_failed = ReservationHistory.query.filter_by(
-        user_id=current_user.id,
-        status='failed'
-    ).count()
-
-    # 获取最常使用的琴房
-    most_used_room = Room.query.join(ReservationHistory).filter(
-        ReservationHistory.user_id == current_user.id,
-        ReservationHistory.status == 'successful'
-    ).group_by(Room.id).order_by(func.count(ReservationHistory.id).desc()).first()
-
-    # 获取最常使用的星期几
-    most_used_day_query = ReservationHistory.query.filter_by(
-        user_id=current_user.id,
-        status='successful'
-    ).with_entities(
-        func.dayofweek(ReservationHistory.reservation_date).label('day_of_week'),
-        func.count().label('count')
-    ).group_by('day_of_week').order_by(func.count().desc()).first()
-
-    most_used_day = None
-    if most_used_day_query:
-        # 将星期几从MySQL格式（1=星期日，2=星期一）转换为我们的格式（0=星期一）
-        day_num = (int(most_used_day_query.day_of_week) - 2) % 7
-        most_used_day = get_day_name(day_num)
+    # 获取预约统计（写入历史记录时已预先计算）
+    stats = UserReservationStats.query.get(current_user.id)
 
     # 计算下一次预约时间
     beijing_tz = pytz.timezone('Asia/Shanghai')
@@ -106,12 +76,11 @@ def dashboard():
         'recurring_reservations': recurring_reservations,
         'pending_reservations': pending_reservations,
         'statistics': {
-            'total_successful': total_successful,
-            'total_failed': total_failed,
-            'success_rate': (total_successful / (total_successful + total_failed) * 100) if (
-                                                                                                        total_successful + total_failed) > 0 else 0,
-            'most_used_room': most_used_room.name if most_used_room else None,
-            'most_used_day': most_used_day
+            'total_successful': stats.successful_count if stats else 0,
+            'total_failed': stats.failed_count if stats else 0,
+            'success_rate': stats.success_rate if stats else 0,
+            'most_used_room': stats.most_used_room.name if stats and stats.most_used_room else None,
+            'most_used_day': get_day_name(stats.most_used_day) if stats and stats.most_used_day is not None else None
         },
         'next_reservation_time': reservation_time.strftime('%H:%M'),
         'next_reservation_day': next_reservation_day,
@@ -125,14 +94,16 @@ def dashboard():
 @main_bp.route('/about')
 def about():
     """关于页面，包含系统信息"""
+    # 统计数据来自缓存的系统摘要，每晚预约处理后刷新
+    summary = SystemSummary.get()
     system_info = {
         'max_daily_reservations': current_app.config['MAX_DAILY_RESERVATIONS'],
         'max_reservation_hours': current_app.config['MAX_RESERVATION_HOURS'],
         'reservation_open_time': current_app.config['RESERVATION_OPEN_TIME'],
         'notifications_enabled': current_app.config['NOTIFICATION_ENABLED'],
-        'reservation_count': ReservationHistory.query.count(),
-        'user_count': len(set([r.user_id for r in ReservationHistory.query.all()])),
-        'room_count': Room.query.count()
+        'reservation_count': summary['history_count'],
+        'user_count': summary['history_user_count'],
+        'room_count': summary['room_count']
     }
 
     return render_template('main/about.html', system_info=system_info)
\ No newline at end of file
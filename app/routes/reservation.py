@@ -10,8 +10,13 @@ from app.models.room import Room
 from app.models.reservation import RecurringReservation, OneTimeReservation, ReservationHistory
 from app.services.ccom_client import CCOMClient
 from app.services.reservation_service import ReservationService
-from app.utils.exceptions import ReservationLimitExceeded, DurationLimitExceeded
-from app.utils.time_utils import get_day_of_week, get_day_name, calculate_duration_hours
+from app.services.availability_cache import availability_cache
+from app.services.room_scanner import get_current_snapshot
+from app.utils.exceptions import ReservationLimitExceeded, DurationLimitExceeded, ReservationConflict
+from app.utils.time_utils import get_day_of_week, get_day_name, calculate_duration_hours, parse_hhmm
+from app.utils.pagination import keyset_paginate
+from app.utils.slot_bitmap import intervals_to_masks, mask_to_ranges
+from sqlalchemy.orm import joinedload
 from datetime import datetime, timedelta, date
 import pytz
 
@@ -37,6 +42,16 @@ def recurring_list():
     return render_template('reservation/recurring_list.html', reservations=reservations)
 
 
+def _read_fallbacks(suffix=''):
+    """从表单读取按顺序排列的备选琴房和备选分区"""
+    room_ids = []
+    for value in request.form.getlist(f'fallback_room_ids{suffix}'):
+        if value.isdigit() and int(value) not in room_ids:
+            room_ids.append(int(value))
+    partition = request.form.get(f'fallback_partition{suffix}') or None
+    return room_ids or None, partition
+
+
 @reservation_bp.route('/recurring/create', methods=['GET', 'POST'])
 @login_required
 def recurring_create():
@@ -62,13 +77,17 @@ def recurring_create():
                 from app.utils.time_utils import calculate_duration_hours
                 duration = calculate_duration_hours(start_time_1, end_time_1)
 
+                fallback_room_ids_1, fallback_partition_1 = _read_fallbacks('_1')
                 reservation = RecurringReservation(
                     user_id=current_user.id,
                     room_id=room_id_1,
                     day_of_week=day_of_week,
                     start_time=start_time_1,
                     end_time=end_time_1,
-                    is_active=True
+                    is_active=True,
+                    fallback_room_ids=fallback_room_ids_1,
+                    fallback_partition=fallback_partition_1,
+                    contiguous='contiguous_1' in request.form
                 )
 
                 db.session.add(reservation)
@@ -87,13 +106,17 @@ def recurring_create():
                         flash('总预约时长不能超过6小时', 'danger')
                         return render_template('reservation/recurring_create.html', rooms=rooms)
 
+                    fallback_room_ids_2, fallback_partition_2 = _read_fallbacks('_2')
                     reservation2 = RecurringReservation(
                         user_id=current_user.id,
                         room_id=room_id_2,
                         day_of_week=day_of_week,
                         start_time=start_time_2,
                         end_time=end_time_2,
-                        is_active=True
+                        is_active=True,
+                        fallback_room_ids=fallback_room_ids_2,
+                        fallback_partition=fallback_partition_2,
+                        contiguous='contiguous_2' in request.form
                     )
 
                     db.session.add(reservation2)
@@ -145,6 +168,8 @@ def recurring_edit(id):
             reservation.start_time = start_time
             reservation.end_time = end_time
             reservation.is_active = is_active
+            reservation.fallback_room_ids, reservation.fallback_partition = _read_fallbacks()
+            reservation.contiguous = 'contiguous' in request.form
 
             db.session.commit()
 
@@ -229,11 +254,12 @@ def one_time_create():
                     ReservationService.check_reservation_limits(
                         current_user.id, reservation_date, start_time, end_time
                     )
-                except (ReservationLimitExceeded, DurationLimitExceeded) as e:
+                except (ReservationLimitExceeded, DurationLimitExceeded, ReservationConflict) as e:
                     flash(str(e), 'danger')
                     return render_template('reservation/one_time_create.html', rooms=rooms, min_date=min_date)
 
-            # 创建一次性预约/取消
+            # 创建一次性预约/取消（取消请求不使用备选琴房和完整预约选项）
+            fallback_room_ids, fallback_partition = (None, None) if is_cancellation else _read_fallbacks()
             reservation = OneTimeReservation(
                 user_id=current_user.id,
                 room_id=room_id,
@@ -241,7 +267,10 @@ def one_time_create():
                 start_time=start_time,
                 end_time=end_time,
                 is_cancellation=is_cancellation,
-                status='pending'
+                status='pending',
+                fallback_room_ids=fallback_room_ids,
+                fallback_partition=fallback_partition,
+                contiguous='contiguous' in request.form and not is_cancellation
             )
 
             db.session.add(reservation)
@@ -285,17 +314,15 @@ def one_time_delete(id):
     return redirect(url_for('reservation.one_time_list'))
 
 
-@reservation_bp.route('/history')
-@login_required
-def history():
-    """查看预约历史"""
+def _history_query():
+    """按请求参数构建当前用户的历史查询，返回 (查询, 状态, 开始日期, 结束日期)"""
     # 获取筛选参数
     status = request.args.get('status', 'all')
     date_from = request.args.get('date_from', (date.today() - timedelta(days=30)).strftime('%Y-%m-%d'))
     date_to = request.args.get('date_to', date.today().strftime('%Y-%m-%d'))
 
     # 构建查询
-    query = ReservationHistory.query.filter_by(user_id=current_user.id)
+    query = ReservationHistory.query.filter_by(user_id=current_user.id).options(joinedload(ReservationHistory.room))
 
     if status != 'all':
         query = query.filter_by(status=status)
@@ -306,19 +333,47 @@ def history():
     if date_to:
         query = query.filter(ReservationHistory.reservation_date <= datetime.strptime(date_to, '%Y-%m-%d').date())
 
-    # 按日期和时间排序
-    history_items = query.order_by(
-        ReservationHistory.reservation_date.desc(),
-        ReservationHistory.start_time
-    ).all()
+    return query, status, date_from, date_to
+
+
+# 按日期倒序、开始时间正序排列，id 保证游标唯一
+HISTORY_KEYS = (
+    (ReservationHistory.reservation_date, True),
+    (ReservationHistory.start_time, False),
+    (ReservationHistory.id, False)
+)
+
+
+@reservation_bp.route('/history')
+@login_required
+def history():
+    """查看预约历史（第一页，后续页面通过 history_data 无限滚动加载）"""
+    query, status, date_from, date_to = _history_query()
+    page = keyset_paginate(query, HISTORY_KEYS, request.args.get('cursor'),
+                           current_app.config.get('HISTORY_PAGE_SIZE', 50))
 
     return render_template('reservation/history.html',
-                           history_items=history_items,
+                           history_items=page.items,
+                           next_cursor=page.next_cursor,
                            status=status,
                            date_from=date_from,
                            date_to=date_to)
 
 
+@reservation_bp.route('/history/data')
+@login_required
+def history_data():
+    """预约历史的 JSON 分页接口，使用上一页返回的 next_cursor 获取下一页"""
+    query, _, _, _ = _history_query()
+    page = keyset_paginate(query, HISTORY_KEYS, request.args.get('cursor'),
+                           current_app.config.get('HISTORY_PAGE_SIZE', 50))
+
+    return jsonify({
+        'items': [item.to_dict() for item in page.items],
+        'next_cursor': page.next_cursor
+    })
+
+
 @reservation_bp.route('/check-availability', methods=['GET'])
 @login_required
 def check_availability():
@@ -333,26 +388,85 @@ def check_availability():
         # Get the room
         room = Room.query.get_or_404(room_id)
 
-        # Connect to CCOM
-        client = CCOMClient(current_user.username, current_user.get_ccom_password(), current_user.ccom_token)
-        if not client.soft_login():
-            return jsonify({'error': 'Failed to connect to CCOM. Please check your credentials.'}), 401
+        def fetch():
+            # Connect to CCOM
+            client = CCOMClient(current_user.username, current_user.get_ccom_password(), current_user.ccom_token)
+            if not client.soft_login():
+                raise PermissionError('Failed to connect to CCOM. Please check your credentials.')
 
-        # Update token if needed
-        if client.token != current_user.ccom_token:
-            current_user.ccom_token = client.token
-            db.session.commit()
+            # Update token if needed
+            if client.token != current_user.ccom_token:
+                current_user.ccom_token = client.token
+                db.session.commit()
 
-        # Get availability
-        availability = client.find_room_availability(room_id)
+            availability = client.find_room_availability(room.id)
+            if 'error' not in availability:
+                # 所选日期完整空闲的 15 分钟时段，由位图合并为连续区间
+                masks = intervals_to_masks(availability['remainingTimeList'])
+                availability['date'] = date_str
+                availability['free'] = mask_to_ranges(masks.get(date_str, 0))
+            return availability
+
+        # Availability is the same for every user: served from the shared cache,
+        # concurrent misses for the same room make a single upstream call
+        availability, _ = availability_cache.get(
+            room.ccom_id, date_str, fetch,
+            ttl=current_app.config.get('AVAILABILITY_CACHE_TTL_SECONDS', 30),
+            is_valid=lambda value: 'error' not in value
+        )
 
         return jsonify(availability)
 
+    except PermissionError as e:
+        return jsonify({'error': str(e)}), 401
+
     except Exception as e:
         current_app.logger.error(f"Error checking availability: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 
+@reservation_bp.route('/availability-snapshot', methods=['GET'])
+@login_required
+def availability_snapshot():
+    """API endpoint returning the free 15-minute slots of all rooms from the latest full scan"""
+    snapshot = get_current_snapshot()
+    if snapshot is None:
+        return jsonify({'error': 'No availability scan has been run yet'}), 404
+
+    return jsonify(snapshot.to_dict(request.args.get('date')))
+
+
+@reservation_bp.route('/free-rooms', methods=['GET'])
+@login_required
+def free_rooms():
+    """API endpoint listing the rooms free for a whole time range, from the latest full scan"""
+    date_str = request.args.get('date')
+    start_time = request.args.get('start_time')
+    end_time = request.args.get('end_time')
+
+    if not date_str or not start_time or not end_time:
+        return jsonify({'error': 'Missing required parameters'}), 400
+
+    try:
+        parse_hhmm(start_time)
+        parse_hhmm(end_time)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    snapshot = get_current_snapshot()
+    if snapshot is None:
+        return jsonify({'error': 'No availability scan has been run yet'}), 404
+
+    ccom_ids = snapshot.free_rooms(date_str, start_time, end_time)
+    rooms = Room.query.filter(Room.ccom_id.in_(ccom_ids)).order_by(Room.name).all() if ccom_ids else []
+
+    return jsonify({
+        'taken_at': snapshot.taken_at.isoformat(),
+        'rooms': [{'id': room.id, 'ccom_id': room.ccom_id, 'name': room.name, 'partition': room.partition}
+                  for room in rooms]
+    })
+
+
 @reservation_bp.route('/rooms')
 @login_required
 def room_list():
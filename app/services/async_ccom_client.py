@@ -0,0 +1,339 @@
+"""
+@Author: Tianyi Zhang
+@Date: 2025/4/26
+@Description: Asynchronous CCOM client backed by one shared keep-alive connection pool
+"""
+import asyncio
+import json
+import threading
+import time
+from urllib.parse import urlsplit
+import httpx
+from flask import current_app
+from app.services.token_cache import token_cache
+from app.services.run_trace import current_request, http_trace_hook
+from app.utils.dns_cache import pin_host
+from app.utils.exceptions import ApiError, LoginError
+
+
+class CCOMConnectionPool:
+    """
+    Process-wide event loop and HTTP connection pool shared by every CCOM client
+
+    The loop runs in a dedicated daemon thread so that synchronous callers can
+    submit coroutines to it, and all requests to the CCOM API reuse the same
+    keep-alive connections instead of paying a TCP+TLS handshake per client.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, root, max_connections=200, keepalive_seconds=120, timeout=10):
+        self.root = root
+        self.max_connections = max_connections
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=keepalive_seconds
+        )
+        self.timeout = timeout
+
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_loop, name='ccom-event-loop', daemon=True)
+        self._thread.start()
+
+        self.client = self.run(self._create_client())
+
+        self.keepalive_seconds = keepalive_seconds
+        self.last_probe_ok = 0
+        self.last_probe_at = None
+        self._keepalive_future = None
+        self.latency_ms = None  # Exponentially weighted average of API response times
+
+    @classmethod
+    def get(cls):
+        """Get the shared pool, creating it from the app config on first use"""
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    config = current_app.config
+                    cls._instance = cls(
+                        config['CCOM_API_ROOT'],
+                        max_connections=config.get('CCOM_POOL_MAX_CONNECTIONS', 200),
+                        keepalive_seconds=config.get('CCOM_POOL_KEEPALIVE_SECONDS', 120),
+                        timeout=config.get('CCOM_REQUEST_TIMEOUT', 10)
+                    )
+        return cls._instance
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def _create_client(self):
+        return httpx.AsyncClient(limits=self.limits, timeout=self.timeout)
+
+    def in_loop_thread(self):
+        return threading.current_thread() is self._thread
+
+    def submit(self, coro):
+        """Schedule a coroutine on the pool's loop and return a concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the pool's loop and block until it finishes"""
+        if self.in_loop_thread():
+            coro.close()
+            raise RuntimeError("Cannot block on the CCOM event loop from inside it; await the coroutine instead")
+        return self.submit(coro).result(timeout)
+
+    def observe_latency(self, elapsed_ms, weight=0.2):
+        """Fold one API response time into the running latency estimate"""
+        if self.latency_ms is None:
+            self.latency_ms = elapsed_ms
+        else:
+            self.latency_ms += weight * (elapsed_ms - self.latency_ms)
+
+    def pin_dns(self, ttl=600):
+        """Resolve the CCOM API host once and cache it for new connections"""
+        parts = urlsplit(self.root)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        return pin_host(parts.hostname, port, ttl)
+
+    async def _probe(self, count):
+        """Send `count` concurrent HEAD requests, forcing that many connections open"""
+        responses = await asyncio.gather(
+            *(self.client.head(self.root) for _ in range(count)),
+            return_exceptions=True
+        )
+        self.last_probe_ok = sum(1 for r in responses if not isinstance(r, Exception))
+        self.last_probe_at = time.time()
+        return self.last_probe_ok
+
+    def prewarm(self, count):
+        """
+        Open up to `count` persistent connections ahead of time
+
+        Returns:
+            int: Number of connections successfully established
+        """
+        count = max(1, min(count, self.max_connections))
+        return self.run(self._probe(count))
+
+    async def _keepalive(self, count, until, interval):
+        while True:
+            remaining = until - time.time()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(min(interval, remaining))
+            if time.time() < until:
+                await self._probe(count)
+
+    def start_keepalive(self, count, until, interval=20):
+        """
+        Keep `count` connections alive with periodic HEAD probes
+
+        Args:
+            count: Number of connections to keep warm
+            until: Wall-clock timestamp after which probing stops
+            interval: Seconds between probe rounds
+        """
+        self.stop_keepalive()
+        count = max(1, min(count, self.max_connections))
+        self._keepalive_future = self.submit(self._keepalive(count, until, interval))
+
+    def stop_keepalive(self):
+        """Stop probing so probes don't compete with real requests"""
+        if self._keepalive_future is not None:
+            self._keepalive_future.cancel()
+            self._keepalive_future = None
+
+    def warm_connection_count(self):
+        """Count the connections the last probe round kept open, 0 once they may have expired"""
+        if self.last_probe_at is None or time.time() - self.last_probe_at >= self.keepalive_seconds:
+            return 0
+        return self.last_probe_ok
+
+
+class AsyncCCOMClient:
+    def __init__(self, username, password=None, token=None, pool=None):
+        """
+        Initialize the asynchronous CCOM client
+
+        Must be created inside an app context; the coroutines themselves can then
+        run on the pool's event loop without one.
+
+        Args:
+            username: CCOM username
+            password: CCOM password - can be None if token is provided
+            token: Authentication token - can be None if password is provided
+            pool: CCOMConnectionPool to use (default: the shared pool)
+        """
+        self.username = username
+        self.password = password
+        self.token = token
+        self.pool = pool or CCOMConnectionPool.get()
+        self.root = current_app.config['CCOM_API_ROOT']
+        self.ua = current_app.config['CCOM_API_UA']
+        self.token_freshness = current_app.config.get('TOKEN_FRESHNESS_SECONDS', 600)
+        self.logger = current_app.logger
+
+    @property
+    def http(self):
+        return self.pool.client
+
+    async def soft_login(self, revalidate=False):
+        """
+        Try to use existing token, fall back to full login if that fails
+
+        Tokens validated within TOKEN_FRESHNESS_SECONDS are trusted without a
+        basicInfo round trip unless `revalidate` is set.
+        """
+        if self.token:
+            if not revalidate and token_cache.is_fresh(self.username, self.token, self.token_freshness):
+                self.logger.info(f"Soft login served from token cache for user {self.username}")
+                return True
+
+            try:
+                result = await self.get_basic_info()
+                if result.get('status') == 200 and result.get('msg') == '成功':
+                    if result.get('data', {}).get('studentNumber', '').lower() == self.username.lower():
+                        token_cache.mark_valid(self.username, self.token)
+                        self.logger.info(f"Soft login successful for user {self.username}")
+                        return True
+                token_cache.mark_invalid(self.username, self.token)
+            except Exception as e:
+                self.logger.error(f"Soft login failed: {str(e)}")
+
+        # Only attempt login if we have a password
+        if self.password:
+            return await self.login()
+        else:
+            raise LoginError("No password or valid token available for login")
+
+    async def login(self):
+        """Perform full login to the CCOM system"""
+        if not self.password:
+            raise LoginError("Password is required for login")
+
+        url = f"{self.root}/service-zuul/applet/login/login"
+        headers = {'Content-Type': 'application/json;charset=UTF-8'}
+        body = {
+            "accountNumber": self.username,
+            "lessee": "151",
+            "password": self.password,
+            "code": None
+        }
+
+        try:
+            resp = await self.http.post(url, headers=headers, content=json.dumps(body))
+            resp_data = resp.json()
+
+            if resp_data.get('status') == 200 and resp_data.get('msg') == '成功':
+                self.token = resp_data['data']['token']
+                token_cache.mark_valid(self.username, self.token)
+                self.logger.info(f"Login successful for user {self.username}")
+                return True
+            else:
+                self.logger.error(f"Login failed: {resp_data}")
+                raise LoginError(f"Login failed: {resp_data.get('msg')}")
+        except Exception as e:
+            self.logger.error(f"Login error: {str(e)}")
+            raise LoginError(f"Login error: {str(e)}")
+
+    async def _call_api(self, method, api_name, data=None):
+        """Generic method to call CCOM API endpoints"""
+        if self.token is None:
+            raise LoginError("You must call `login` or `soft_login` before calling other APIs")
+
+        url = f"{self.root}/order/applet/order/{api_name}"
+        headers = {
+            'Content-Type': 'application/json;charset=UTF-8',
+            'User-Agent': self.ua,
+            'Authorization': self.token,
+        }
+
+        # Inside a traced run, the connection timings go to the record of the request being sent
+        record = current_request()
+        extensions = {'trace': http_trace_hook(record)} if record is not None else None
+
+        try:
+            started = time.perf_counter()
+            if method.lower() == 'get':
+                resp = await self.http.get(url, headers=headers, extensions=extensions)
+            elif method.lower() == 'post':
+                resp = await self.http.post(url, json=data, headers=headers, extensions=extensions)
+            else:
+                raise ValueError(f"Unsupported HTTP method: {method}")
+            self.pool.observe_latency((time.perf_counter() - started) * 1000)
+
+            if resp.status_code != 200:
+                raise ApiError(f"Server error with HTTP status code: {resp.status_code}")
+
+            return resp.json()
+        except Exception as e:
+            self.logger.error(f"API call error: {str(e)}")
+            raise ApiError(f"API call error: {str(e)}")
+
+    async def get_basic_info(self):
+        """Get user's basic information"""
+        url = f"{self.root}/service-zuul/applet/login/basicInfo"
+        headers = {
+            'Content-Type': 'application/json;charset=utf-8',
+            'User-Agent': self.ua,
+            'Authorization': self.token,
+        }
+
+        resp = await self.http.get(url, headers=headers)
+        return resp.json()
+
+    async def get_order_list(self):
+        """Get user's current reservations"""
+        return await self._call_api('get', 'getOrderList?type=0', {})
+
+    async def get_reserve_information(self, device_id):
+        """Get the raw availability information of a room"""
+        return await self._call_api('get', f'getReserveInformation?device={device_id}', {})
+
+    async def reserve_room(self, room_id, start_time, end_time):
+        """
+        Make a room reservation with proper error handling
+
+        Args:
+            room_id: Room CCOM ID
+            start_time: Reservation start time (millisecond timestamp)
+            end_time: Reservation end time (millisecond timestamp)
+
+        Returns:
+            dict: API response with status and message
+        """
+        # Ensure we're not exceeding the 3-hour limit
+        hours_diff = (end_time - start_time) / (1000 * 60 * 60)  # Convert ms to hours
+        if hours_diff > 3:
+            self.logger.warning(f"Reservation request exceeds 3-hour limit: {hours_diff} hours")
+            return {
+                'status': 400,
+                'msg': f'Reservation exceeds maximum allowed duration (3 hours). Requested: {hours_diff:.2f} hours'
+            }
+
+        data = {
+            "device": room_id,
+            'subscribeList': [{"startTime": start_time, "endTime": end_time, "aiMonitoringNum": None}]
+        }
+
+        try:
+            result = await self._call_api('post', 'placeAnOrder', data)
+            # Log the response for debugging
+            self.logger.info(f"Reserve room response: {result}")
+            return result
+        except ApiError as e:
+            # Make sure we return a dictionary with status and msg even in error cases
+            self.logger.error(f"Reserve room API error: {str(e)}")
+            return {
+                'status': 500,
+                'msg': f'API error: {str(e)}'
+            }
+
+    async def cancel_reservation(self, order_id):
+        """Cancel an existing reservation"""
+        data = {'id': order_id, 'type': '6'}
+        return await self._call_api('post', 'cancel', data)
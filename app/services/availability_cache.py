@@ -0,0 +1,113 @@
+"""
+@Author: Tianyi Zhang
+@Date: 2025/4/26
+@Description: Process-wide cache of room availability with request coalescing
+"""
+import threading
+import time
+
+
+class _Flight:
+    """An upstream fetch in progress, shared by every request that missed the same key"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class AvailabilityCache:
+    """
+    Cache CCOM availability responses by (ccom_id, date)
+
+    Availability is the same for every user, so one upstream call serves all
+    of them for `ttl` seconds. Concurrent misses for the same key are
+    coalesced: the first caller fetches, the others wait for its result.
+    Failed fetches are not cached.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, ccom_id, date, fetch, ttl, is_valid=None, wait_timeout=30):
+        """
+        Return the cached availability for (ccom_id, date), calling `fetch()` on a miss
+
+        Args:
+            ccom_id: CCOM device id of the room
+            date: Date string the availability was requested for
+            fetch: Callable doing the upstream request
+            ttl: Seconds a fetched value stays fresh
+            is_valid: Predicate deciding whether a fetched value may be cached
+            wait_timeout: Seconds a coalesced request waits for the leader
+
+        Returns:
+            tuple: (value, cached) where cached is True if no upstream call was made for this request
+        """
+        key = (str(ccom_id), date)
+
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry[1] > time.time():
+                    self.hits += 1
+                    return entry[0], True
+
+                flight = self._flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._flights[key] = _Flight()
+                    self.misses += 1
+                    break
+                self.coalesced += 1
+
+            if not flight.done.wait(wait_timeout):
+                raise TimeoutError(f"Timed out waiting for availability of room {ccom_id}")
+            if flight.error is None:
+                return flight.value, True
+            # The leader failed (e.g. its credentials were rejected); try with our own fetch
+
+        try:
+            flight.value = fetch()
+            if is_valid is None or is_valid(flight.value):
+                with self._lock:
+                    now = time.time()
+                    self._entries = {k: v for k, v in self._entries.items() if v[1] > now}
+                    self._entries[key] = (flight.value, now + ttl)
+            return flight.value, False
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    def invalidate(self, ccom_id=None, date=None):
+        """Drop cached availability, e.g. after a reservation changed it"""
+        with self._lock:
+            if ccom_id is None:
+                self._entries.clear()
+                return
+            for key in list(self._entries):
+                if key[0] == str(ccom_id) and (date is None or key[1] == date):
+                    del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            now = time.time()
+            return {
+                'entries': sum(1 for _, expires_at in self._entries.values() if expires_at > now),
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced
+            }
+
+
+# Shared by every request in the process
+availability_cache = AvailabilityCache()
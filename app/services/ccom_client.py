@@ -3,18 +3,20 @@
 @Date: 2025/4/26
 @Description: Modified CCOM client with proper error handling
 """
-import requests
-import json
-from flask import current_app
 from app.models.room import Room
-from app import db
-import csv
-import os
-import time
-from app.utils.exceptions import ApiError, LoginError, AlreadyChosen, FailedToChoose, FailedToDelChosen, FailedToFind
+from app.services.async_ccom_client import AsyncCCOMClient
+from app.services.room_scanner import RoomScanner
+from app.utils.exceptions import AlreadyChosen, FailedToChoose, FailedToDelChosen, FailedToFind
 
 
 class CCOMClient:
+    """
+    Synchronous facade over AsyncCCOMClient
+
+    Every call is run on the shared CCOM event loop, so all clients reuse the
+    same keep-alive connection pool.
+    """
+
     def __init__(self, username, password=None, token=None):
         """
         Initialize CCOM client
@@ -24,105 +26,47 @@ class CCOMClient:
             password: CCOM password - can be None if token is provided
             token: Authentication token - can be None if password is provided
         """
-        self.username = username
-        self.password = password  # Now accepts password directly
-        self.token = token
-        self.root = current_app.config['CCOM_API_ROOT']
-        self.ua = current_app.config['CCOM_API_UA']
-        self.session = requests.Session()  # Use session for persistent connections
-
-    def soft_login(self):
+        self.async_client = AsyncCCOMClient(username, password, token)
+        self.pool = self.async_client.pool
+
+    @property
+    def username(self):
+        return self.async_client.username
+
+    @property
+    def password(self):
+        return self.async_client.password
+
+    @property
+    def token(self):
+        return self.async_client.token
+
+    @token.setter
+    def token(self, value):
+        self.async_client.token = value
+
+    def _run(self, coro):
+        return self.pool.run(coro)
+
+    def soft_login(self, revalidate=False):
         """Try to use existing token, fall back to full login if that fails"""
-        if self.token:
-            try:
-                result = self.get_basic_info()
-                if result.get('status') == 200 and result.get('msg') == '成功':
-                    if result.get('data', {}).get('studentNumber', '').lower() == self.username.lower():
-                        current_app.logger.info(f"Soft login successful for user {self.username}")
-                        return True
-            except Exception as e:
-                current_app.logger.error(f"Soft login failed: {str(e)}")
-
-        # Only attempt login if we have a password
-        if self.password:
-            return self.login()
-        else:
-            raise LoginError("No password or valid token available for login")
+        return self._run(self.async_client.soft_login(revalidate))
 
     def login(self):
         """Perform full login to the CCOM system"""
-        if not self.password:
-            raise LoginError("Password is required for login")
-
-        url = f"{self.root}/service-zuul/applet/login/login"
-        headers = {'Content-Type': 'application/json;charset=UTF-8'}
-        body = {
-            "accountNumber": self.username,
-            "lessee": "151",
-            "password": self.password,
-            "code": None
-        }
-
-        try:
-            body_json = json.dumps(body)
-            headers['Content-Length'] = str(len(body_json))
-            resp = self.session.post(url, headers=headers, data=body_json, proxies=None)
-            resp_data = resp.json()
-
-            if resp_data.get('status') == 200 and resp_data.get('msg') == '成功':
-                self.token = resp_data['data']['token']
-                current_app.logger.info(f"Login successful for user {self.username}")
-                return True
-            else:
-                current_app.logger.error(f"Login failed: {resp_data}")
-                raise LoginError(f"Login failed: {resp_data.get('msg')}")
-        except Exception as e:
-            current_app.logger.error(f"Login error: {str(e)}")
-            raise LoginError(f"Login error: {str(e)}")
+        return self._run(self.async_client.login())
 
     def _call_api(self, method, api_name, data=None):
         """Generic method to call CCOM API endpoints"""
-        if self.token is None:
-            raise LoginError("You must call `login` or `soft_login` before calling other APIs")
-
-        url = f"{self.root}/order/applet/order/{api_name}"
-        headers = {
-            'Content-Type': 'application/json;charset=UTF-8',
-            'User-Agent': self.ua,
-            'Authorization': self.token,
-        }
-
-        try:
-            if method.lower() == 'get':
-                resp = self.session.get(url, headers=headers, proxies=None)
-            elif method.lower() == 'post':
-                resp = self.session.post(url, json=data, headers=headers, proxies=None)
-            else:
-                raise ValueError(f"Unsupported HTTP method: {method}")
-
-            if resp.status_code != 200:
-                raise ApiError(f"Server error with HTTP status code: {resp.status_code}")
-
-            return resp.json()
-        except Exception as e:
-            current_app.logger.error(f"API call error: {str(e)}")
-            raise ApiError(f"API call error: {str(e)}")
+        return self._run(self.async_client._call_api(method, api_name, data))
 
     def get_basic_info(self):
         """Get user's basic information"""
-        url = f"{self.root}/service-zuul/applet/login/basicInfo"
-        headers = {
-            'Content-Type': 'application/json;charset=utf-8',
-            'User-Agent': self.ua,
-            'Authorization': self.token,
-        }
-
-        resp = self.session.get(url, headers=headers, proxies=None)
-        return resp.json()
+        return self._run(self.async_client.get_basic_info())
 
     def get_order_list(self):
         """Get user's current reservations"""
-        return self._call_api('get', 'getOrderList?type=0', {})
+        return self._run(self.async_client.get_order_list())
 
     def reserve_room(self, room_id, start_time, end_time):
         """
@@ -136,52 +80,24 @@ class CCOMClient:
         Returns:
             dict: API response with status and message
         """
-        # Ensure we're not exceeding the 3-hour limit
-        hours_diff = (end_time - start_time) / (1000 * 60 * 60)  # Convert ms to hours
-        if hours_diff > 3:
-            current_app.logger.warning(f"Reservation request exceeds 3-hour limit: {hours_diff} hours")
-            return {
-                'status': 400,
-                'msg': f'Reservation exceeds maximum allowed duration (3 hours). Requested: {hours_diff:.2f} hours'
-            }
-
-        data = {
-            "device": room_id,
-            'subscribeList': [{"startTime": start_time, "endTime": end_time, "aiMonitoringNum": None}]
-        }
-
-        try:
-            result = self._call_api('post', 'placeAnOrder', data)
-            # Log the response for debugging
-            current_app.logger.info(f"Reserve room response: {result}")
-            return result
-        except ApiError as e:
-            # Make sure we return a dictionary with status and msg even in error cases
-            current_app.logger.error(f"Reserve room API error: {str(e)}")
-            return {
-                'status': 500,
-                'msg': f'API error: {str(e)}'
-            }
+        return self._run(self.async_client.reserve_room(room_id, start_time, end_time))
 
     def cancel_reservation(self, order_id):
         """Cancel an existing reservation"""
-        data = {'id': order_id, 'type': '6'}
-        result = self._call_api('post', 'cancel', data)
-        return result
+        return self._run(self.async_client.cancel_reservation(order_id))
 
-    def find_available_rooms(self, piano_only=True):
-        """Find all available rooms, optionally filtering for piano rooms only"""
-        results = []
-        rooms = Room.query.all()
+    def find_available_rooms(self, piano_only=True, max_concurrency=32):
+        """Find all available rooms, optionally filtering for piano rooms only, fetching them concurrently"""
+        rooms = RoomScanner.select_rooms(piano_only)
+        responses = self._run(RoomScanner.fetch_all(self.async_client, rooms, max_concurrency))
 
+        results = []
         for room in rooms:
-            # Skip non-piano rooms if piano_only is True
-            if piano_only and "无钢琴" in (room.instruments or ""):
-                continue
-
-            device_id = int(room.ccom_id)
-            api_response = self._call_api('get', f'getReserveInformation?device={device_id}', {})
-            parsed_response = self._parse_response(api_response)
+            api_response = responses[room.ccom_id]
+            if isinstance(api_response, Exception):
+                parsed_response = {'error': 'API call failed', 'details': str(api_response)}
+            else:
+                parsed_response = self._parse_response(api_response)
             parsed_response['room'] = {
                 'id': room.id,
                 'ccom_id': room.ccom_id,
@@ -0,0 +1,213 @@
+"""
+@Author: Tianyi Zhang
+@Date: 2025/4/26
+@Description: Room contention index used to request the most contested slots first
+"""
+from datetime import datetime
+from flask import current_app
+from app import db
+from app.models.reservation import RoomContention, ReservationHistory, OneTimeReservation
+from sqlalchemy import func, and_, or_
+from app.services.response_classifier import classify_message, SWITCH_ROOM
+
+
+class ContentionIndex:
+    """
+    Snapshot of the RoomContention table keyed by (room_id, start_time)
+
+    A slot's score is its recent failure rate, boosted up to twofold when
+    requests for it are lost within the first moments after the window opens.
+    The table is small (one row per requested slot) and is loaded with a
+    single query when the plan is built.
+    """
+
+    # Requests losing this long after the window opened count as half as contested
+    SPEED_SCALE_MS = 1000
+
+    def __init__(self, rows=(), hot_threshold=0.5, max_fanout=1):
+        """
+        Args:
+            rows: RoomContention rows
+            hot_threshold: Score from which a slot is considered hot
+            max_fanout: Number of warm connections a hot slot may be sent over
+        """
+        self.hot_threshold = hot_threshold
+        self.max_fanout = max(1, max_fanout)
+        self._scores = {(row.room_id, row.start_time): self._score(row) for row in rows}
+
+    @classmethod
+    def load(cls):
+        """Load the index from the database using the configured thresholds"""
+        config = current_app.config
+        return cls(
+            RoomContention.query.all(),
+            hot_threshold=config.get('CONTENTION_HOT_THRESHOLD', 0.5),
+            max_fanout=config.get('DISPATCH_CONTENTION_FANOUT', 1)
+        )
+
+    @classmethod
+    def _score(cls, row):
+        if not row.attempts:
+            return 0.0
+        if row.lost_after_ms is None:
+            return row.failure_rate
+        return row.failure_rate * (1 + cls.SPEED_SCALE_MS / (cls.SPEED_SCALE_MS + max(0.0, row.lost_after_ms)))
+
+    def __len__(self):
+        return len(self._scores)
+
+    def score(self, room_id, start_time):
+        """Get the contention score of a slot, 0 for slots never requested"""
+        return self._scores.get((room_id, start_time), 0.0)
+
+    def fanout(self, room_id, start_time):
+        """Suggest over how many warm connections a request for the slot should go"""
+        if self.max_fanout == 1 or self.score(room_id, start_time) < self.hot_threshold:
+            return 1
+        return self.max_fanout
+
+    @staticmethod
+    def is_room_rejection(message):
+        """Whether a rejection message means the room is taken, so another room may still succeed"""
+        # Rejections caused by the user, by sending too early or by the network say nothing about the slot
+        return classify_message(message).action == SWITCH_ROOM
+
+    @staticmethod
+    def is_contention_failure(outcome):
+        """Whether a failed outcome means somebody else got the slot first"""
+        if outcome['status'] != 'failed' or not outcome.get('processed') or outcome['item'].is_cancellation:
+            return False
+        return ContentionIndex.is_room_rejection(outcome.get('message'))
+
+    @staticmethod
+    def update(outcomes):
+        """
+        Fold the outcomes of one run into the contention table
+
+        Only the rows of slots requested in this run are read and written.
+        Rooms found taken before an outcome fell back to another room count
+        as lost requests for that slot.
+
+        Args:
+            outcomes: Outcomes of dispatched planned reservations
+        """
+        decay = current_app.config.get('CONTENTION_DECAY', 0.3)
+
+        observations = {}
+        for outcome in outcomes:
+            item = outcome['item']
+            if item.is_cancellation or not outcome.get('processed'):
+                continue
+            slot = observations.setdefault((item.room_id, item.start_time), {'attempts': 0, 'failures': 0, 'lost_ms': []})
+            slot['attempts'] += 1
+            if ContentionIndex.is_contention_failure(outcome):
+                slot['failures'] += 1
+                if outcome.get('responded_ms') is not None:
+                    slot['lost_ms'].append(outcome['responded_ms'])
+
+            for room_id in outcome.get('taken_rooms', ()):
+                slot = observations.setdefault((room_id, item.start_time), {'attempts': 0, 'failures': 0, 'lost_ms': []})
+                slot['attempts'] += 1
+                slot['failures'] += 1
+
+        if not observations:
+            return 0
+
+        room_ids = {room_id for room_id, _ in observations}
+        existing = {
+            (row.room_id, row.start_time): row
+            for row in RoomContention.query.filter(RoomContention.room_id.in_(room_ids)).all()
+            if (row.room_id, row.start_time) in observations
+        }
+
+        now = datetime.utcnow()
+        for (room_id, start_time), slot in observations.items():
+            row = existing.get((room_id, start_time))
+            rate = slot['failures'] / slot['attempts']
+            lost_ms = sum(slot['lost_ms']) / len(slot['lost_ms']) if slot['lost_ms'] else None
+
+            if row is None:
+                row = RoomContention(room_id=room_id, start_time=start_time, attempts=0, failures=0,
+                                     failure_rate=rate, lost_after_ms=lost_ms)
+                db.session.add(row)
+            else:
+                row.failure_rate += decay * (rate - row.failure_rate)
+                if lost_ms is not None:
+                    row.lost_after_ms = lost_ms if row.lost_after_ms is None else \
+                        row.lost_after_ms + decay * (lost_ms - row.lost_after_ms)
+
+            row.attempts += slot['attempts']
+            row.failures += slot['failures']
+            row.updated_at = now
+
+        db.session.commit()
+        return len(observations)
+
+    @staticmethod
+    def ensure_built():
+        """
+        Build the contention table from the history if it is still empty
+
+        Run once at startup so a deployment upgraded with existing history
+        does not start from an empty index; runs never scan the history.
+
+        Returns:
+            int: Number of rebuilt slots, 0 if nothing was done
+        """
+        if RoomContention.query.first() is not None or ReservationHistory.query.first() is None:
+            return 0
+        return ContentionIndex.rebuild()
+
+    @staticmethod
+    def rebuild():
+        """
+        Recompute the contention table from the full reservation history
+
+        Every reservation date counts as one run and is folded in date order
+        like `update` does. The history does not record how long after the
+        window opened a request lost, so rebuilt slots have no speed boost
+        until the next runs add it. Cancellations are left out.
+
+        Returns:
+            int: Number of slots in the rebuilt table
+        """
+        decay = current_app.config.get('CONTENTION_DECAY', 0.3)
+
+        rows = db.session.query(
+            ReservationHistory.reservation_date, ReservationHistory.room_id, ReservationHistory.start_time,
+            ReservationHistory.status, ReservationHistory.message, func.count(ReservationHistory.id)
+        ).outerjoin(OneTimeReservation, and_(
+            ReservationHistory.source_type == 'one_time', ReservationHistory.source_id == OneTimeReservation.id
+        )).filter(
+            or_(OneTimeReservation.is_cancellation.is_(None), OneTimeReservation.is_cancellation == False)
+        ).group_by(
+            ReservationHistory.reservation_date, ReservationHistory.room_id, ReservationHistory.start_time,
+            ReservationHistory.status, ReservationHistory.message
+        ).order_by(ReservationHistory.reservation_date).all()
+
+        runs = {}
+        for reservation_date, room_id, start_time, status, message, count in rows:
+            slot = runs.setdefault(reservation_date, {}).setdefault((room_id, start_time), [0, 0])
+            slot[0] += count
+            if status == 'failed' and ContentionIndex.is_room_rejection(message):
+                slot[1] += count
+
+        now = datetime.utcnow()
+        table = {}
+        for reservation_date in sorted(runs):
+            for (room_id, start_time), (attempts, failures) in runs[reservation_date].items():
+                rate = failures / attempts
+                row = table.get((room_id, start_time))
+                if row is None:
+                    row = table[(room_id, start_time)] = RoomContention(
+                        room_id=room_id, start_time=start_time, attempts=0, failures=0, failure_rate=rate)
+                else:
+                    row.failure_rate += decay * (rate - row.failure_rate)
+                row.attempts += attempts
+                row.failures += failures
+                row.updated_at = now
+
+        RoomContention.query.delete()
+        db.session.add_all(table.values())
+        db.session.commit()
+        return len(table)
@@ -0,0 +1,136 @@
+"""
+@Author: Tianyi Zhang
+@Date: 2025/4/26
+@Description: Precision-timed dispatch of reservation requests at the window open instant
+"""
+from datetime import datetime
+from flask import current_app
+from app.utils.time_utils import BEIJING_TIMEZONE, get_current_time, precise_sleep_until, ServerTimeHelper
+import asyncio
+import threading
+import time
+
+
+class DispatchEngine:
+    """
+    Release prepared reservation requests when the CCOM booking window opens
+
+    Workers do all of their preparation (database access, login, segment
+    splitting) ahead of time and then block in `wait()`. A single timer thread
+    sleeps until the computed fire instant, busy-waits the final milliseconds on
+    the monotonic clock and releases every worker at once.
+    """
+
+    def __init__(self, open_time=None, pool=None):
+        """
+        Initialize the dispatch engine
+
+        Args:
+            open_time: Server-side opening time string (default: RESERVATION_OPEN_TIME)
+            pool: Optional CCOMConnectionPool whose keep-alive probing stops at the fire
+                instant and whose warm connections are counted then
+        """
+        self.open_time = open_time or current_app.config['RESERVATION_OPEN_TIME']
+        self.spin_seconds = current_app.config.get('DISPATCH_SPIN_MS', 5) / 1000
+        self.lead_ms = current_app.config.get('DISPATCH_LEAD_MS', 0)
+        self.logger = current_app.logger
+        self.pool = pool
+        self.warm_connections = None
+
+        self.offset_ms = 0.0
+        self.rtt_ms = 0.0
+        self.calibrated = False
+        self.fire_wall_time = None  # Local wall-clock time at which requests are released
+        self.fire_deadline = None  # Same instant expressed in time.perf_counter()
+        self.released_at = None
+
+        self._released = threading.Event()
+        self._async_waiters = []  # (loop, asyncio.Event) pairs woken on release
+        self._waiters_lock = threading.Lock()
+        self._timer = None
+
+    def calibrate(self):
+        """Measure the server clock offset and round-trip time"""
+        try:
+            clock = ServerTimeHelper().measure_clock()
+            self.offset_ms = clock['offset_ms']
+            self.rtt_ms = clock['rtt_ms']
+            self.calibrated = True
+            self.logger.info(f"Dispatch clock calibrated: offset={self.offset_ms:.1f}ms, rtt={self.rtt_ms:.1f}ms")
+        except Exception as e:
+            # Fall back to the local clock rather than missing the window entirely
+            self.logger.error(f"Dispatch clock calibration failed, using local clock: {str(e)}")
+        return self.calibrated
+
+    def open_instant(self):
+        """Get today's window opening time on the server clock"""
+        now = get_current_time()
+        open_at = datetime.strptime(self.open_time, '%H%M').time()
+        return datetime.combine(now.date(), open_at, tzinfo=BEIJING_TIMEZONE)
+
+    def arm(self):
+        """
+        Compute the local fire instant and start the release timer
+
+        The request must leave one-way latency before the server opens, and the
+        server clock runs `offset_ms` ahead of ours.
+        """
+        server_open = self.open_instant().timestamp()
+        self.fire_wall_time = server_open - (self.offset_ms + self.rtt_ms / 2 + self.lead_ms) / 1000
+        self.fire_deadline = time.perf_counter() + (self.fire_wall_time - time.time())
+
+        if self.fire_deadline <= time.perf_counter():
+            self.logger.warning("Dispatch fire time already passed, releasing immediately")
+            self._release()
+            return
+
+        self.logger.info(
+            f"Dispatch armed for {datetime.fromtimestamp(self.fire_wall_time, BEIJING_TIMEZONE).isoformat()}")
+        self._timer = threading.Thread(target=self._run_timer, name='dispatch-timer', daemon=True)
+        self._timer.start()
+
+    def _run_timer(self):
+        precise_sleep_until(self.fire_deadline, self.spin_seconds)
+        self._release()
+
+    def _release(self):
+        self.released_at = time.perf_counter()
+        if self.pool is not None:
+            # Counted before any request can take a connection
+            self.pool.stop_keepalive()
+            self.warm_connections = self.pool.warm_connection_count()
+
+        with self._waiters_lock:
+            self._released.set()
+            waiters, self._async_waiters = self._async_waiters, []
+        for loop, event in waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    def wait(self, timeout=None):
+        """Block the calling worker until the fire instant"""
+        return self._released.wait(timeout)
+
+    async def wait_async(self):
+        """Suspend the calling coroutine until the fire instant without blocking its loop"""
+        with self._waiters_lock:
+            if self._released.is_set():
+                return
+            event = asyncio.Event()
+            self._async_waiters.append((asyncio.get_running_loop(), event))
+        await event.wait()
+
+    def stats(self):
+        """Summarize the dispatch timing for run results"""
+        release_lag_ms = None
+        if self.released_at is not None and self.fire_deadline is not None:
+            release_lag_ms = (self.released_at - self.fire_deadline) * 1000
+
+        return {
+            'calibrated': self.calibrated,
+            'offset_ms': round(self.offset_ms, 1),
+            'rtt_ms': round(self.rtt_ms, 1),
+            'fire_at': datetime.fromtimestamp(self.fire_wall_time, BEIJING_TIMEZONE).strftime(
+                '%H:%M:%S.%f')[:-3] if self.fire_wall_time else None,
+            'release_lag_ms': round(release_lag_ms, 3) if release_lag_ms is not None else None,
+            'warm_connections': self.warm_connections
+        }
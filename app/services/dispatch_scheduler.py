@@ -0,0 +1,149 @@
+"""
+@Author: Tianyi Zhang
+@Date: 2025/4/26
+@Description: Adaptive concurrency scheduler for dispatching planned reservations
+"""
+from collections import defaultdict
+import asyncio
+import math
+import time
+
+
+class DispatchScheduler:
+    """
+    Run planned requests from one shared queue on the CCOM event loop
+
+    A worker runs a whole planned reservation, retries, fallback rooms and
+    rollbacks included, so its throughput depends on the handler's service
+    time rather than on one round trip. When a DispatchEngine releases the
+    requests at the window open, every item gets its own worker (up to
+    `max_concurrency`) so none waits for another to finish. Otherwise, with
+    a mean service time of S ms, one worker gets through about
+    `target_window_ms / S` items inside the target window, and enough
+    workers are started to finish every item within it.
+    """
+
+    POLICIES = ('round_robin', 'fifo')
+
+    # Exponentially weighted handler service time, kept across runs like the pool latency
+    service_ms = None
+
+    def __init__(self, max_concurrency=200, target_window_ms=50, policy='round_robin'):
+        """
+        Args:
+            max_concurrency: Upper bound on concurrent requests (usually the pool size)
+            target_window_ms: Time in which every item should be finished without a release barrier
+            policy: 'round_robin' to interleave users fairly, 'fifo' to keep plan order
+        """
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown dispatch fairness policy: {policy}")
+
+        self.max_concurrency = max(1, max_concurrency)
+        self.target_window_ms = target_window_ms
+        self.policy = policy
+        self.concurrency = None
+        self.latency_ms = None
+
+    @classmethod
+    def observe_service_time(cls, elapsed_ms, weight=0.2):
+        """Fold the time one handler took into the running service time estimate"""
+        if cls.service_ms is None:
+            cls.service_ms = elapsed_ms
+        else:
+            cls.service_ms += weight * (elapsed_ms - cls.service_ms)
+
+    def size_concurrency(self, request_count, service_ms=None, barrier=False):
+        """
+        Choose the number of concurrent workers
+
+        Args:
+            request_count: Number of items to run
+            service_ms: Mean time one handler takes, None if unknown
+            barrier: The items are held until a common release instant
+
+        Returns:
+            int: Number of workers
+        """
+        if request_count <= 0:
+            return 0
+
+        if not barrier and service_ms and service_ms > 0:
+            per_worker = max(1, int(self.target_window_ms // service_ms))
+            needed = math.ceil(request_count / per_worker)
+        else:
+            # Behind a release barrier, or without an estimate, start everything at once
+            needed = request_count
+
+        return max(1, min(self.max_concurrency, needed))
+
+    def order(self, items, key=lambda item: item.user_id, priority=None):
+        """
+        Order the shared queue according to the fairness policy
+
+        With 'round_robin', every user's first request is queued before any
+        user's second one, so users with many reservations cannot crowd out
+        users with a single one. Items with a higher `priority` go first,
+        both among a user's own items and within each round.
+        """
+        items = list(items)
+        if priority:
+            items.sort(key=lambda item: -priority(item))
+        if self.policy == 'fifo':
+            return items
+
+        rank = defaultdict(int)
+        ranked = []
+        for position, item in enumerate(items):
+            user = key(item)
+            ranked.append((rank[user], position, item))
+            rank[user] += 1
+
+        return [item for _, _, item in sorted(ranked, key=lambda entry: entry[:2])]
+
+    async def run(self, items, handler, latency_ms=None, barrier=False):
+        """
+        Process every item with `handler` using the adaptive worker count
+
+        Args:
+            items: Planned items, already ordered
+            handler: Coroutine function called with each item
+            latency_ms: Observed server latency, None if unknown (reported in the stats)
+            barrier: The handlers wait for a common release instant, e.g. a DispatchEngine
+
+        Returns:
+            list: Handler results in the order of `items`
+        """
+        items = list(items)
+        self.latency_ms = latency_ms
+        self.concurrency = self.size_concurrency(len(items), self.service_ms, barrier)
+        results = [None] * len(items)
+
+        queue = asyncio.Queue()
+        for index, item in enumerate(items):
+            queue.put_nowait((index, item))
+
+        async def worker():
+            while True:
+                try:
+                    index, item = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                started = time.perf_counter()
+                try:
+                    results[index] = await handler(item)
+                except Exception as e:
+                    results[index] = e
+                if not barrier:
+                    # Behind a barrier the handler time is mostly waiting for the release
+                    self.observe_service_time((time.perf_counter() - started) * 1000)
+
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        return results
+
+    def stats(self):
+        return {
+            'workers': self.concurrency,
+            'latency_ms': round(self.latency_ms, 1) if self.latency_ms else None,
+            'service_ms': round(self.service_ms, 1) if self.service_ms else None,
+            'policy': self.policy
+        }
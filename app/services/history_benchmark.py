@@ -0,0 +1,140 @@
+"""
+@Author: Tianyi Zhang
+@Date: 2025/4/26
+@Description: Benchmark of the reservation history access paths with and without their indexes
+"""
+from sqlalchemy import create_engine, select, text
+from app.models.reservation import ReservationHistory
+from datetime import date, datetime, timedelta
+import random
+import statistics
+import time
+
+
+class HistoryBenchmark:
+    """
+    Seed a synthetic reservation history in a scratch SQLite database and time
+    the queries the application runs against it, first without and then with
+    the indexes declared on ReservationHistory
+    """
+
+    def __init__(self, rows=200000, users=500, rooms=120, days=365, repeat=5, seed=0):
+        self.rows = rows
+        self.users = users
+        self.rooms = rooms
+        self.days = days
+        self.repeat = repeat
+        self.random = random.Random(seed)
+        self.today = date.today()
+        self.table = ReservationHistory.__table__
+        self.engine = create_engine('sqlite://')
+
+    def seed(self, batch_size=10000):
+        """Create the table without its secondary indexes and fill it with synthetic rows"""
+        self.table.create(self.engine)
+        with self.engine.begin() as conn:
+            for index in self.table.indexes:
+                conn.execute(text(f'DROP INDEX IF EXISTS {index.name}'))
+
+            start = datetime.combine(self.today - timedelta(days=self.days), datetime.min.time())
+            batch = []
+            for i in range(self.rows):
+                offset = self.random.randrange(self.days + 7)
+                hour = self.random.randrange(8, 22)
+                batch.append({
+                    'user_id': self.random.randrange(1, self.users + 1),
+                    'room_id': self.random.randrange(1, self.rooms + 1),
+                    'reservation_date': (start + timedelta(days=offset)).date(),
+                    'start_time': f'{hour:02d}00',
+                    'end_time': f'{hour + 1:02d}00',
+                    'status': 'successful' if self.random.random() < 0.6 else 'failed',
+                    'message': '预约成功',
+                    'source_type': 'recurring',
+                    'source_id': i,
+                    'created_at': start + timedelta(days=offset - 1, hours=21, minutes=30, seconds=i % 60)
+                })
+                if len(batch) >= batch_size:
+                    conn.execute(self.table.insert(), batch)
+                    batch = []
+            if batch:
+                conn.execute(self.table.insert(), batch)
+
+    def queries(self):
+        """The access paths of the application, keyed by a short name"""
+        t = self.table
+        user_id = self.random.randrange(1, self.users + 1)
+        tomorrow = self.today + timedelta(days=1)
+        month_ago = self.today - timedelta(days=30)
+
+        return {
+            # ReservationService.get_user_daily_reservations
+            'daily_limit': select(t).where(
+                t.c.user_id == user_id, t.c.reservation_date == tomorrow, t.c.status == 'successful'),
+            # main.dashboard upcoming reservations
+            'dashboard_upcoming': select(t).where(
+                t.c.user_id == user_id, t.c.status == 'successful',
+                t.c.reservation_date >= self.today, t.c.reservation_date <= self.today + timedelta(days=7)
+            ).order_by(t.c.reservation_date, t.c.start_time),
+            # reservation.history default 30 day window
+            'user_history': select(t).where(
+                t.c.user_id == user_id, t.c.reservation_date >= month_ago, t.c.reservation_date <= self.today
+            ).order_by(t.c.reservation_date.desc(), t.c.start_time),
+            # admin.index and admin.history first page
+            'admin_recent': select(t).order_by(t.c.created_at.desc()).limit(20),
+            # NotificationService.send_bulk_reservation_results
+            'recent_created': select(t).where(t.c.created_at >= datetime.combine(self.today, datetime.min.time())),
+            # admin.history date range filter and per-date digests
+            'date_range': select(t).where(t.c.reservation_date == tomorrow)
+        }
+
+    def time_queries(self, queries):
+        timings = {}
+        with self.engine.connect() as conn:
+            for name, query in queries.items():
+                samples = []
+                for _ in range(self.repeat):
+                    started = time.perf_counter()
+                    conn.execute(query).fetchall()
+                    samples.append((time.perf_counter() - started) * 1000)
+                timings[name] = statistics.median(samples)
+        return timings
+
+    def query_plans(self, queries):
+        plans = {}
+        with self.engine.connect() as conn:
+            for name, query in queries.items():
+                compiled = query.compile(self.engine, compile_kwargs={'literal_binds': True})
+                rows = conn.execute(text(f'EXPLAIN QUERY PLAN {compiled}')).fetchall()
+                plans[name] = '; '.join(row[-1] for row in rows)
+        return plans
+
+    def create_indexes(self):
+        for index in self.table.indexes:
+            index.create(self.engine)
+
+    def run(self):
+        """
+        Seed, time every query without indexes, create the indexes and time again
+
+        Returns:
+            dict: rows, seed_seconds, and per query the median timings in ms
+                before/after with the query plan after indexing
+        """
+        started = time.perf_counter()
+        self.seed()
+        seed_seconds = time.perf_counter() - started
+
+        queries = self.queries()
+        before = self.time_queries(queries)
+        self.create_indexes()
+        after = self.time_queries(queries)
+        plans = self.query_plans(queries)
+
+        return {
+            'rows': self.rows,
+            'seed_seconds': seed_seconds,
+            'queries': {
+                name: {'before_ms': before[name], 'after_ms': after[name], 'plan': plans[name]}
+                for name in queries
+            }
+        }
@@ -0,0 +1,111 @@
+"""
+@Author: Tianyi Zhang
+@Date: 2025/4/26
+@Description: Streaming export of the reservation history as CSV or JSON Lines
+"""
+from sqlalchemy import select
+from app import db
+from app.models.user import User
+from app.models.room import Room
+from app.models.reservation import ReservationHistory
+from datetime import date, datetime
+import csv
+import io
+import json
+
+
+EXPORT_COLUMNS = (
+    'id', 'reservation_date', 'start_time', 'end_time', 'user_id', 'username', 'room_id', 'room_name',
+    'room_ccom_id', 'status', 'message', 'source_type', 'source_id', 'created_at'
+)
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson'
+}
+
+
+class HistoryExporter:
+    """
+    Stream ReservationHistory joined with user and room names
+
+    Rows are fetched through a server-side cursor in batches of `batch_size`
+    and encoded as they arrive, so memory use does not grow with the export.
+    """
+
+    def __init__(self, user_id=None, status=None, date_from=None, date_to=None, batch_size=1000):
+        self.user_id = user_id
+        self.status = status
+        self.date_from = date_from
+        self.date_to = date_to
+        self.batch_size = batch_size
+
+    def statement(self):
+        h = ReservationHistory
+        stmt = select(
+            h.id, h.reservation_date, h.start_time, h.end_time, h.user_id, User.username, h.room_id,
+            Room.name, Room.ccom_id, h.status, h.message, h.source_type, h.source_id, h.created_at
+        ).join(User, User.id == h.user_id).join(Room, Room.id == h.room_id)
+
+        if self.user_id:
+            stmt = stmt.where(h.user_id == self.user_id)
+        if self.status:
+            stmt = stmt.where(h.status == self.status)
+        if self.date_from:
+            stmt = stmt.where(h.reservation_date >= self.date_from)
+        if self.date_to:
+            stmt = stmt.where(h.reservation_date <= self.date_to)
+
+        # Follows ix_reservation_history_date so the database can stream in index order
+        return stmt.order_by(h.reservation_date, h.id)
+
+    def rows(self):
+        """Yield one tuple per history entry, in EXPORT_COLUMNS order"""
+        result = db.session.execute(self.statement().execution_options(yield_per=self.batch_size))
+        try:
+            for partition in result.partitions():
+                yield from partition
+        finally:
+            result.close()
+
+    def csv_chunks(self):
+        """Yield the export as CSV text, one chunk per batch"""
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        # BOM so spreadsheet programs detect UTF-8 for the Chinese messages
+        buffer.write('\ufeff')
+        writer.writerow(EXPORT_COLUMNS)
+
+        for count, row in enumerate(self.rows(), 1):
+            writer.writerow([_text(value) for value in row])
+            if count % self.batch_size == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+
+        yield buffer.getvalue()
+
+    def jsonl_chunks(self):
+        """Yield the export as JSON Lines, one chunk per batch"""
+        lines = []
+        for row in self.rows():
+            record = {column: _text(value) if isinstance(value, (date, datetime)) else value
+                      for column, value in zip(EXPORT_COLUMNS, row)}
+            lines.append(json.dumps(record, ensure_ascii=False))
+            if len(lines) >= self.batch_size:
+                yield '\n'.join(lines) + '\n'
+                lines = []
+
+        if lines:
+            yield '\n'.join(lines) + '\n'
+
+    def chunks(self, export_format):
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(f"Unsupported export format: {export_format}")
+        return self.csv_chunks() if export_format == 'csv' else self.jsonl_chunks()
+
+
+def _text(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
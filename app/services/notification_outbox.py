@@ -0,0 +1,268 @@
+"""
+@Author: Tianyi Zhang
+@Date: 2025/4/26
+@Description: Asynchronous notification outbox drained by a pool of delivery workers
+"""
+from collections import deque
+from flask import current_app
+from requests.adapters import HTTPAdapter
+import itertools
+import queue
+import threading
+import time
+import requests
+
+
+NOTICE_SERVER = "https://notice.zty.ink"
+
+
+def mask_key(key):
+    return key[:5] + '...' if len(key) > 5 else '***'
+
+
+def create_session(pool_size):
+    """Create an HTTP session that keeps up to `pool_size` connections to the push server open"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def deliver(session, key, payload, timeout=10):
+    """
+    Send one notification to one push key
+
+    Returns:
+        tuple: (success, error description or None)
+    """
+    try:
+        response = session.post(f"{NOTICE_SERVER}/{key}", data=payload, timeout=timeout)
+    except requests.exceptions.Timeout:
+        return False, 'timeout'
+    except requests.exceptions.ConnectionError:
+        return False, 'connection error'
+    except Exception as e:
+        return False, str(e)
+
+    if response.status_code == 200:
+        return True, None
+    return False, f"HTTP {response.status_code}: {response.text[:100]}"
+
+
+class OutboxMessage:
+    """A notification waiting to be delivered"""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, user_id, payload, key=None, attempt=0, enqueued_at=None):
+        self.id = next(self._ids)
+        self.user_id = user_id
+        self.payload = payload
+        self.key = key  # None until the user's keys have been resolved
+        self.attempt = attempt
+        self.enqueued_at = enqueued_at or time.time()
+
+    def for_key(self, key):
+        return OutboxMessage(self.user_id, self.payload, key, 0, self.enqueued_at)
+
+
+class NotificationOutbox:
+    """
+    Process-wide queue of notifications delivered by background workers
+
+    Callers enqueue a message and return immediately. Workers look up the
+    user's push keys, send to each key over one pooled HTTP session (at most
+    NOTIFICATION_PER_KEY_CONCURRENCY requests per key at a time) and retry
+    failed deliveries with exponential backoff. Messages for a key that is
+    busy wait in that key's own list and are queued again when one of its
+    deliveries finishes, so no worker spins on them.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, app, workers=4, per_key_concurrency=1, max_retries=3, retry_backoff=1.0, timeout=10):
+        """
+        Args:
+            app: Flask app, used for the workers' app context
+            workers: Number of delivery threads
+            per_key_concurrency: Maximum concurrent deliveries to one push key
+            max_retries: Retries of a failed delivery before giving up
+            retry_backoff: First retry delay in seconds, doubled on every further retry
+            timeout: HTTP timeout in seconds
+        """
+        self.app = app
+        self.per_key_concurrency = per_key_concurrency
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.timeout = timeout
+        self.session = create_session(workers)
+
+        self._queue = queue.Queue()
+        self._key_active = {}  # Push key -> deliveries in progress
+        self._key_waiting = {}  # Push key -> messages waiting for a free slot of that key
+        self._key_lock = threading.Lock()
+        self._scheduled_retries = 0
+
+        self._metrics_lock = threading.Lock()
+        self._counters = {'enqueued': 0, 'delivered': 0, 'failed': 0, 'retried': 0, 'dropped': 0}
+        self._latencies = deque(maxlen=500)  # Seconds from enqueue to delivery
+
+        self._workers = [
+            threading.Thread(target=self._run_worker, name=f'notification-worker-{i}', daemon=True)
+            for i in range(max(1, workers))
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    @classmethod
+    def get(cls):
+        """Get the shared outbox, creating it from the app config on first use"""
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    config = current_app.config
+                    cls._instance = cls(
+                        current_app._get_current_object(),
+                        workers=config.get('NOTIFICATION_WORKERS', 4),
+                        per_key_concurrency=config.get('NOTIFICATION_PER_KEY_CONCURRENCY', 1),
+                        max_retries=config.get('NOTIFICATION_MAX_RETRIES', 3),
+                        retry_backoff=config.get('NOTIFICATION_RETRY_BACKOFF', 1.0),
+                        timeout=config.get('NOTIFICATION_TIMEOUT', 10)
+                    )
+        return cls._instance
+
+    def _count(self, name, value=1):
+        with self._metrics_lock:
+            self._counters[name] += value
+
+    def enqueue(self, user_id, payload):
+        """Queue a notification for all of a user's push keys and return at once"""
+        self._count('enqueued')
+        self._queue.put(OutboxMessage(user_id, payload))
+
+    def _acquire_slot(self, message):
+        """Take a delivery slot of the message's key, or park the message until one is free"""
+        with self._key_lock:
+            if self._key_active.get(message.key, 0) >= self.per_key_concurrency:
+                self._key_waiting.setdefault(message.key, deque()).append(message)
+                return False
+            self._key_active[message.key] = self._key_active.get(message.key, 0) + 1
+            return True
+
+    def _release_slot(self, key):
+        """Free a delivery slot of `key` and queue the next message waiting for it"""
+        with self._key_lock:
+            self._key_active[key] -= 1
+            if not self._key_active[key]:
+                del self._key_active[key]
+            waiting = self._key_waiting.get(key)
+            if not waiting:
+                return
+            message = waiting.popleft()
+            if not waiting:
+                del self._key_waiting[key]
+            # Queued before the slot's own task is done, so join() never sees a gap
+            self._queue.put(message)
+
+    def _parked_count(self):
+        with self._key_lock:
+            return sum(len(waiting) for waiting in self._key_waiting.values())
+
+    def _run_worker(self):
+        while True:
+            message = self._queue.get()
+            try:
+                if message.key is None:
+                    self._expand(message)
+                else:
+                    self._deliver(message)
+            except Exception as e:
+                self.app.logger.error(f"Notification worker error: {str(e)}")
+            finally:
+                self._queue.task_done()
+
+    def _expand(self, message):
+        """Resolve the user's push keys and queue one delivery per key"""
+        from app.models.user import User
+
+        with self.app.app_context():
+            user = User.query.get(message.user_id)
+            keys = []
+            if user and user.push_notification_key:
+                keys = [key.strip() for key in user.push_notification_key.split(',') if key.strip()]
+
+        if not keys:
+            self._count('dropped')
+            self.app.logger.warning(f"Dropping notification for user {message.user_id}: no notification key")
+            return
+
+        for key in keys:
+            self._queue.put(message.for_key(key))
+
+    def _deliver(self, message):
+        if not self._acquire_slot(message):
+            # Another worker is talking to this key - the message waits for that delivery to finish
+            return
+
+        try:
+            success, error = deliver(self.session, message.key, message.payload, self.timeout)
+        finally:
+            self._release_slot(message.key)
+
+        if success:
+            self._count('delivered')
+            with self._metrics_lock:
+                self._latencies.append(time.time() - message.enqueued_at)
+            self.app.logger.info(f"Delivered notification {message.id} to key {mask_key(message.key)}")
+            return
+
+        if message.attempt < self.max_retries:
+            delay = self.retry_backoff * (2 ** message.attempt)
+            message.attempt += 1
+            self._count('retried')
+            self.app.logger.warning(f"Notification {message.id} to key {mask_key(message.key)} failed ({error}), "
+                                    f"retrying in {delay:.1f}s")
+            self._schedule_retry(message, delay)
+        else:
+            self._count('failed')
+            self.app.logger.error(f"Giving up on notification {message.id} to key {mask_key(message.key)}: {error}")
+
+    def _schedule_retry(self, message, delay):
+        with self._metrics_lock:
+            self._scheduled_retries += 1
+
+        def requeue():
+            with self._metrics_lock:
+                self._scheduled_retries -= 1
+            self._queue.put(message)
+
+        timer = threading.Timer(delay, requeue)
+        timer.daemon = True
+        timer.start()
+
+    def join(self, timeout=None):
+        """Wait until the queue is empty (scheduled retries excluded), for tests and shutdown"""
+        deadline = time.time() + timeout if timeout is not None else None
+        while self._queue.unfinished_tasks or self._parked_count():
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def stats(self):
+        """Queue depth, delivery counters and delivery latency in milliseconds"""
+        with self._metrics_lock:
+            latencies = sorted(self._latencies)
+            stats = dict(self._counters)
+            stats['queue_depth'] = self._queue.qsize() + self._scheduled_retries
+        stats['queue_depth'] += self._parked_count()
+
+        if latencies:
+            stats['latency_avg_ms'] = round(sum(latencies) / len(latencies) * 1000, 1)
+            stats['latency_p95_ms'] = round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 1)
+            stats['latency_max_ms'] = round(latencies[-1] * 1000, 1)
+        else:
+            stats['latency_avg_ms'] = stats['latency_p95_ms'] = stats['latency_max_ms'] = None
+        return stats
@@ -3,14 +3,45 @@
 @Date: 2025/4/26
 @Description: Notification service for reservation system
 """
-import requests
 from flask import current_app
 from app.models.user import User
+from app.services.notification_outbox import NotificationOutbox, create_session, deliver, mask_key
 from app import db
 from datetime import datetime, timedelta
 
+# Session of the synchronous sends, kept apart from the outbox so a one-off send starts no workers
+_session = create_session(4)
+
 
 class NotificationService:
+    @staticmethod
+    def build_payload(title, message, icon=None, group=None):
+        payload = {
+            'title': title,
+            'body': message
+        }
+
+        if icon:
+            payload['icon'] = icon
+        if group:
+            payload['group'] = group
+
+        return payload
+
+    @staticmethod
+    def enqueue_notification(user_id, title, message, icon=None, group=None):
+        """
+        Queue a push notification for background delivery and return immediately
+
+        Returns:
+            bool: True if the notification was queued
+        """
+        if not current_app.config.get('NOTIFICATION_ENABLED', False):
+            return False
+
+        NotificationOutbox.get().enqueue(user_id, NotificationService.build_payload(title, message, icon, group))
+        return True
+
     @staticmethod
     def send_notification(user_id, title, message, icon=None, group=None):
         """
@@ -54,58 +85,33 @@ class NotificationService:
         current_app.logger.info(f"Notification title: {title}")
         current_app.logger.info(f"Notification message: {message}")
 
+        payload = NotificationService.build_payload(title, message, icon, group)
         success = False
         for i, key in enumerate(notification_keys):
-            try:
-                # Mask the key for logging purposes
-                masked_key = key[:5] + '...' if len(key) > 5 else '***'
-                current_app.logger.info(f"Sending to key #{i + 1}: {masked_key}")
-
-                server_url = f"https://notice.zty.ink/{key}"
-
-                payload = {
-                    'title': title,
-                    'body': message
-                }
-
-                if icon:
-                    payload['icon'] = icon
-                if group:
-                    payload['group'] = group
-
-                # Send the notification with a timeout
-                response = requests.post(server_url, data=payload, timeout=10)
+            current_app.logger.info(f"Sending to key #{i + 1}: {mask_key(key)}")
 
-                # Log the response
-                current_app.logger.info(f"Response for key #{i + 1}: Status {response.status_code}")
-
-                if response.status_code == 200:
-                    success = True
-                    current_app.logger.info(f"Successfully sent notification to key #{i + 1}")
-                else:
-                    current_app.logger.warning(
-                        f"Failed to send notification to key #{i + 1}. Status: {response.status_code}")
-                    try:
-                        current_app.logger.warning(f"Error response: {response.text[:100]}")
-                    except:
-                        pass
-
-            except requests.exceptions.Timeout:
-                current_app.logger.error(f"Timeout sending notification to key #{i + 1}")
-            except requests.exceptions.ConnectionError:
-                current_app.logger.error(f"Connection error sending notification to key #{i + 1}")
-            except Exception as e:
-                current_app.logger.error(f"Error sending notification to key #{i + 1}: {str(e)}")
+            sent, error = deliver(_session, key, payload, current_app.config.get('NOTIFICATION_TIMEOUT', 10))
+            if sent:
+                success = True
+                current_app.logger.info(f"Successfully sent notification to key #{i + 1}")
+            else:
+                current_app.logger.warning(f"Failed to send notification to key #{i + 1}: {error}")
 
         return success
 
     @staticmethod
-    def send_reservation_success(user_id, room_name, date, start_time, end_time):
-        """Send notification about successful reservation"""
+    def should_notify(status, message):
+        """False for "duplicate request" failures, which users are never notified about"""
+        return status == 'successful' or not (message and "重复请求" in message)
+
+    @staticmethod
+    def send_reservation_success(user_id, room_name, date, start_time, end_time, enqueue=False):
+        """Send notification about successful reservation, or queue it with `enqueue`"""
         formatted_time = f"{start_time[:2]}:{start_time[2:]} - {end_time[:2]}:{end_time[2:]}"
         message = f"恭喜！已成功预订于 {date} {formatted_time}的{room_name}。请按时前往"
 
-        return NotificationService.send_notification(
+        send = NotificationService.enqueue_notification if enqueue else NotificationService.send_notification
+        return send(
             user_id=user_id,
             title="琴房预约成功",
             message=message,
@@ -114,12 +120,13 @@ class NotificationService:
         )
 
     @staticmethod
-    def send_reservation_failure(user_id, room_name, date, start_time, end_time, reason):
-        """Send notification about failed reservation"""
+    def send_reservation_failure(user_id, room_name, date, start_time, end_time, reason, enqueue=False):
+        """Send notification about failed reservation, or queue it with `enqueue`"""
         formatted_time = f"{start_time[:2]}:{start_time[2:]} - {end_time[:2]}:{end_time[2:]}"
         message = f"很抱歉，预定的于 {date} {formatted_time} 的 {room_name}  失败。原因：{reason}"
 
-        return NotificationService.send_notification(
+        send = NotificationService.enqueue_notification if enqueue else NotificationService.send_notification
+        return send(
             user_id=user_id,
             title="琴房预约失败",
             message=message,
@@ -128,12 +135,46 @@ class NotificationService:
         )
 
     @staticmethod
-    def send_bulk_reservation_results(results):
+    def send_reservation_digest(user_id, date, entries, enqueue=False):
+        """
+        Send one notification summarizing all of a user's reservation outcomes for a date,
+        or queue it with `enqueue`
+
+        Args:
+            user_id: User ID
+            date: Reservation date string
+            entries: Dicts with room_name, start_time, end_time, status and reason
+        """
+        successful = [e for e in entries if e['status'] == 'successful']
+        failed = [e for e in entries if e['status'] != 'successful']
+
+        lines = [f"{date} 预约结果：成功 {len(successful)} 个，失败 {len(failed)} 个"]
+        for entry in sorted(entries, key=lambda e: e['start_time']):
+            formatted_time = f"{entry['start_time'][:2]}:{entry['start_time'][2:]} - {entry['end_time'][:2]}:{entry['end_time'][2:]}"
+            if entry['status'] == 'successful':
+                lines.append(f"✓ {formatted_time} {entry['room_name']}")
+            else:
+                lines.append(f"✗ {formatted_time} {entry['room_name']}（{entry['reason']}）")
+
+        send = NotificationService.enqueue_notification if enqueue else NotificationService.send_notification
+        return send(
+            user_id=user_id,
+            title="琴房预约成功" if not failed else ("琴房预约失败" if not successful else "琴房预约部分成功"),
+            message="\n".join(lines),
+            icon="https://api.zty.ink/api/v2/objects/icon/se2ezd5tzxgsubc0rx.png" if not failed
+            else "https://api.zty.ink/api/v2/objects/icon/fi9tl1ylkeyi8yoirb.png",
+            group="CCOM Piano Reservation"
+        )
+
+    @staticmethod
+    def send_bulk_reservation_results(results, digest=None):
         """
         Send notifications for bulk reservation results with direct history query
 
         Args:
             results: Results from ReservationService.execute_reservations()
+            digest: Send one digest per user instead of one push per reservation
+                (default: NOTIFICATION_DIGEST)
 
         Returns:
             int: Number of notifications sent
@@ -143,6 +184,11 @@ class NotificationService:
         from app.models.user import User
         from app.models.room import Room
 
+        if digest is None:
+            digest = current_app.config.get('NOTIFICATION_DIGEST', False)
+        if digest and results.get('target_date'):
+            return NotificationService.send_bulk_digests(results['target_date'])
+
         current_app.logger.info("Beginning to send bulk reservation notifications")
 
         # Use a much wider time window - last 60 minutes to be safe
@@ -230,7 +276,7 @@ class NotificationService:
                     )
                 else:
                     # Skip notification for "duplicate request" failures
-                    if history.message and "重复请求" in history.message:
+                    if not NotificationService.should_notify(history.status, history.message):
                         current_app.logger.info(f"Skipping notification for duplicate request: {history.id}")
                         continue
 
@@ -255,4 +301,58 @@ class NotificationService:
                 current_app.logger.error(traceback.format_exc())
 
         current_app.logger.info(f"Finished sending notifications. Total sent: {notifications_sent}")
-        return notifications_sent
\ No newline at end of file
+        return notifications_sent
+
+    @staticmethod
+    def send_bulk_digests(target_date):
+        """
+        Queue one digest of their outcomes for `target_date` for every user with a notification key
+
+        All history entries, room names and keys are loaded with a single joined query.
+
+        Returns:
+            int: Number of digests queued
+        """
+        from app.models.reservation import ReservationHistory
+        from app.models.room import Room
+
+        rows = db.session.query(
+            ReservationHistory.user_id,
+            ReservationHistory.start_time,
+            ReservationHistory.end_time,
+            ReservationHistory.status,
+            ReservationHistory.message,
+            Room.name
+        ).join(Room, Room.id == ReservationHistory.room_id).join(
+            User, User.id == ReservationHistory.user_id
+        ).filter(
+            ReservationHistory.reservation_date == target_date,
+            User.push_notification_key != None,
+            User.push_notification_key != ''
+        ).order_by(ReservationHistory.created_at, ReservationHistory.id).all()
+
+        # Latest outcome per (user, room, start time); later rows overwrite earlier ones
+        latest = {}
+        for user_id, start_time, end_time, status, message, room_name in rows:
+            if not NotificationService.should_notify(status, message):
+                continue
+            latest[(user_id, room_name, start_time)] = {
+                'room_name': room_name,
+                'start_time': start_time,
+                'end_time': end_time,
+                'status': status,
+                'reason': message or "Unknown error"
+            }
+
+        by_user = {}
+        for (user_id, _, _), entry in latest.items():
+            by_user.setdefault(user_id, []).append(entry)
+
+        date_str = target_date.strftime('%Y-%m-%d')
+        sent = 0
+        for user_id, entries in by_user.items():
+            if NotificationService.send_reservation_digest(user_id, date_str, entries, enqueue=True):
+                sent += 1
+
+        current_app.logger.info(f"Queued {sent} reservation digests for {date_str} ({len(latest)} reservations)")
+        return sent
@@ -0,0 +1,129 @@
+"""
+@Author: Tianyi Zhang
+@Date: 2025/4/26
+@Description: Per-run index of the users' CCOM orders for cancellations and rollbacks
+"""
+from datetime import datetime
+from app.utils.time_utils import BEIJING_TIMEZONE, parse_hhmm
+import threading
+import time
+
+
+def _order_slot(timestamp_ms):
+    """(ISO date, minute of the day) of a millisecond timestamp in Beijing time"""
+    start = datetime.fromtimestamp(timestamp_ms / 1000, BEIJING_TIMEZONE)
+    return start.date().isoformat(), start.hour * 60 + start.minute
+
+
+class OrderIndex:
+    """
+    One user's CCOM orders indexed by (device, date, start time)
+
+    Each order's start is converted to Beijing time once when the index is
+    built, so finding the order of a cancellation is a dictionary lookup
+    instead of a scan of the whole order list. Orders are taken out of the
+    index when found, so concurrent cancellations of the same user never
+    pick the same order.
+    """
+
+    def __init__(self, orders, fetched_at=None):
+        """
+        Args:
+            orders: `data` of a getOrderList response
+            fetched_at: time.time() of the fetch (default: now)
+        """
+        self.fetched_at = fetched_at or time.time()
+        self._by_start = {}  # (device, ISO date, minute of the day) -> order
+        self._by_day = {}  # (device, ISO date) -> orders sorted by start
+        for order in sorted(orders, key=lambda order: order['startTime']):
+            day, minute = _order_slot(order['startTime'])
+            device = str(order['device'])
+            self._by_start.setdefault((device, day, minute), order)
+            self._by_day.setdefault((device, day), []).append(order)
+
+    def __len__(self):
+        return len(self._by_start)
+
+    def take(self, device, day, start_time=None):
+        """
+        Take the order for a room on a day out of the index
+
+        Args:
+            device: Room CCOM ID
+            day: Date (or ISO date string) of the order
+            start_time: Start time string (e.g., "1400"); when no order starts
+                exactly then, the first remaining order of that room and day is taken
+
+        Returns:
+            dict: The order, or None if the user holds none for that room and day
+        """
+        device = str(device)
+        day = day if isinstance(day, str) else day.isoformat()
+        order = None
+        if start_time is not None:
+            order = self._by_start.get((device, day, parse_hhmm(start_time)))
+        if order is None:
+            orders = self._by_day.get((device, day))
+            order = orders[0] if orders else None
+        if order is not None:
+            self._discard(device, day, order)
+        return order
+
+    def take_at(self, device, start_timestamp):
+        """Take the order for a room starting exactly at a millisecond timestamp, or None"""
+        device = str(device)
+        day, minute = _order_slot(start_timestamp)
+        order = self._by_start.get((device, day, minute))
+        if order is not None and order['startTime'] == start_timestamp:
+            self._discard(device, day, order)
+            return order
+        return None
+
+    def _discard(self, device, day, order):
+        day_orders = self._by_day.get((device, day), [])
+        day_orders.remove(order)
+        if not day_orders:
+            self._by_day.pop((device, day), None)
+        key = (device,) + _order_slot(order['startTime'])
+        if self._by_start.get(key) is order:
+            # Another order starting in the same minute takes its place
+            replacement = next((other for other in day_orders if other['startTime'] == order['startTime']), None)
+            if replacement is None:
+                del self._by_start[key]
+            else:
+                self._by_start[key] = replacement
+
+    @staticmethod
+    async def fetch(client):
+        """
+        Fetch and index the orders of a logged-in AsyncCCOMClient's user
+
+        Raises:
+            ValueError: If CCOM did not return the order list
+        """
+        response = await client.get_order_list()
+        if response.get('status') != 200:
+            raise ValueError(response.get('msg') or f"status {response.get('status')}")
+        return OrderIndex(response.get('data') or [])
+
+
+# Order indexes fetched by the pre-login job, consumed by the reservation job
+_prefetched = None
+_prefetch_lock = threading.Lock()
+
+
+def set_prefetched_orders(target_date, indexes):
+    """Store the prefetched indexes (user_id -> OrderIndex) for the run booking `target_date`"""
+    global _prefetched
+    with _prefetch_lock:
+        _prefetched = (target_date, indexes) if indexes is not None else None
+
+
+def take_prefetched_orders(target_date):
+    """Take the indexes prefetched for `target_date` out of the store; each run gets its own"""
+    global _prefetched
+    with _prefetch_lock:
+        prefetched, _prefetched = _prefetched, None
+    if prefetched is None or prefetched[0] != target_date:
+        return {}
+    return prefetched[1]
@@ -0,0 +1,262 @@
+"""
+@Author: Tianyi Zhang
+@Date: 2025/4/26
+@Description: Pre-materialized reservation work plan built before the booking window opens
+"""
+from datetime import datetime, timedelta, date
+from flask import current_app
+from typing import NamedTuple, Optional, Tuple
+from app.models.user import User
+from app.models.room import Room
+from app.models.reservation import RecurringReservation, OneTimeReservation
+from app.services.contention_index import ContentionIndex
+from app.utils.time_utils import get_day_of_week
+import json
+import threading
+
+
+class PlannedReservation(NamedTuple):
+    """A single ready-to-send reservation or cancellation"""
+    source_type: str  # recurring, one_time
+    source_id: int
+    user_id: int
+    username: str
+    password: Optional[str]
+    token: Optional[str]
+    token_verified: bool
+    room_id: int
+    room_ccom_id: str
+    room_name: str
+    start_time: str
+    end_time: str
+    segments: Tuple[Tuple[int, int], ...]  # (start_ms, end_ms) pairs from split_reservation_time
+    is_cancellation: bool = False
+    contention: float = 0.0  # Score from the contention index, higher is requested earlier
+    fanout: int = 1  # Suggested number of warm connections for this request
+    fallbacks: Tuple[Tuple[int, str, str], ...] = ()  # (room_id, ccom_id, name) tried in order if the room is taken
+    contiguous: bool = False  # All segments or none: cancel booked segments if another one fails
+
+    def to_dict(self, reveal_secrets=False):
+        """Convert to a JSON-serializable dict, masking credentials unless asked not to"""
+        data = self._asdict()
+        data['segments'] = [list(segment) for segment in self.segments]
+        data['fallbacks'] = [list(fallback) for fallback in self.fallbacks]
+        if not reveal_secrets:
+            data['password'] = '***' if self.password else None
+            data['token'] = (self.token[:6] + '...') if self.token else None
+        return data
+
+
+class ReservationPlan:
+    """Immutable list of planned requests for one target date"""
+
+    def __init__(self, target_date, items, skipped=None, invalid=None):
+        """
+        Args:
+            target_date: Date the plan books for
+            items: PlannedReservation entries
+            skipped: Reservations deliberately left out, e.g. daily limit already reached
+            invalid: Reservations that cannot be planned, e.g. missing user or room
+        """
+        self.target_date = target_date
+        self.created_at = datetime.utcnow()
+        self.items = tuple(items)
+        self.skipped = tuple(skipped or ())
+        self.invalid = tuple(invalid or ())
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def by_source(self, source_type):
+        """Get the planned items of one source type"""
+        return [item for item in self.items if item.source_type == source_type]
+
+    def to_dict(self, reveal_secrets=False):
+        return {
+            'target_date': self.target_date.isoformat(),
+            'created_at': self.created_at.isoformat(),
+            'total': len(self.items),
+            'recurring': len(self.by_source('recurring')),
+            'one_time': len(self.by_source('one_time')),
+            'items': [item.to_dict(reveal_secrets) for item in self.items],
+            'skipped': list(self.skipped),
+            'invalid': list(self.invalid)
+        }
+
+    def dump(self, reveal_secrets=False):
+        """Render the plan as pretty-printed JSON for inspection"""
+        return json.dumps(self.to_dict(reveal_secrets), ensure_ascii=False, indent=2)
+
+
+# The plan built by the pre-login job, consumed by the reservation job
+_current_plan = None
+_plan_lock = threading.Lock()
+
+
+def set_current_plan(plan):
+    global _current_plan
+    with _plan_lock:
+        _current_plan = plan
+
+
+def get_current_plan(target_date=None):
+    """Get the stored plan, optionally only if it was built for `target_date`"""
+    with _plan_lock:
+        plan = _current_plan
+    if plan is not None and target_date is not None and plan.target_date != target_date:
+        return None
+    return plan
+
+
+class ReservationPlanner:
+    @staticmethod
+    def resolve_fallbacks(reservation, rooms, partition_rooms, contention, limit):
+        """
+        Ordered fallback rooms of a reservation
+
+        The explicitly chosen rooms come first, then the piano rooms of the
+        fallback partition, least contested first at the reservation's start time.
+
+        Args:
+            reservation: RecurringReservation or OneTimeReservation
+            rooms: room_id -> Room, containing the explicitly chosen rooms
+            partition_rooms: partition -> piano rooms of that partition
+            contention: ContentionIndex used to order the partition's rooms
+            limit: Maximum number of fallbacks
+
+        Returns:
+            tuple: (room_id, ccom_id, name) triples, without the reservation's own room
+        """
+        candidates = [rooms[room_id] for room_id in (reservation.fallback_room_ids or ()) if room_id in rooms]
+        if reservation.fallback_partition:
+            candidates += sorted(partition_rooms.get(reservation.fallback_partition, ()),
+                                 key=lambda room: contention.score(room.id, reservation.start_time))
+
+        fallbacks = []
+        seen = {reservation.room_id}
+        for room in candidates:
+            if room.id not in seen:
+                seen.add(room.id)
+                fallbacks.append((room.id, room.ccom_id, room.name))
+        return tuple(fallbacks[:limit])
+
+    @staticmethod
+    def build_plan(target_date=None, verified_user_ids=None):
+        """
+        Query all pending work for the target date and materialize it as a plan
+
+        Args:
+            target_date: Target date (default: tomorrow)
+            verified_user_ids: IDs of users whose token was validated during pre-login
+
+        Returns:
+            ReservationPlan: The plan, ready to be dispatched without further SQL or crypto
+        """
+        from app.services.reservation_service import ReservationService
+
+        if target_date is None:
+            target_date = date.today() + timedelta(days=1)
+        verified_user_ids = set(verified_user_ids or ())
+
+        recurring_reservations = RecurringReservation.query.filter_by(
+            day_of_week=get_day_of_week(target_date),
+            is_active=True
+        ).all()
+
+        one_time_reservations = OneTimeReservation.query.filter_by(
+            reservation_date=target_date,
+            status='pending'
+        ).all()
+
+        all_reservations = recurring_reservations + one_time_reservations
+        user_ids = {r.user_id for r in all_reservations}
+        room_ids = {r.room_id for r in all_reservations}
+        room_ids |= {room_id for r in all_reservations for room_id in (r.fallback_room_ids or ())}
+        partitions = {r.fallback_partition for r in all_reservations if r.fallback_partition}
+
+        users = {u.id: u for u in User.query.filter(User.id.in_(user_ids)).all()} if user_ids else {}
+        rooms = {r.id: r for r in Room.query.filter(Room.id.in_(room_ids)).all()} if room_ids else {}
+
+        # Piano rooms of every fallback partition, in one query
+        partition_rooms = {}
+        if partitions:
+            for room in Room.query.filter(Room.partition.in_(partitions)).order_by(Room.id).all():
+                if "无钢琴" not in (room.instruments or ""):
+                    partition_rooms.setdefault(room.partition, []).append(room)
+        max_fallbacks = current_app.config.get('FALLBACK_MAX_CANDIDATES', 5)
+
+        contention = ContentionIndex.load()
+
+        # Decrypt each user's password exactly once
+        passwords = {}
+        for user in users.values():
+            try:
+                passwords[user.id] = user.get_ccom_password()
+            except Exception as e:
+                current_app.logger.error(f"Could not decrypt CCOM password for user {user.username}: {str(e)}")
+                passwords[user.id] = None
+
+        # Successful reservations every user with a recurring reservation already holds that day
+        daily_counts = ReservationService.count_daily_reservations(
+            list({reservation.user_id for reservation in recurring_reservations}), target_date)
+
+        items = []
+        skipped = []
+        invalid = []
+
+        for source_type, reservations in (('recurring', recurring_reservations),
+                                          ('one_time', one_time_reservations)):
+            for reservation in reservations:
+                user = users.get(reservation.user_id)
+                room = rooms.get(reservation.room_id)
+
+                if not user:
+                    invalid.append({'source_type': source_type, 'source_id': reservation.id,
+                                    'reason': f"User not found: {reservation.user_id}"})
+                    continue
+                if not room:
+                    invalid.append({'source_type': source_type, 'source_id': reservation.id,
+                                    'reason': f"Room not found: {reservation.room_id}"})
+                    continue
+
+                # Recurring reservations are skipped once the user already holds the daily maximum
+                if source_type == 'recurring':
+                    if daily_counts.get(user.id, 0) >= current_app.config['MAX_DAILY_RESERVATIONS']:
+                        skipped.append({'source_type': source_type, 'source_id': reservation.id,
+                                        'reason': f"Daily limit reached for {user.username}"})
+                        continue
+
+                is_cancellation = bool(getattr(reservation, 'is_cancellation', False))
+                segments = () if is_cancellation else tuple(ReservationService.split_reservation_time(
+                    target_date, reservation.start_time, reservation.end_time))
+
+                items.append(PlannedReservation(
+                    source_type=source_type,
+                    source_id=reservation.id,
+                    user_id=user.id,
+                    username=user.username,
+                    password=passwords.get(user.id),
+                    token=user.ccom_token,
+                    token_verified=user.id in verified_user_ids,
+                    room_id=room.id,
+                    room_ccom_id=room.ccom_id,
+                    room_name=room.name,
+                    start_time=reservation.start_time,
+                    end_time=reservation.end_time,
+                    segments=segments,
+                    is_cancellation=is_cancellation,
+                    contention=0.0 if is_cancellation else contention.score(room.id, reservation.start_time),
+                    fanout=1 if is_cancellation else contention.fanout(room.id, reservation.start_time),
+                    fallbacks=() if is_cancellation else ReservationPlanner.resolve_fallbacks(
+                        reservation, rooms, partition_rooms, contention, max_fallbacks),
+                    contiguous=bool(reservation.contiguous) and not is_cancellation
+                ))
+
+        plan = ReservationPlan(target_date, items, skipped, invalid)
+        current_app.logger.info(
+            f"Built reservation plan for {target_date}: {len(plan)} requests, "
+            f"{len(plan.skipped)} skipped, {len(plan.invalid)} invalid")
+        return plan
@@ -0,0 +1,150 @@
+"""
+@Author: Tianyi Zhang
+@Date: 2025/4/26
+@Description: Speculative racing of one reservation request over several warm connections
+"""
+from app.services.response_classifier import classify, response_message, SUCCESS, RETRY, RETRY_AT_OPEN
+from app.services.run_trace import traced_request, note_response
+import asyncio
+import time
+
+
+class ReservationRace:
+    """
+    Send copies of the same placeAnOrder over several connections, staggered
+    by a few milliseconds around an anchor instant (usually the fire instant)
+
+    The first copy answered with "成功" or "已选择" wins. The other copies
+    can only be answered "重复请求" or "已选择" once a copy has won, so their
+    answers are harmless. Copies sent a moment before the window opens may be
+    answered "琴房暂未开放", which is harmless as long as a later copy gets through.
+    """
+
+    def __init__(self, connections, stagger_ms):
+        """
+        Args:
+            connections: Number of copies sent, one per warm connection
+            stagger_ms: Gap between consecutive copies in milliseconds
+        """
+        self.connections = max(1, connections)
+        self.stagger_ms = max(0.0, stagger_ms)
+
+    def offsets_ms(self):
+        """Send offsets of the copies relative to the anchor, centred on it"""
+        middle = (self.connections - 1) / 2
+        return [(lane - middle) * self.stagger_ms for lane in range(self.connections)]
+
+    @staticmethod
+    def is_win(response):
+        return classify(response).action == SUCCESS
+
+    @staticmethod
+    def is_benign(response):
+        """Whether a losing copy's answer leaves the outcome open, e.g. a duplicate or a transport error"""
+        return classify(response).action in (RETRY, RETRY_AT_OPEN)
+
+    async def run(self, client, room_ccom_id, start_timestamp, end_timestamp, anchor=None, journal=None, item=None):
+        """
+        Race one segment
+
+        Args:
+            client: Logged-in AsyncCCOMClient
+            room_ccom_id: Room CCOM ID
+            start_timestamp: Start time (millisecond timestamp)
+            end_timestamp: End time (millisecond timestamp)
+            anchor: time.perf_counter() value the offsets are relative to; None sends the first copy now
+            journal: Optional RunJournal recording each send and response
+            item: PlannedReservation the segment belongs to, required with `journal`
+
+        Returns:
+            dict: `won`, `decided` (False if only benign answers came back and the
+                caller should fall back to normal retries), `message`, `winner` lane
+                and per-lane timing in `lanes`
+        """
+        offsets = self.offsets_ms()
+        if anchor is None:
+            anchor = time.perf_counter() - offsets[0] / 1000
+        won = asyncio.Event()
+
+        async def lane(index, offset_ms):
+            delay = anchor + offset_ms / 1000 - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if won.is_set():
+                # Somebody already won; the copy would only earn a "重复请求"
+                return {'lane': index, 'offset_ms': round(offset_ms, 1), 'skipped': True}
+
+            if journal:
+                journal.record_send(item, start_timestamp, end_timestamp, index)
+            sent = time.perf_counter()
+            with traced_request(item, 'reserve', start_timestamp, lane=index) as record:
+                try:
+                    response = await client.reserve_room(room_ccom_id, start_timestamp, end_timestamp)
+                except Exception as e:
+                    response = e
+            answered = time.perf_counter()
+            if journal:
+                journal.record_response(item, response, start_timestamp)
+            note_response(record, response, classify(response))
+
+            if self.is_win(response):
+                won.set()
+            return {
+                'lane': index,
+                'offset_ms': round(offset_ms, 1),
+                'sent_ms': round((sent - anchor) * 1000, 2),  # Actual send time relative to the anchor
+                'elapsed_ms': round((answered - sent) * 1000, 2),
+                'answered_ms': round((answered - anchor) * 1000, 2),
+                'status': None if isinstance(response, Exception) else response.get('status'),
+                'msg': response_message(response),
+                'won': self.is_win(response),
+                'response': response
+            }
+
+        lanes = await asyncio.gather(*(lane(index, offset) for index, offset in enumerate(offsets)))
+
+        answered = sorted((entry for entry in lanes if not entry.get('skipped')), key=lambda entry: entry['answered_ms'])
+        winners = [entry for entry in answered if entry['won']]
+        losers = [entry for entry in answered if not self.is_benign(entry['response'])]
+        for entry in lanes:
+            entry.pop('response', None)
+
+        if winners:
+            return {'won': True, 'decided': True, 'message': None, 'winner': winners[0]['lane'], 'lanes': lanes}
+        if losers:
+            # A definitive rejection such as the slot being taken
+            return {'won': False, 'decided': True, 'message': losers[-1]['msg'], 'winner': None, 'lanes': lanes}
+        return {'won': False, 'decided': False, 'message': answered[-1]['msg'] if answered else None,
+                'winner': None, 'lanes': lanes}
+
+    @staticmethod
+    def summarize(races, stagger_ms):
+        """
+        Aggregate the timing of a run's races for tuning the number of copies and the stagger
+
+        Args:
+            races: Race records from the outcomes
+            stagger_ms: Stagger used in the run
+
+        Returns:
+            dict: Win count per lane, mean response time per lane and the races themselves
+        """
+        wins_by_lane = {}
+        elapsed_by_lane = {}
+        for race in races:
+            if race['winner'] is not None:
+                wins_by_lane[race['winner']] = wins_by_lane.get(race['winner'], 0) + 1
+            for entry in race['lanes']:
+                if not entry.get('skipped'):
+                    elapsed_by_lane.setdefault(entry['lane'], []).append(entry['elapsed_ms'])
+
+        return {
+            'stagger_ms': stagger_ms,
+            'races': len(races),
+            'won': sum(1 for race in races if race['won']),
+            'wins_by_lane': dict(sorted(wins_by_lane.items())),
+            'mean_elapsed_ms_by_lane': {
+                lane: round(sum(values) / len(values), 2) for lane, values in sorted(elapsed_by_lane.items())
+            },
+            'details': races
+        }
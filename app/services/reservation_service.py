@@ -8,12 +8,29 @@ from flask import current_app
 from sqlalchemy.orm import scoped_session
 from app import db
 from app.models.user import User
-from app.models.room import Room
-from app.models.reservation import RecurringReservation, OneTimeReservation, ReservationHistory
+from app.models.reservation import RecurringReservation, OneTimeReservation, ReservationHistory, ReservationRun
 from app.services.ccom_client import CCOMClient
-from app.utils.time_utils import get_current_time, get_day_of_week, ServerTimeHelper, convert_to_timestamp
-from app.utils.exceptions import ReservationLimitExceeded, DurationLimitExceeded
-import pytz
+from app.services.async_ccom_client import AsyncCCOMClient, CCOMConnectionPool
+from app.services.token_cache import token_cache
+from app.services.reservation_plan import ReservationPlanner, get_current_plan, set_current_plan
+from app.services.dispatch_scheduler import DispatchScheduler
+from app.services.contention_index import ContentionIndex
+from app.services.run_journal import RunJournal
+from app.services.reservation_race import ReservationRace
+from app.services.order_index import OrderIndex, set_prefetched_orders, take_prefetched_orders
+from app.services.run_trace import RunTrace, traced_request, note_response, build_timeline
+from app.services.response_classifier import classify, response_message, RESERVATION_RULES, CANCELLATION_RULES, \
+    SUCCESS, TERMINAL, RETRY_AT_OPEN, SWITCH_ROOM, NOT_OPEN_GRACE_SECONDS
+from app.services.user_stats import UserStatsService
+from app.services.system_summary import SystemSummary
+from app.services.availability_cache import availability_cache
+from app.utils.time_utils import get_day_of_week, parse_hhmm
+from app.utils.exceptions import ReservationLimitExceeded, DurationLimitExceeded, ReservationConflict
+from app.utils.slot_bitmap import time_mask, mask_to_ranges, covers
+from app.services.room_scanner import get_current_snapshot
+from sqlalchemy import func
+import asyncio
+import os
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import concurrent.futures
 import threading
@@ -53,6 +70,22 @@ class ReservationService:
             status='successful'
         ).all()
 
+    @staticmethod
+    def count_daily_reservations(user_ids, target_date):
+        """
+        Count the successful reservations of several users on one date with a single grouped query
+
+        Returns:
+            dict: user_id -> number of successful reservations (users without any are left out)
+        """
+        if not user_ids:
+            return {}
+        return dict(db.session.query(ReservationHistory.user_id, func.count(ReservationHistory.id)).filter(
+            ReservationHistory.user_id.in_(user_ids),
+            ReservationHistory.reservation_date == target_date,
+            ReservationHistory.status == 'successful'
+        ).group_by(ReservationHistory.user_id).all())
+
     @staticmethod
     def check_reservation_limits(user_id, target_date, start_time, end_time):
         """
@@ -81,8 +114,50 @@ class ReservationService:
             raise ReservationLimitExceeded(
                 f"You already have {len(existing_reservations)} reservations on {target_date}")
 
+        # Check the new range does not overlap the user's other reservations that day
+        occupied = ReservationService.get_user_occupied_mask(user_id, target_date, existing_reservations)
+        conflicts = time_mask(start_time, end_time, cover=True) & occupied
+        if conflicts:
+            ranges = ', '.join(f"{start}-{end}" for start, end in mask_to_ranges(conflicts))
+            raise ReservationConflict(f"Reservation overlaps your other reservations on {target_date} at {ranges}")
+
         return True
 
+    @staticmethod
+    def get_user_occupied_mask(user_id, target_date, successful=None):
+        """
+        Slots of `target_date` already taken by the user
+
+        Combines successful reservations, pending one-time reservations and
+        active recurring reservations for that weekday, minus the slots of
+        pending one-time cancellations.
+
+        Args:
+            user_id: User ID
+            target_date: Target date
+            successful: The user's successful history entries for the date, if already loaded
+
+        Returns:
+            int: Slot mask (see app.utils.slot_bitmap)
+        """
+        if successful is None:
+            successful = ReservationService.get_user_daily_reservations(user_id, target_date)
+
+        one_time = OneTimeReservation.query.filter_by(
+            user_id=user_id, reservation_date=target_date, status='pending').all()
+        recurring = RecurringReservation.query.filter_by(
+            user_id=user_id, day_of_week=get_day_of_week(target_date), is_active=True).all()
+
+        occupied = cancelled = 0
+        for reservation in [*successful, *recurring, *one_time]:
+            mask = time_mask(reservation.start_time, reservation.end_time, cover=True)
+            if getattr(reservation, 'is_cancellation', False):
+                cancelled |= mask
+            else:
+                occupied |= mask
+
+        return occupied & ~cancelled
+
     @staticmethod
     def split_reservation_time(target_date, start_time, end_time, max_hours=3):
         """
@@ -98,19 +173,9 @@ class ReservationService:
             list: List of (start_timestamp, end_timestamp) tuples
         """
         # Convert time strings to datetime objects
-        start_hour, start_minute = int(start_time[:2]), int(start_time[2:])
-        end_hour, end_minute = int(end_time[:2]), int(end_time[2:])
-
-        # Create datetime objects
-        start_datetime = datetime.combine(
-            target_date,
-            datetime.strptime(f"{start_hour:02d}:{start_minute:02d}", "%H:%M").time()
-        )
-
-        end_datetime = datetime.combine(
-            target_date,
-            datetime.strptime(f"{end_hour:02d}:{end_minute:02d}", "%H:%M").time()
-        )
+        midnight = datetime.combine(target_date, datetime.min.time())
+        start_datetime = midnight + timedelta(minutes=parse_hhmm(start_time))
+        end_datetime = midnight + timedelta(minutes=parse_hhmm(end_time))
 
         # Handle case where end time is on the next day
         if end_datetime <= start_datetime:
@@ -136,542 +201,737 @@ class ReservationService:
         return segments
 
     @staticmethod
-    def attempt_reservation(client, room_ccom_id, start_timestamp, end_timestamp, max_attempts=5, retry_delay=0.5):
+    async def attempt_reservation(client, room_ccom_id, start_timestamp, end_timestamp, max_attempts=5, retry_delay=None,
+                                  journal=None, item=None, fail_fast=False, open_at=None):
         """
-        Attempt to make a reservation, correctly handling all response types
+        Attempt to make a reservation, acting on each response as RESERVATION_RULES classifies it
 
         Args:
-            client: CCOMClient instance
+            client: AsyncCCOMClient instance
             room_ccom_id: Room CCOM ID
             start_timestamp: Start time (millisecond timestamp)
             end_timestamp: End time (millisecond timestamp)
             max_attempts: Maximum number of attempts
-            retry_delay: Delay between attempts in seconds
+            retry_delay: Base delay between attempts in seconds, overriding the per-class delays
+            journal: Optional RunJournal recording each send and response
+            item: PlannedReservation the segment belongs to, required with `journal`
+            fail_fast: Return as soon as the room is found taken instead of retrying, e.g. when
+                another room can be tried
+            open_at: time.perf_counter() instant the window opens at; "not open yet" answers are
+                retried exactly then instead of failing
 
         Returns:
             tuple: (success, error_message)
         """
-        for attempt in range(max_attempts):
-            try:
-                response = client.reserve_room(room_ccom_id, start_timestamp, end_timestamp)
-
-                # Check response message
-                msg = response.get('msg', '')
-                status = response.get('status', 0)
-
-                # IMPORTANT: Only consider it a success if status is 200 AND msg is "成功"
-                if status == 200 and msg == '成功':
-                    current_app.logger.info(f"Reservation successful on attempt {attempt + 1}")
-                    return True, None
+        logger = client.logger
+        retries = {}  # Rule name -> retries so far, for per-class backoff
+        rule = msg = None
 
-                # Handle specific failure cases
+        for attempt in range(max_attempts):
+            if journal:
+                journal.record_send(item, start_timestamp, end_timestamp, attempt)
+            with traced_request(item, 'reserve', start_timestamp, attempt) as record:
+                try:
+                    response = await client.reserve_room(room_ccom_id, start_timestamp, end_timestamp)
+                except Exception as e:
+                    response = e
+            if journal:
+                journal.record_response(item, response, start_timestamp)
+
+            rule = classify(response)
+            msg = response_message(response)
+            note_response(record, response, rule)
+
+            if rule.action == SUCCESS:
+                logger.info(f"Reservation successful on attempt {attempt + 1} ({rule.name})")
+                return True, None
+            if rule.action == TERMINAL:
+                logger.warning(f"Reservation failed ({rule.name}): {msg}")
+                return False, msg
+            if rule.action == SWITCH_ROOM and fail_fast:
+                return False, msg
 
-                # "琴房暂未开放" means the piano room is not open yet - this is a failure
-                if '琴房暂未开放' in msg:
-                    current_app.logger.warning(f"Piano room not open yet on attempt {attempt + 1}")
-                    # This is a definite failure, not a retry condition
+            if rule.action == RETRY_AT_OPEN:
+                now = time.perf_counter()
+                if open_at is None or now > open_at + NOT_OPEN_GRACE_SECONDS:
+                    # Not a matter of timing: the room really is not open
+                    logger.warning(f"Piano room not open on attempt {attempt + 1}")
                     return False, msg
+                delay = open_at - now if open_at > now else rule.retry_delay(retries.get(rule.name, 0), retry_delay)
+            else:
+                delay = rule.retry_delay(retries.get(rule.name, 0), retry_delay)
 
-                # Already chosen is considered a success
-                if '已选择' in msg:
-                    current_app.logger.info(f"Room already reserved successfully")
-                    return True, None
+            if attempt < max_attempts - 1:
+                retries[rule.name] = retries.get(rule.name, 0) + 1
+                logger.info(f"Retrying reservation in {delay * 1000:.0f}ms "
+                            f"(attempt {attempt + 1}/{max_attempts}, {rule.name}): {msg}")
+                await asyncio.sleep(delay)
 
-                # Exceeded order limit is a definite failure
-                if '超出预约订单数量限制' in msg:
-                    current_app.logger.warning(f"Reservation failed: Exceeded limit")
-                    return False, msg
+        if rule is not None and rule.name == 'duplicate':
+            # If all attempts result in duplicate requests, it may be already successful
+            # or there's a system issue - mark as failure to be safe
+            return False, "Maximum duplicate requests"
+        return False, msg or "Maximum attempts reached"
 
-                # For duplicate request errors, continue trying
-                if '重复请求' in msg:
-                    if attempt < max_attempts - 1:
-                        current_app.logger.info(
-                            f"Retrying after duplicate request (attempt {attempt + 1}/{max_attempts})")
-                        time.sleep(retry_delay)
-                        continue
-                    else:
-                        # If all attempts result in duplicate requests, it may be already successful
-                        # or there's a system issue - mark as failure to be safe
-                        return False, "Maximum duplicate requests"
-
-                # For other failures, retry if not the last attempt
-                if attempt < max_attempts - 1:
-                    current_app.logger.info(f"Retrying reservation (attempt {attempt + 1}/{max_attempts}): {msg}")
-                    time.sleep(retry_delay)
-                    continue
-
-                # All attempts failed with non-specific errors
-                return False, msg
+    @staticmethod
+    async def attempt_cancellation(client, room_ccom_id, target_date, max_attempts=3, retry_delay=None,
+                                   journal=None, item=None, orders=None, start_time=None):
+        """
+        Find the user's order for a room on the target date and cancel it
 
-            except Exception as e:
-                if attempt < max_attempts - 1:
-                    current_app.logger.info(
-                        f"Exception during reservation (attempt {attempt + 1}/{max_attempts}): {str(e)}")
-                    time.sleep(retry_delay)
-                    continue
-                return False, str(e)
+        Args:
+            client: AsyncCCOMClient instance
+            room_ccom_id: Room CCOM ID
+            target_date: Date of the order to cancel
+            max_attempts: Maximum number of cancel attempts
+            retry_delay: Base delay between attempts in seconds, overriding the per-class delays
+            journal: Optional RunJournal recording each send and response
+            item: PlannedReservation being cancelled, required with `journal`
+            orders: Optional OrderIndex of the user's orders, fetched once per run
+            start_time: Start time string of the reservation, to tell apart several orders of one day
+
+        Returns:
+            tuple: (success, error_message)
+        """
+        order = await ReservationService.find_order(client, room_ccom_id, target_date, start_time, orders)
+        if order is None:
+            return False, 'No matching reservation found to cancel'
 
-        return False, "Maximum attempts reached"
+        return await ReservationService.cancel_order(client, order['id'], max_attempts, retry_delay, journal, item)
 
     @staticmethod
-    def process_single_recurring_reservation(reservation, target_date, results_dict, lock):
+    async def find_order(client, room_ccom_id, target_date, start_time=None, orders=None):
         """
-        Process a single recurring reservation with improved debugging and direct notifications
+        Take the user's order for a room on the target date out of `orders`
 
-        Args:
-            reservation: RecurringReservation instance
-            target_date: Target date for reservation
-            results_dict: Shared dictionary to accumulate results
-            lock: Threading lock for safe update of results_dict
+        Orders booked after `orders` was fetched are found by fetching the
+        order list once more.
 
         Returns:
-            None (updates results_dict in place)
+            dict: The order, or None if there is none or the order list cannot be fetched
         """
-        session = None
-        history_id = None  # Track created history ID for debugging
+        if orders is not None:
+            order = orders.take(room_ccom_id, target_date, start_time)
+            if order is not None:
+                return order
 
         try:
-            # Get thread-local session
-            session = ReservationService.get_db_session()
+            fresh = await OrderIndex.fetch(client)
+        except Exception as e:
+            client.logger.error(f"Cannot fetch the order list of {client.username}: {str(e)}")
+            return None
+        return fresh.take(room_ccom_id, target_date, start_time)
 
-            # Skip if user already has MAX_DAILY_RESERVATIONS successful reservations
-            existing_reservations = ReservationService.get_user_daily_reservations(
-                reservation.user_id, target_date
-            )
-            if len(existing_reservations) >= current_app.config['MAX_DAILY_RESERVATIONS']:
-                with lock:
-                    results_dict['skipped'] += 1
-                return
+    @staticmethod
+    async def cancel_order(client, order_id, max_attempts=3, retry_delay=None, journal=None, item=None):
+        """
+        Cancel one CCOM order, acting on each response as CANCELLATION_RULES classifies it
 
-            # Process the reservation
-            user = session.query(User).get(reservation.user_id)
-            if not user:
-                with lock:
-                    results_dict['failed'] += 1
-                    results_dict['errors'].append(f"User not found: {reservation.user_id}")
-                return
+        Returns:
+            tuple: (success, error_message)
+        """
+        error_msg = "No attempts made"
+        retries = {}
+        for attempt in range(max_attempts):
+            if journal:
+                journal.record_send(item, attempt=attempt, order_id=order_id)
+            with traced_request(item, 'cancel', attempt=attempt) as record:
+                try:
+                    response = await client.cancel_reservation(order_id)
+                except Exception as e:
+                    response = e
+            if journal:
+                journal.record_response(item, response)
 
-            client = CCOMClient(user.username, user.get_ccom_password(), user.ccom_token)
+            rule = classify(response, CANCELLATION_RULES)
+            note_response(record, response, rule)
+            if rule.action == SUCCESS:
+                return True, None
 
-            # Ensure we're logged in
-            if not client.soft_login():
-                with lock:
-                    results_dict['failed'] += 1
-                    results_dict['errors'].append(f"Failed to login for user {user.username}")
-                return
+            error_msg = response_message(response) or 'Unknown error'
+            if rule.action == TERMINAL:
+                return False, error_msg
 
-            # Update user token
-            user.ccom_token = client.token
-            session.commit()
+            if attempt < max_attempts - 1:  # Not the last attempt
+                await asyncio.sleep(rule.retry_delay(retries.get(rule.name, 0), retry_delay))
+                retries[rule.name] = retries.get(rule.name, 0) + 1
 
-            # Get room
-            room = session.query(Room).get(reservation.room_id)
-            if not room:
-                with lock:
-                    results_dict['failed'] += 1
-                    results_dict['errors'].append(f"Room not found: {reservation.room_id}")
-                return
-
-            # Split reservation into segments (max 3 hours each)
-            time_segments = ReservationService.split_reservation_time(
-                target_date,
-                reservation.start_time,
-                reservation.end_time
-            )
+        return False, error_msg
 
-            # Process all segments with improved error handling
-            all_segments_succeeded = True
-            all_errors = []
+    @staticmethod
+    async def dispatch_planned_reservation(item, client, target_date, dispatch=None, journal=None,
+                                           race_stagger_ms=None, parallel_segments=False, slots=None, orders=None):
+        """
+        Send a single planned reservation or cancellation
 
-            for start_timestamp, end_timestamp in time_segments:
-                # Try to reserve this segment with multiple attempts
-                success, error_msg = ReservationService.attempt_reservation(
-                    client, room.ccom_id, start_timestamp, end_timestamp
-                )
+        Runs on the CCOM event loop and touches neither the database nor the
+        app context; the outcome is recorded afterwards by `record_outcomes`.
 
-                if not success:
-                    all_segments_succeeded = False
-                    # Only add non-None, non-empty error messages
-                    if error_msg:
-                        all_errors.append(error_msg)
+        Args:
+            item: PlannedReservation from the reservation plan
+            client: Logged-in AsyncCCOMClient for the item's user
+            target_date: Target date for reservation
+            dispatch: Optional DispatchEngine to wait on before sending
+            journal: Optional RunJournal recording each send and response
+            race_stagger_ms: Race hot items (fan-out above 1) over that many connections with
+                this gap between the copies; None disables racing
+            parallel_segments: Send all segments of a long reservation at once
+            slots: Optional asyncio.Semaphore bounding the user's segments in flight
+            orders: Optional OrderIndex of the user's orders for cancellations
 
-            # Record results
-            with lock:
-                results_dict['processed'] += 1
+        Returns:
+            dict: Outcome with the item, status and message
+        """
+        race = None
+        if race_stagger_ms is not None and item.fanout > 1 and not item.is_cancellation:
+            race = ReservationRace(item.fanout, race_stagger_ms)
+
+        # The order to cancel is looked up before the window, so only the cancel request is sent at the open
+        order = None
+        if item.is_cancellation:
+            order = await ReservationService.find_order(
+                client, item.room_ccom_id, target_date, item.start_time, orders
+            )
 
-                if all_segments_succeeded:
-                    results_dict['successful'] += 1
-                    status = 'successful'
-                    message = 'Reservation successful'
-                else:
-                    results_dict['failed'] += 1
-                    status = 'failed'
-                    message = '; '.join(all_errors) if all_errors else "Unknown error"
-
-            # Always create a new history entry for better tracking and to ensure we have a record
-            # First, create the new history entry
-            new_history = ReservationHistory(
-                user_id=reservation.user_id,
-                room_id=reservation.room_id,
-                reservation_date=target_date,
-                start_time=reservation.start_time,
-                end_time=reservation.end_time,
-                status=status,
-                message=message,
-                source_type='recurring',
-                source_id=reservation.id,
-                created_at=datetime.utcnow()  # Explicitly set creation time
+        # Everything is prepared - hold until the window opens
+        anchor = None
+        open_at = dispatch.fire_deadline if dispatch else None
+        if dispatch:
+            if race is not None and dispatch.fire_deadline is not None:
+                # The racing copies time themselves around the fire instant, the earliest slightly ahead of it
+                anchor = dispatch.fire_deadline
+            else:
+                await dispatch.wait_async()
+
+        requested_room = item.room_name
+        taken_rooms = []
+        races = []
+        if item.is_cancellation:
+            if order is None:
+                success, error_msg = False, 'No matching reservation found to cancel'
+            else:
+                success, error_msg = await ReservationService.cancel_order(
+                    client, order['id'], journal=journal, item=item
+                )
+            all_errors = [error_msg] if error_msg else []
+        else:
+            # The outcome is recorded against the room finally used
+            success, all_errors, item, taken_rooms = await ReservationService.reserve_with_fallbacks(
+                client, item, target_date, journal, race, anchor, races, open_at, parallel_segments, slots
             )
 
-            # Add to session and commit immediately
-            session.add(new_history)
+        # How long after the release the final answer came back, for the contention index
+        responded_ms = None
+        if dispatch and dispatch.released_at is not None:
+            responded_ms = (time.perf_counter() - dispatch.released_at) * 1000
+
+        if success:
+            status = 'successful'
+            message = 'Successfully cancelled' if item.is_cancellation else 'Reservation successful'
+            if item.room_name != requested_room:
+                message += f" in fallback room {item.room_name} ({requested_room} was taken)"
+        else:
+            status = 'failed'
+            message = '; '.join(all_errors) if all_errors else "Unknown error"
+
+        outcome = {'item': item, 'status': status, 'message': message, 'processed': True,
+                   'token': client.token, 'responded_ms': responded_ms}
+        if taken_rooms:
+            outcome['taken_rooms'] = taken_rooms
+        if races:
+            outcome['races'] = races
+        return outcome
 
-            try:
-                session.flush()  # Flush to get the ID before commit
-                history_id = new_history.id
-                session.commit()
-                current_app.logger.info(f"Successfully created new history entry: ID={history_id}")
-            except Exception as commit_error:
-                session.rollback()
-                current_app.logger.error(f"Error creating history: {str(commit_error)}")
-                # Try one more time with a new session
-                try:
-                    session.close()
-                    session = ReservationService.get_db_session()
-
-                    # Create a new history entry with a fresh session
-                    history = ReservationHistory(
-                        user_id=reservation.user_id,
-                        room_id=reservation.room_id,
-                        reservation_date=target_date,
-                        start_time=reservation.start_time,
-                        end_time=reservation.end_time,
-                        status=status,
-                        message=message,
-                        source_type='recurring',
-                        source_id=reservation.id,
-                        created_at=datetime.utcnow()
-                    )
-                    session.add(history)
-                    session.flush()
-                    history_id = history.id
-                    session.commit()
-                    current_app.logger.info(f"Successfully saved history on second attempt: ID={history_id}")
-                except Exception as retry_error:
-                    current_app.logger.error(f"Final error saving history: {str(retry_error)}")
-                    with lock:
-                        results_dict['errors'].append(f"Could not save history: {str(retry_error)}")
+    @staticmethod
+    def fallback_candidates(item, target_date):
+        """
+        Fallback rooms of `item` worth trying, as PlannedReservations for those rooms
 
-            # Log the creation of history entry for debugging
-            current_app.logger.info(f"Created/updated history entry: ID={history_id}, "
-                                    f"User={reservation.user_id}, Room={reservation.room_id}, "
-                                    f"Date={target_date}, Status={status}")
+        Rooms the latest availability snapshot shows occupied during the
+        reservation are left out; rooms shown free come before rooms the
+        snapshot knows nothing about. A snapshot older than its TTL is ignored.
+        """
+        snapshot = get_current_snapshot()
+        if snapshot and not snapshot.is_fresh():
+            snapshot = None
+        need = time_mask(item.start_time, item.end_time, cover=True)
+        day = target_date.isoformat()
+
+        free, unknown = [], []
+        for room_id, ccom_id, name in item.fallbacks:
+            mask = snapshot.rooms.get(ccom_id, {}).get(day) if snapshot else None
+            if mask is None:
+                unknown.append((room_id, ccom_id, name))
+            elif covers(mask, need):
+                free.append((room_id, ccom_id, name))
+
+        return [item._replace(room_id=room_id, room_ccom_id=ccom_id, room_name=name, fallbacks=())
+                for room_id, ccom_id, name in free + unknown]
 
-            # Send notification directly after processing the reservation
-            try:
-                # Check if notifications are enabled in the configuration
-                if current_app.config.get('NOTIFICATION_ENABLED', False):
-                    current_app.logger.info(f"Sending direct notification for history ID {history_id}")
-
-                    if status == 'successful':
-                        NotificationService.send_reservation_success(
-                            user_id=reservation.user_id,
-                            room_name=room.name,
-                            date=target_date.strftime('%Y-%m-%d'),
-                            start_time=reservation.start_time,
-                            end_time=reservation.end_time
-                        )
-                    else:
-                        NotificationService.send_reservation_failure(
-                            user_id=reservation.user_id,
-                            room_name=room.name,
-                            date=target_date.strftime('%Y-%m-%d'),
-                            start_time=reservation.start_time,
-                            end_time=reservation.end_time,
-                            reason=message
-                        )
-            except Exception as notification_error:
-                current_app.logger.error(
-                    f"Error sending notification for history {history_id}: {str(notification_error)}")
-                # Don't let notification failure affect the reservation result
-                pass
+    @staticmethod
+    async def reserve_segment(client, item, start_timestamp, end_timestamp, journal=None, fail_fast=False,
+                              race=None, anchor=None, races=None, open_at=None):
+        """
+        Reserve one segment, racing it over several connections first when `race` is given
 
-            # Include created history information in results
-            with lock:
-                if 'created_histories' not in results_dict:
-                    results_dict['created_histories'] = []
-                results_dict['created_histories'].append(history_id)
+        A race that only gets benign answers (e.g. sent a moment too early) falls
+        back to the normal retries.
 
-        except Exception as e:
-            with lock:
-                results_dict['failed'] += 1
-                results_dict['errors'].append(str(e))
-            current_app.logger.error(f"Error processing recurring reservation {reservation.id}: {str(e)}")
-        finally:
-            # Make sure to properly close the session
-            if session:
-                ReservationService.close_db_session()
+        Args:
+            race: Optional ReservationRace
+            anchor: time.perf_counter() instant the racing copies are timed around
+            races: List collecting the timing of each race
+            open_at: time.perf_counter() instant the window opens at, see `attempt_reservation`
 
-            return history_id
+        Returns:
+            tuple: (success, error_message)
+        """
+        if race is not None:
+            result = await race.run(client, item.room_ccom_id, start_timestamp, end_timestamp, anchor, journal, item)
+            if races is not None:
+                races.append({'room_name': item.room_name, 'start': start_timestamp, 'won': result['won'],
+                              'winner': result['winner'], 'lanes': result['lanes']})
+            if result['won']:
+                return True, None
+            if result['decided']:
+                return False, result['message']
+
+        # Try to reserve this segment with multiple attempts
+        return await ReservationService.attempt_reservation(
+            client, item.room_ccom_id, start_timestamp, end_timestamp, journal=journal, item=item,
+            fail_fast=fail_fast, open_at=open_at
+        )
 
     @staticmethod
-    def process_single_one_time_reservation(reservation, target_date, results_dict, lock):
+    async def reserve_segments(client, item, journal=None, fail_fast=False, race=None, anchor=None, races=None,
+                               open_at=None, parallel=False, slots=None):
         """
-        Process a single one-time reservation with guaranteed single history entry and direct notifications
+        Reserve every segment of `item` in its room
+
+        Sequentially, a segment is only sent once the previous one is settled.
+        With `parallel`, all segments go out at once, so the later segments of a
+        long reservation are not requested seconds after the first one.
+
+        Segments already booked are cancelled again when the room is given up
+        as taken, or when another segment of a contiguous reservation fails.
 
         Args:
-            reservation: OneTimeReservation instance
-            target_date: Target date for reservation
-            results_dict: Shared dictionary to accumulate results
-            lock: Threading lock for safe update of results_dict
+            fail_fast: Give up on the room as soon as a segment is rejected as taken (only
+                the first one when sending sequentially)
+            race: Optional ReservationRace used for every segment
+            anchor: Instant the racing copies of the first segment (of every segment with
+                `parallel`) are timed around
+            races: List collecting the timing of each race
+            open_at: Instant the window opens at, see `attempt_reservation`
+            parallel: Send all segments concurrently
+            slots: Optional asyncio.Semaphore bounding the user's segments in flight, since
+                CCOM limits how many orders a user may hold
 
         Returns:
-            None (updates results_dict in place)
+            tuple: (success, error messages, whether the room was given up as taken)
         """
-        session = None
-        history_id = None
+        async def send(index, segment_fail_fast, segment_anchor):
+            start_timestamp, end_timestamp = item.segments[index]
+            if slots is None:
+                result = await ReservationService.reserve_segment(
+                    client, item, start_timestamp, end_timestamp, journal, segment_fail_fast,
+                    race, segment_anchor, races, open_at)
+            else:
+                async with slots:
+                    result = await ReservationService.reserve_segment(
+                        client, item, start_timestamp, end_timestamp, journal, segment_fail_fast,
+                        race, segment_anchor, races, open_at)
+            success, error_msg = result
+            taken = not success and segment_fail_fast and ContentionIndex.is_room_rejection(error_msg)
+            return success, error_msg, taken
+
+        if parallel and len(item.segments) > 1:
+            results = await asyncio.gather(*(send(index, fail_fast, anchor) for index in range(len(item.segments))))
+        else:
+            results = []
+            for index in range(len(item.segments)):
+                results.append(await send(index, fail_fast and index == 0, anchor if index == 0 else None))
+                if results[-1][2]:
+                    break
+
+        booked = [item.segments[index] for index, (success, _, _) in enumerate(results) if success]
+        taken = [error_msg for _, error_msg, segment_taken in results if segment_taken]
+        # Only add non-None, non-empty error messages
+        errors = [error_msg for success, error_msg, _ in results if not success and error_msg]
+
+        if taken:
+            if booked:
+                await ReservationService.rollback_segments(client, item, booked)
+            return False, [taken[0] or "Unknown error"], True
+
+        success = len(booked) == len(item.segments)
+        if not success and booked and item.contiguous:
+            errors.append(await ReservationService.rollback_segments(client, item, booked))
+        return success, errors, False
+
+    @staticmethod
+    async def rollback_segments(client, item, segments):
+        """
+        Cancel the orders booked for `segments` of `item`
 
+        Returns:
+            str: Summary of the rollback for the outcome message
+        """
         try:
-            # Get thread-local session
-            session = ReservationService.get_db_session()
+            orders = await OrderIndex.fetch(client)
+        except Exception as e:
+            return f"Could not roll back {len(segments)} booked segment(s): {str(e)}"
+
+        order_ids = [order['id'] for order in (orders.take_at(item.room_ccom_id, start_timestamp)
+                                               for start_timestamp, _ in segments) if order is not None]
+        failures = []
+        for order_id in order_ids:
+            cancelled, error_msg = await ReservationService.cancel_order(client, order_id, item=item)
+            if not cancelled:
+                failures.append(error_msg)
+
+        if failures or len(order_ids) < len(segments):
+            client.logger.error(f"Rollback of {item.room_name} for {item.username} incomplete: {failures}")
+            return (f"Rolled back {len(order_ids) - len(failures)} of {len(segments)} booked segment(s)"
+                    + (f": {'; '.join(failures)}" if failures else ""))
+        client.logger.info(f"Rolled back {len(segments)} booked segment(s) of {item.room_name} for {item.username}")
+        return f"Rolled back {len(segments)} booked segment(s)"
 
-            user = session.query(User).get(reservation.user_id)
-            if not user:
-                reservation.status = 'failed'
-                session.commit()
-                with lock:
-                    results_dict['failed'] += 1
-                    results_dict['errors'].append(f"User not found: {reservation.user_id}")
-                return
+    @staticmethod
+    async def reserve_with_fallbacks(client, item, target_date, journal=None, race=None, anchor=None, races=None,
+                                     open_at=None, parallel=False, slots=None):
+        """
+        Reserve `item`, moving on to its next fallback room as soon as the
+        room is found taken (see `reserve_segments`)
 
-            client = CCOMClient(user.username, user.get_ccom_password(), user.ccom_token)
+        `race`, `anchor`, `races`, `open_at`, `parallel` and `slots` are passed on
+        to `reserve_segments`; only the requested room is raced around the anchor.
 
-            # Ensure we're logged in
-            if not client.soft_login():
-                reservation.status = 'failed'
-                session.commit()
+        Returns:
+            tuple: (success, error messages, item of the last room tried, ids of the rooms given up as taken)
+        """
+        candidates = [item] + (ReservationService.fallback_candidates(item, target_date) if item.fallbacks else [])
+        taken_rooms = []
+        taken_errors = []
+
+        for index, candidate in enumerate(candidates):
+            success, errors, taken = await ReservationService.reserve_segments(
+                client, candidate, journal, fail_fast=index < len(candidates) - 1,
+                race=race, anchor=anchor if index == 0 else None, races=races, open_at=open_at,
+                parallel=parallel, slots=slots
+            )
+            if not taken:
+                if not success:
+                    errors = taken_errors + errors
+                return success, errors, candidate, taken_rooms
 
-                with lock:
-                    results_dict['failed'] += 1
-                    results_dict['errors'].append(f"Failed to login for user {user.username}")
-                return
-
-            # Update user token
-            user.ccom_token = client.token
-            session.commit()
-
-            # Get room
-            room = session.query(Room).get(reservation.room_id)
-            if not room:
-                reservation.status = 'failed'
-                session.commit()
-                with lock:
-                    results_dict['failed'] += 1
-                    results_dict['errors'].append(f"Room not found: {reservation.room_id}")
-                return
-
-            # Process cancellation
-            if reservation.is_cancellation:
-                # First, get the user's current reservations
-                orders = client.get_order_list()
-                order_id = None
-
-                if orders.get('status') == 200:
-                    for order in orders.get('data', []):
-                        # Check if this order matches our reservation
-                        order_date = datetime.fromtimestamp(
-                            order['startTime'] / 1000,
-                            pytz.timezone('Asia/Shanghai')
-                        ).date()
-
-                        if (order_date == target_date and
-                                str(order['device']) == str(room.ccom_id)):
-                            order_id = order['id']
-                            break
-
-                if order_id:
-                    # Make multiple attempts to cancel
-                    success = False
-                    error_msg = "No attempts made"
-
-                    for attempt in range(3):  # Try up to 3 times
-                        response = client.cancel_reservation(order_id)
-
-                        if response.get('status') == 200 and response.get('msg') == '成功':
-                            success = True
-                            error_msg = None
-                            break
-
-                        if attempt < 2:  # Not the last attempt
-                            time.sleep(0.5)  # Wait before retry
-
-                        error_msg = response.get('msg', 'Unknown error')
-                else:
-                    success = False
-                    error_msg = 'No matching reservation found to cancel'
+            client.logger.info(f"{candidate.room_name} is taken, trying the next fallback room")
+            taken_rooms.append(candidate.room_id)
+            taken_errors.append(f"{candidate.room_name}: {errors[0]}")
 
-                # Record results
-                with lock:
-                    results_dict['processed'] += 1
-
-                    if success:
-                        reservation.status = 'successful'
-                        results_dict['successful'] += 1
-                        status = 'successful'
-                        message = 'Successfully cancelled'
-                    else:
-                        reservation.status = 'failed'
-                        results_dict['failed'] += 1
-                        status = 'failed'
-                        message = error_msg
+    @staticmethod
+    def record_outcomes(outcomes, target_date, results, journal=None):
+        """
+        Store the outcomes of a run in a single transaction: history entries,
+        one-time reservation statuses and renewed tokens, then notifications
 
-                session.commit()
+        Args:
+            outcomes: Outcomes from dispatch_planned_reservation
+            target_date: Target date for reservation
+            results: Results dictionaries keyed by source type
+            journal: Optional RunJournal holding the same outcomes, discarded once committed
 
+        Returns:
+            dict: Whether the outcomes were committed and how many notifications were queued
+        """
+        for outcome in outcomes:
+            results_dict = results[outcome['item'].source_type]
+            if outcome['processed']:
+                results_dict['processed'] += 1
+                results_dict['successful' if outcome['status'] == 'successful' else 'failed'] += 1
             else:
-                # Regular reservation - Split into segments (max 3 hours each)
-                time_segments = ReservationService.split_reservation_time(
-                    target_date,
-                    reservation.start_time,
-                    reservation.end_time
-                )
+                results_dict['failed'] += 1
+                results_dict['errors'].append(outcome['message'])
 
-                # Process all segments
-                all_segments_succeeded = True
-                all_errors = []
+        committed = False
+        histories = []
+        for attempt in range(2):
+            try:
+                histories = ReservationService.stage_outcomes(outcomes, target_date)
+                db.session.commit()
+                committed = True
+                break
+            except Exception as e:
+                db.session.rollback()
+                current_app.logger.error(f"Error storing run results (attempt {attempt + 1}): {str(e)}")
+
+        if not committed:
+            for results_dict in results.values():
+                results_dict['errors'].append("Could not save reservation history")
+            if journal:
+                journal.close()
+                current_app.logger.error(f"Run results kept in journal {journal.path} for recovery")
+            return {'committed': False, 'notifications_queued': 0}
+
+        if journal:
+            journal.commit()
+        SystemSummary.invalidate()
+        # The run just changed which slots are free
+        availability_cache.invalidate()
+
+        current_app.logger.info(f"Stored {len(histories)} history entries for {target_date}")
+        for outcome, history in zip(outcomes, histories):
+            results[outcome['item'].source_type].setdefault('created_histories', []).append(history.id)
+
+        # Queue notifications once everything is safely stored; delivery happens in the background
+        if current_app.config.get('NOTIFICATION_DIGEST', False):
+            queued = ReservationService.queue_digests(outcomes, target_date)
+        else:
+            queued = ReservationService.queue_notifications(outcomes, target_date)
+
+        return {'committed': True, 'notifications_queued': queued}
 
-                for start_timestamp, end_timestamp in time_segments:
-                    # Try to reserve this segment with multiple attempts
-                    success, error_msg = ReservationService.attempt_reservation(
-                        client, room.ccom_id, start_timestamp, end_timestamp
+    @staticmethod
+    def queue_notifications(outcomes, target_date):
+        """Queue one notification per outcome, returning how many were queued"""
+        queued = 0
+        for outcome in outcomes:
+            item = outcome['item']
+            try:
+                if outcome['status'] == 'successful':
+                    sent = NotificationService.send_reservation_success(
+                        user_id=item.user_id,
+                        room_name=item.room_name,
+                        date=target_date.strftime('%Y-%m-%d'),
+                        start_time=item.start_time,
+                        end_time=item.end_time,
+                        enqueue=True
+                    )
+                else:
+                    sent = NotificationService.send_reservation_failure(
+                        user_id=item.user_id,
+                        room_name=item.room_name,
+                        date=target_date.strftime('%Y-%m-%d'),
+                        start_time=item.start_time,
+                        end_time=item.end_time,
+                        reason=outcome['message'],
+                        enqueue=True
                     )
+                queued += 1 if sent else 0
+            except Exception as notification_error:
+                # Don't let notification failure affect the reservation result
+                current_app.logger.error(
+                    f"Error queueing notification for {item.source_type} {item.source_id}: "
+                    f"{str(notification_error)}")
+        return queued
 
-                    if not success:
-                        all_segments_succeeded = False
-                        # Only add non-None, non-empty error messages
-                        if error_msg:
-                            all_errors.append(error_msg)
+    @staticmethod
+    def queue_digests(outcomes, target_date):
+        """
+        Queue one digest per user covering all of their outcomes in this run,
+        built from the outcomes in memory without touching the database
 
-                # Record results
-                with lock:
-                    results_dict['processed'] += 1
-
-                    if all_segments_succeeded:
-                        reservation.status = 'successful'
-                        results_dict['successful'] += 1
-                        status = 'successful'
-                        message = 'Reservation successful'
-                    else:
-                        reservation.status = 'failed'
-                        results_dict['failed'] += 1
-                        status = 'failed'
-                        message = '; '.join(all_errors) if all_errors else "Unknown error"
+        Returns:
+            int: Number of digests queued
+        """
+        by_user = {}
+        for outcome in outcomes:
+            if not NotificationService.should_notify(outcome['status'], outcome['message']):
+                continue
+            item = outcome['item']
+            by_user.setdefault(item.user_id, []).append({
+                'room_name': item.room_name,
+                'start_time': item.start_time,
+                'end_time': item.end_time,
+                'status': outcome['status'],
+                'reason': outcome['message']
+            })
+
+        queued = 0
+        for user_id, entries in by_user.items():
+            try:
+                if NotificationService.send_reservation_digest(
+                        user_id, target_date.strftime('%Y-%m-%d'), entries, enqueue=True):
+                    queued += 1
+            except Exception as notification_error:
+                current_app.logger.error(f"Error queueing digest for user {user_id}: {str(notification_error)}")
+        return queued
 
-                session.commit()
+    @staticmethod
+    def stage_outcomes(outcomes, target_date):
+        """
+        Add history entries and status/token updates for `outcomes` to the session
+        without committing
 
-            # Always create a new history entry for better tracking and to ensure we have a record
-            # First, create the new history entry
-            new_history = ReservationHistory(
-                user_id=reservation.user_id,
-                room_id=reservation.room_id,
+        Outcomes may be dispatch outcomes (with a PlannedReservation `item`) or
+        journal records (plain dicts).
+
+        Returns:
+            list: The staged ReservationHistory entries, in the order of `outcomes`
+        """
+        now = datetime.utcnow()
+        histories = []
+        one_time_status = {}
+        tokens = {}
+
+        for outcome in outcomes:
+            item = outcome.get('item')
+            fields = item._asdict() if item is not None else outcome
+
+            histories.append(ReservationHistory(
+                user_id=fields['user_id'],
+                room_id=fields['room_id'],
                 reservation_date=target_date,
-                start_time=reservation.start_time,
-                end_time=reservation.end_time,
-                status=status,
-                message=message,
-                source_type='one_time',
-                source_id=reservation.id,
-                created_at=datetime.utcnow()  # Explicitly set creation time
-            )
+                start_time=fields['start_time'],
+                end_time=fields['end_time'],
+                status=outcome['status'],
+                message=outcome['message'],
+                source_type=fields['source_type'],
+                source_id=fields['source_id'],
+                created_at=now
+            ))
+
+            if fields['source_type'] == 'one_time':
+                one_time_status[fields['source_id']] = outcome['status']
+            if item is not None and outcome.get('token') and outcome['token'] != item.token:
+                tokens[item.user_id] = outcome['token']
+
+        db.session.add_all(histories)
+        UserStatsService.record(histories)
+
+        for status in set(one_time_status.values()):
+            ids = [source_id for source_id, value in one_time_status.items() if value == status]
+            OneTimeReservation.query.filter(OneTimeReservation.id.in_(ids)).update(
+                {OneTimeReservation.status: status}, synchronize_session=False)
+
+        for user_id, token in tokens.items():
+            User.query.filter_by(id=user_id).update({User.ccom_token: token}, synchronize_session=False)
+
+        db.session.flush()
+        return histories
 
-            # Add to session and commit immediately
-            session.add(new_history)
+    @staticmethod
+    def recover_journals(reconcile=True):
+        """
+        Store the outcomes of runs that died before committing their results
 
-            try:
-                session.flush()  # Flush to get the ID before commit
-                history_id = new_history.id
-                session.commit()
-                current_app.logger.info(f"Successfully created new one-time history entry: ID={history_id}")
-            except Exception as commit_error:
-                session.rollback()
-                current_app.logger.error(f"Error creating one-time history: {str(commit_error)}")
-                # Try one more time with a new session
-                try:
-                    session.close()
-                    session = ReservationService.get_db_session()
-
-                    # Create a new history entry with a fresh session
-                    history = ReservationHistory(
-                        user_id=reservation.user_id,
-                        room_id=reservation.room_id,
-                        reservation_date=target_date,
-                        start_time=reservation.start_time,
-                        end_time=reservation.end_time,
-                        status=status,
-                        message=message,
-                        source_type='one_time',
-                        source_id=reservation.id,
-                        created_at=datetime.utcnow()
-                    )
-                    session.add(history)
-                    session.flush()
-                    history_id = history.id
-                    session.commit()
-                    current_app.logger.info(f"Successfully saved one-time history on second attempt: ID={history_id}")
-                except Exception as retry_error:
-                    current_app.logger.error(f"Final error saving one-time history: {str(retry_error)}")
-                    with lock:
-                        results_dict['errors'].append(f"Could not save one-time history: {str(retry_error)}")
+        Outcomes already present in the history (same source and date) are not
+        written twice. Reservations that were sent but never finished are
+        resolved against the user's CCOM order list when `reconcile` is set,
+        otherwise from the responses recorded in the journal.
 
-            # Log the creation of history entry
-            current_app.logger.info(f"Created/updated one-time history entry: ID={history_id}, "
-                                    f"User={reservation.user_id}, Room={reservation.room_id}, "
-                                    f"Date={target_date}, Status={status}")
+        Returns:
+            dict: Recovery results
+        """
+        results = {'journals': 0, 'recovered': 0, 'reconciled': 0, 'errors': []}
 
-            # Send notification directly after processing the reservation
-            try:
-                # Check if notifications are enabled in the configuration
-                if current_app.config.get('NOTIFICATION_ENABLED', False):
-                    current_app.logger.info(f"Sending direct notification for one-time history ID {history_id}")
-
-                    if status == 'successful':
-                        NotificationService.send_reservation_success(
-                            user_id=reservation.user_id,
-                            room_name=room.name,
-                            date=target_date.strftime('%Y-%m-%d'),
-                            start_time=reservation.start_time,
-                            end_time=reservation.end_time
-                        )
-                    else:
-                        NotificationService.send_reservation_failure(
-                            user_id=reservation.user_id,
-                            room_name=room.name,
-                            date=target_date.strftime('%Y-%m-%d'),
-                            start_time=reservation.start_time,
-                            end_time=reservation.end_time,
-                            reason=message
-                        )
-            except Exception as notification_error:
-                current_app.logger.error(
-                    f"Error sending notification for one-time history {history_id}: {str(notification_error)}")
-                # Don't let notification failure affect the reservation result
-                pass
+        for path in RunJournal.pending():
+            journal = RunJournal.read(path)
+            if journal['committed'] or journal['target_date'] is None:
+                os.remove(path)
+                continue
 
-        except Exception as e:
+            results['journals'] += 1
+            target_date = date.fromisoformat(journal['target_date'])
             try:
-                if reservation and session:
-                    reservation.status = 'failed'
-                    session.commit()
-            except:
-                pass
+                finished = {record['src'] for record in journal['outcomes']}
+                interrupted = {src: sends for src, sends in journal['sends'].items() if src not in finished}
+                records = journal['outcomes'] + ReservationService.resolve_interrupted(
+                    interrupted, journal['responses'], target_date, reconcile)
+
+                stored = {
+                    (h.source_type, h.source_id)
+                    for h in ReservationHistory.query.filter_by(reservation_date=target_date).all()
+                }
+                missing = [r for r in records if (r['source_type'], r['source_id']) not in stored]
+
+                ReservationService.stage_outcomes(missing, target_date)
+                db.session.commit()
+                SystemSummary.invalidate()
+                os.remove(path)
+
+                results['recovered'] += len(missing)
+                results['reconciled'] += len(interrupted)
+                current_app.logger.warning(
+                    f"Recovered {len(missing)} outcomes for {target_date} from journal {path} "
+                    f"({len(interrupted)} interrupted)")
+            except Exception as e:
+                db.session.rollback()
+                results['errors'].append(f"{path}: {str(e)}")
+                current_app.logger.error(f"Error recovering journal {path}: {str(e)}")
 
-            with lock:
-                results_dict['failed'] += 1
-                results_dict['errors'].append(str(e))
-            current_app.logger.error(f"Error processing one-time reservation {reservation.id}: {str(e)}")
-        finally:
-            # Make sure to properly close the session
-            if session:
-                ReservationService.close_db_session()
+        return results
+
+    @staticmethod
+    def resolve_interrupted(interrupted, responses, target_date, reconcile=True):
+        """
+        Decide the outcome of reservations that were sent but never finished
+
+        Args:
+            interrupted: Journal send records grouped by source key
+            responses: Journal response records grouped by source key
+            target_date: Target date of the run
+            reconcile: Whether to check the users' CCOM order lists
+
+        Returns:
+            list: Outcome records in the journal's format
+        """
+        orders_by_user = {}
+        if reconcile:
+            user_ids = {sends[0]['u'] for sends in interrupted.values()}
+            for user in User.query.filter(User.id.in_(user_ids)).all() if user_ids else []:
+                try:
+                    client = CCOMClient(user.username, user.get_ccom_password(), user.ccom_token)
+                    client.soft_login()
+                    orders = client.get_order_list()
+                    if orders.get('status') == 200:
+                        orders_by_user[user.id] = orders.get('data', [])
+                except Exception as e:
+                    current_app.logger.error(f"Cannot fetch orders of {user.username} for recovery: {str(e)}")
+
+        records = []
+        for src, sends in interrupted.items():
+            # With fallback rooms, only the sends to the room tried last decide the outcome
+            last = sends[-1]
+            sends = [send for send in sends if send['dev'] == last['dev']]
+            source_type, source_id = src.split(':')
+            start_time, end_time = last['span'].split('-')
+            orders = orders_by_user.get(last['u'])
+            cancellation = 'cancel' in last
+
+            if orders is not None:
+                order_ids = {order['id'] for order in orders}
+                booked = {order['startTime'] for order in orders if str(order['device']) == str(last['dev'])}
+                if cancellation:
+                    success = not any(send['cancel'] in order_ids for send in sends)
+                else:
+                    success = all(send['st'] in booked for send in sends)
+                message = 'Recovered from CCOM order list: ' + (
+                    'reservation confirmed' if success else 'no matching order')
+            else:
+                # Fall back to what CCOM answered before the run died
+                answered = {}
+                for response in responses.get(src, []):
+                    rule = classify({'status': response.get('s'), 'msg': response.get('m')},
+                                    CANCELLATION_RULES if cancellation else RESERVATION_RULES)
+                    answered[response.get('st')] = rule.action == SUCCESS
+                success = bool(answered) and all(answered.values()) and (
+                    cancellation or all(send['st'] in answered for send in sends))
+                message = 'Recovered from run journal: ' + (
+                    'confirmed by CCOM response' if success else 'run interrupted before a result was recorded')
+
+            records.append({
+                'source_type': source_type,
+                'source_id': int(source_id),
+                'user_id': last['u'],
+                'room_id': last['r'],
+                'start_time': start_time,
+                'end_time': end_time,
+                'status': 'successful' if success else 'failed',
+                'message': message
+            })
+
+        return records
 
     @staticmethod
     def process_user_login(user, results, lock):
@@ -689,6 +949,7 @@ class ReservationService:
                 session.commit()
                 with lock:
                     results['successful'] += 1
+                    results['verified_user_ids'].append(user.id)
                 current_app.logger.info(f"Pre-login successful for user {user.username}")
             else:
                 with lock:
@@ -706,130 +967,249 @@ class ReservationService:
                 ReservationService.close_db_session()
 
     @staticmethod
-    def process_recurring_reservations(target_date=None, max_workers=10):
+    def refresh_cached_tokens():
         """
-        Process all recurring reservations for the given date in parallel
-
-        Args:
-            target_date: Target date (default: tomorrow)
-            max_workers: Maximum number of parallel threads
+        Revalidate cached tokens that are about to go stale, logging in again
+        where a token has expired, so later soft logins stay free
 
         Returns:
-            dict: Processing results
+            dict: Refresh results
         """
-        if target_date is None:
-            target_date = date.today() + timedelta(days=1)
-
-        day_of_week = get_day_of_week(target_date)
-
-        # Get all active recurring reservations for this day of week
-        recurring_reservations = RecurringReservation.query.filter_by(
-            day_of_week=day_of_week,
-            is_active=True
-        ).all()
-
-        # Initialize results dictionary with thread-safe counters
-        results = {
-            'processed': 0,
-            'successful': 0,
-            'failed': 0,
-            'skipped': 0,
-            'errors': []
-        }
-
-        # Thread lock for updating results dictionary
-        lock = threading.Lock()
-
-        # Create app context for each worker thread to use
-        from flask import current_app
-        app = current_app._get_current_object()
+        freshness = current_app.config.get('TOKEN_FRESHNESS_SECONDS', 600)
+        due = dict(token_cache.due_for_refresh(freshness))
+        results = {'checked': 0, 'renewed': 0, 'failed': 0}
+        if not due:
+            return results
+
+        users = User.query.filter(func.lower(User.username).in_(list(due.keys()))).all()
+        clients = []
+        for user in users:
+            try:
+                clients.append((user, AsyncCCOMClient(user.username, user.get_ccom_password(), user.ccom_token)))
+            except Exception as e:
+                current_app.logger.error(f"Cannot refresh token for user {user.username}: {str(e)}")
+                results['failed'] += 1
 
-        # Process reservations in parallel
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            # Submit all tasks - each with its own app context
-            futures = []
-            for reservation in recurring_reservations:
-                def process_with_context(res=reservation):
-                    with app.app_context():
-                        return ReservationService.process_single_recurring_reservation(
-                            res, target_date, results, lock
-                        )
+        async def revalidate_all():
+            return await asyncio.gather(
+                *(client.soft_login(revalidate=True) for _, client in clients),
+                return_exceptions=True
+            )
 
-                futures.append(executor.submit(process_with_context))
+        outcomes = CCOMConnectionPool.get().run(revalidate_all())
 
-            # Wait for all tasks to complete
-            for future in concurrent.futures.as_completed(futures):
-                try:
-                    future.result()
-                except Exception as e:
-                    with app.app_context():
-                        current_app.logger.error(f"Unexpected thread error: {str(e)}")
-                    with lock:
-                        results['errors'].append(f"Thread error: {str(e)}")
+        for (user, client), outcome in zip(clients, outcomes):
+            results['checked'] += 1
+            if isinstance(outcome, Exception) or not outcome:
+                results['failed'] += 1
+                current_app.logger.warning(f"Token refresh failed for user {user.username}: {outcome}")
+            elif client.token != user.ccom_token:
+                user.ccom_token = client.token
+                results['renewed'] += 1
 
+        db.session.commit()
         return results
 
     @staticmethod
-    def process_one_time_reservations(target_date=None, max_workers=10):
+    def execute_plan(plan, max_concurrency=None, dispatch=None, orders=None):
         """
-        Process all one-time reservations for the given date in parallel
+        Dispatch every request of a reservation plan from one shared queue
+
+        Recurring and one-time requests are interleaved fairly per user and sent
+        concurrently from the CCOM event loop; outcomes are recorded once every
+        request has been sent.
 
         Args:
-            target_date: Target date (default: tomorrow)
-            max_workers: Maximum number of parallel threads
+            plan: ReservationPlan to execute
+            max_concurrency: Upper bound on concurrent requests (default: DISPATCH_MAX_CONCURRENCY)
+            dispatch: Optional DispatchEngine that releases the requests
+            orders: user_id -> OrderIndex for the cancellations (default: the indexes
+                prefetched for the plan's date); users missing from it are fetched
 
         Returns:
-            dict: Processing results
+            dict: Processing results keyed by source type, plus concurrency stats
         """
-        if target_date is None:
-            target_date = date.today() + timedelta(days=1)
+        target_date = plan.target_date
+        config = current_app.config
 
-        # Get all pending one-time reservations for this date
-        one_time_reservations = OneTimeReservation.query.filter_by(
-            reservation_date=target_date,
-            status='pending'
-        ).all()
-
-        # Initialize results dictionary with thread-safe counters
         results = {
-            'processed': 0,
-            'successful': 0,
-            'failed': 0,
-            'errors': []
+            'recurring': {'processed': 0, 'successful': 0, 'failed': 0, 'skipped': 0, 'errors': []},
+            'one_time': {'processed': 0, 'successful': 0, 'failed': 0, 'errors': []}
         }
 
-        # Thread lock for updating results dictionary
-        lock = threading.Lock()
+        for entry in plan.skipped:
+            source_results = results[entry['source_type']]
+            source_results['skipped'] = source_results.get('skipped', 0) + 1
 
-        # Create app context for each worker thread to use
-        from flask import current_app
-        app = current_app._get_current_object()
+        pool = CCOMConnectionPool.get()
+        scheduler = DispatchScheduler(
+            max_concurrency=max_concurrency or config.get('DISPATCH_MAX_CONCURRENCY', pool.max_connections),
+            target_window_ms=config.get('DISPATCH_TARGET_WINDOW_MS', 50),
+            policy=config.get('DISPATCH_FAIRNESS', 'round_robin')
+        )
+        # Most contested slots first, without giving up per-user fairness
+        items = scheduler.order(plan.items, priority=lambda item: item.contention)
+
+        # One client per user so that a renewed token is shared by all of the user's requests
+        clients = {}
+        for item in items:
+            if item.user_id not in clients:
+                clients[item.user_id] = AsyncCCOMClient(item.username, item.password, item.token, pool)
+        unverified = sorted({item.user_id for item in items if not item.token_verified})
+
+        latency_ms = pool.latency_ms
+        if latency_ms is None and dispatch and dispatch.calibrated:
+            latency_ms = dispatch.rtt_ms
+
+        # Hot items are raced over as many connections as the contention index suggests
+        race_stagger_ms = config.get('DISPATCH_RACE_STAGGER_MS', 3) if config.get('DISPATCH_RACE_ENABLED') else None
+        parallel_segments = config.get('DISPATCH_PARALLEL_SEGMENTS', True)
+        user_in_flight = config.get('DISPATCH_USER_MAX_IN_FLIGHT', 2)
+
+        # Cancellations look their orders up in indexes fetched once per user, ideally during pre-login
+        orders = take_prefetched_orders(target_date) if orders is None else dict(orders)
+        cancelling = sorted({item.user_id for item in items if item.is_cancellation})
+
+        # Per-request timing, relative to the open instant when a DispatchEngine releases the requests
+        trace = RunTrace.for_dispatch(dispatch) if config.get('RUN_TRACE_ENABLED', True) else None
+
+        async def run_all():
+            if trace:
+                trace.activate()
+
+            # Tokens that pre-login could not validate must be fixed before the window opens
+            logins = await asyncio.gather(
+                *(clients[user_id].soft_login() for user_id in unverified),
+                return_exceptions=True
+            )
+            failed_logins = {user_id for user_id, ok in zip(unverified, logins)
+                             if isinstance(ok, Exception) or not ok}
+
+            missing = [user_id for user_id in cancelling if user_id not in orders and user_id not in failed_logins]
+            if missing:
+                orders.update(await ReservationService.fetch_order_indexes({user_id: clients[user_id]
+                                                                            for user_id in missing}))
+
+            # CCOM limits the orders a user may hold, so each user's segments in flight are bounded
+            slots = {user_id: asyncio.Semaphore(user_in_flight) for user_id in clients} if user_in_flight else {}
+
+            async def handler(item):
+                if trace:
+                    trace.item_started(item)
+                if item.user_id in failed_logins:
+                    outcome = {'item': item, 'status': 'failed', 'processed': False,
+                               'message': f"Failed to login for user {item.username}"}
+                else:
+                    outcome = await ReservationService.dispatch_planned_reservation(
+                        item, clients[item.user_id], target_date, dispatch, journal, race_stagger_ms,
+                        parallel_segments, slots.get(item.user_id), orders.get(item.user_id)
+                    )
+                if journal:
+                    journal.record_outcome(outcome)
+                return outcome
 
-        # Process reservations in parallel
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            # Submit all tasks - each with its own app context
-            futures = []
-            for reservation in one_time_reservations:
-                def process_with_context(res=reservation):
-                    with app.app_context():
-                        return ReservationService.process_single_one_time_reservation(
-                            res, target_date, results, lock
-                        )
+            return await scheduler.run(items, handler, latency_ms, barrier=dispatch is not None)
 
-                futures.append(executor.submit(process_with_context))
+        # Outcomes go to a local journal while sending and to the database in one go afterwards
+        journal = None
+        if items:
+            try:
+                journal = RunJournal.start(target_date)
+            except OSError as e:
+                current_app.logger.error(f"Cannot open run journal, continuing without one: {str(e)}")
 
-            # Wait for all tasks to complete
-            for future in concurrent.futures.as_completed(futures):
-                try:
-                    future.result()
-                except Exception as e:
-                    with app.app_context():
-                        current_app.logger.error(f"Unexpected thread error: {str(e)}")
-                    with lock:
-                        results['errors'].append(f"Thread error: {str(e)}")
+        outcomes = pool.run(run_all())
+
+        for index, (item, outcome) in enumerate(zip(items, outcomes)):
+            if isinstance(outcome, Exception):
+                current_app.logger.error(f"Unexpected dispatch error: {str(outcome)}")
+                outcomes[index] = {'item': item, 'status': 'failed', 'processed': False,
+                                   'message': str(outcome)}
+                if journal:
+                    journal.record_outcome(outcomes[index])
+
+        # The requests are out - now it is safe to talk to the database
+        if journal:
+            journal.sync()
+        stored = ReservationService.record_outcomes(outcomes, target_date, results, journal)
 
+        try:
+            ContentionIndex.update(outcomes)
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.error(f"Error updating room contention index: {str(e)}")
+
+        # Reservations that could not be planned count as failures
+        if plan.invalid:
+            for entry in plan.invalid:
+                results[entry['source_type']]['failed'] += 1
+                results[entry['source_type']]['errors'].append(entry['reason'])
+
+                if entry['source_type'] == 'one_time':
+                    reservation = db.session.get(OneTimeReservation, entry['source_id'])
+                    if reservation:
+                        reservation.status = 'failed'
+            db.session.commit()
+
+        results['concurrency'] = scheduler.stats()
+        results['notifications_queued'] = stored['notifications_queued']
+        if race_stagger_ms is not None:
+            races = [dict(race, source_type=outcome['item'].source_type, source_id=outcome['item'].source_id)
+                     for outcome in outcomes for race in outcome.get('races', ())]
+            results['racing'] = ReservationRace.summarize(races, race_stagger_ms)
+        if trace:
+            results['trace'] = trace.to_dict(dispatch.released_at if dispatch else None)
         return results
 
+    @staticmethod
+    async def fetch_order_indexes(clients):
+        """
+        Fetch the order lists of several users at once
+
+        Args:
+            clients: user_id -> logged-in AsyncCCOMClient
+
+        Returns:
+            dict: user_id -> OrderIndex for the users whose order list could be fetched
+        """
+        user_ids = list(clients)
+        fetched = await asyncio.gather(*(OrderIndex.fetch(clients[user_id]) for user_id in user_ids),
+                                       return_exceptions=True)
+        indexes = {}
+        for user_id, index in zip(user_ids, fetched):
+            if isinstance(index, Exception):
+                clients[user_id].logger.error(f"Cannot prefetch the orders of {clients[user_id].username}: "
+                                              f"{str(index)}")
+            else:
+                indexes[user_id] = index
+        return indexes
+
+    @staticmethod
+    def prefetch_orders(plan):
+        """
+        Fetch the order lists of every user with a cancellation in `plan` and
+        keep them for the reservation job, so no order list is fetched at the window
+
+        Args:
+            plan: ReservationPlan built by the pre-login job
+
+        Returns:
+            int: Number of users whose orders were prefetched
+        """
+        pool = CCOMConnectionPool.get()
+        clients = {}
+        for item in plan.items:
+            if item.is_cancellation and item.user_id not in clients:
+                clients[item.user_id] = AsyncCCOMClient(item.username, item.password, item.token, pool)
+        if not clients:
+            set_prefetched_orders(plan.target_date, None)
+            return 0
+
+        indexes = pool.run(ReservationService.fetch_order_indexes(clients))
+        set_prefetched_orders(plan.target_date, indexes)
+        current_app.logger.info(f"Prefetched the orders of {len(indexes)} of {len(clients)} users with cancellations")
+        return len(indexes)
+
     @staticmethod
     def perform_pre_login(max_workers=10):
         """
@@ -865,7 +1245,8 @@ class ReservationService:
             'total_users': len(users),
             'successful': 0,
             'failed': 0,
-            'errors': []
+            'errors': [],
+            'verified_user_ids': []
         }
 
         # Thread lock for updating results dictionary
@@ -899,21 +1280,49 @@ class ReservationService:
         return results
 
     @staticmethod
-    def execute_reservations(max_workers=10):
+    def execute_reservations(max_concurrency=None, dispatch=None, use_prepared=True):
         """
-        Execute all pending reservations for tomorrow in parallel
+        Execute all pending reservations for tomorrow concurrently
+
+        Uses the plan built during pre-login when one exists for tomorrow, otherwise
+        builds one on the spot.
 
         Args:
-            max_workers: Maximum number of parallel threads
+            max_concurrency: Upper bound on concurrent requests (default: DISPATCH_MAX_CONCURRENCY)
+            dispatch: Optional DispatchEngine; when given, requests are prepared and
+                held until the engine releases them at the window open instant
+            use_prepared: Consume the plan and order indexes prepared by pre-login; manual
+                runs pass False to build their own and leave them to the scheduled run
 
         Returns:
             dict: Combined processing results
         """
         target_date = date.today() + timedelta(days=1)
 
-        # Process recurring and one-time reservations in parallel
-        recurring_results = ReservationService.process_recurring_reservations(target_date, max_workers)
-        one_time_results = ReservationService.process_one_time_reservations(target_date, max_workers)
+        # Store whatever an earlier run that crashed left behind before history is read again; pre-login
+        # already reconciled with CCOM, so no order lists are fetched this close to the window
+        recovery = ReservationService.recover_journals(reconcile=False)
+        if recovery['journals']:
+            current_app.logger.warning(f"Recovered {recovery['recovered']} outcomes "
+                                       f"from {recovery['journals']} interrupted run(s)")
+
+        if use_prepared:
+            plan = get_current_plan(target_date)
+            if plan is None:
+                current_app.logger.warning(f"No prepared plan for {target_date}, building one now")
+                plan = ReservationPlanner.build_plan(target_date)
+
+            # A plan is only dispatched once
+            set_current_plan(None)
+            orders = None
+        else:
+            # Fresh plan and order lists, so the prepared ones stay in place for the scheduled run
+            plan = ReservationPlanner.build_plan(target_date)
+            orders = {}
+
+        results = ReservationService.execute_plan(plan, max_concurrency, dispatch, orders)
+        recurring_results = results['recurring']
+        one_time_results = results['one_time']
 
         # Combine results
         combined_results = {
@@ -923,7 +1332,56 @@ class ReservationService:
             'total_processed': recurring_results['processed'] + one_time_results['processed'],
             'total_successful': recurring_results['successful'] + one_time_results['successful'],
             'total_failed': recurring_results['failed'] + one_time_results['failed'],
-            'errors': recurring_results['errors'] + one_time_results['errors']
+            'errors': recurring_results['errors'] + one_time_results['errors'],
+            'plan': {
+                'total': len(plan),
+                'created_at': plan.created_at
+            },
+            'concurrency': results['concurrency'],
+            'notifications_queued': results['notifications_queued']
         }
+        if 'racing' in results:
+            combined_results['racing'] = results['racing']
+
+        if dispatch:
+            combined_results['dispatch'] = dispatch.stats()
+
+        if 'trace' in results:
+            combined_results['timeline'] = build_timeline(results['trace'])
+            combined_results['run_id'] = ReservationService.store_run(combined_results, results['trace'])
 
-        return combined_results
\ No newline at end of file
+        return combined_results
+
+    @staticmethod
+    def store_run(combined_results, trace):
+        """
+        Keep the results and per-request timing of a run for the timeline report,
+        dropping all but the newest RUN_TRACE_KEEP runs
+
+        Returns:
+            int: ID of the stored ReservationRun, None if it could not be stored
+        """
+        keys = ('recurring', 'one_time', 'errors', 'concurrency', 'notifications_queued', 'dispatch', 'racing')
+        try:
+            run = ReservationRun(
+                target_date=combined_results['target_date'],
+                total_processed=combined_results['total_processed'],
+                total_successful=combined_results['total_successful'],
+                total_failed=combined_results['total_failed'],
+                results={key: combined_results[key] for key in keys if key in combined_results},
+                trace=trace
+            )
+            db.session.add(run)
+            db.session.flush()
+
+            keep = current_app.config.get('RUN_TRACE_KEEP', 30)
+            stale = [run_id for run_id, in db.session.query(ReservationRun.id)
+                     .order_by(ReservationRun.started_at.desc(), ReservationRun.id.desc()).offset(keep)]
+            if stale:
+                ReservationRun.query.filter(ReservationRun.id.in_(stale)).delete(synchronize_session=False)
+            db.session.commit()
+            return run.id
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.error(f"Error storing the timing of the reservation run: {str(e)}")
+            return None
\ No newline at end of file
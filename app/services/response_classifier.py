@@ -0,0 +1,96 @@
+"""
+@Author: Tianyi Zhang
+@Date: 2025/4/26
+@Description: Declarative classification of CCOM responses into retry actions
+"""
+from typing import NamedTuple, Optional
+
+# Actions a response can lead to
+SUCCESS = 'success'  # The request went through
+TERMINAL = 'terminal'  # Retrying cannot help
+RETRY = 'retry'  # Send the same request again after the rule's delay
+RETRY_AT_OPEN = 'retry_at_open'  # Sent before the window opened; send again at the open instant
+SWITCH_ROOM = 'switch_room'  # The room is taken; another room may still succeed
+
+# How long after the open instant "not open yet" is still put down to clock skew
+NOT_OPEN_GRACE_SECONDS = 2.0
+
+
+class ResponseRule(NamedTuple):
+    """One row of a classifier table"""
+    name: str
+    action: str
+    message: Optional[str] = None  # Substring of `msg` to match, None matches every message
+    exact: bool = False  # Match `msg` exactly instead of as a substring
+    status: Optional[int] = None  # Required `status`, None matches every status
+    delay: float = 0.0  # Seconds before the first retry
+    backoff: float = 1.0  # Factor applied to the delay on every further retry of the same class
+
+    def matches(self, status, msg):
+        if self.status is not None and status != self.status:
+            return False
+        if self.message is None:
+            return True
+        return msg == self.message if self.exact else self.message in msg
+
+    def retry_delay(self, retries, base=None):
+        """Delay before the next retry after `retries` earlier retries of this class"""
+        return (self.delay if base is None else base) * self.backoff ** retries
+
+
+# Rules are tried in order and the first match wins
+RESERVATION_RULES = (
+    ResponseRule('booked', SUCCESS, '成功', exact=True, status=200),
+    ResponseRule('already_chosen', SUCCESS, '已选择'),
+    ResponseRule('not_open', RETRY_AT_OPEN, '琴房暂未开放', delay=0.05),
+    ResponseRule('order_limit', TERMINAL, '超出预约订单数量限制'),
+    ResponseRule('too_long', TERMINAL, 'exceeds maximum allowed duration'),
+    ResponseRule('duplicate', RETRY, '重复请求', delay=0.5),
+    ResponseRule('transport', RETRY, 'API error', delay=0.2, backoff=2.0),
+    ResponseRule('taken', SWITCH_ROOM, '已被预约', delay=0.5),
+    ResponseRule('occupied', SWITCH_ROOM, '已被占用', delay=0.5),
+    # Anything else, e.g. an expired token, a server error or new wording, is retried as before
+    ResponseRule('unknown', RETRY, delay=0.5),
+)
+
+CANCELLATION_RULES = (
+    ResponseRule('cancelled', SUCCESS, '成功', exact=True, status=200),
+    ResponseRule('transport', RETRY, 'API error', delay=0.2, backoff=2.0),
+    ResponseRule('failed', RETRY, delay=0.5),
+)
+
+# Exceptions raised while sending are classified like this
+TRANSPORT_ERROR = ResponseRule('transport', RETRY, delay=0.2, backoff=2.0)
+
+
+def response_message(response):
+    """The message of a response dict, or the text of an exception"""
+    if isinstance(response, Exception):
+        return str(response)
+    return response.get('msg') or ''
+
+
+def classify(response, rules=RESERVATION_RULES):
+    """
+    Find the rule a CCOM response falls under
+
+    Args:
+        response: Response dict with `status` and `msg`, or the exception raised by the request
+        rules: Classifier table
+
+    Returns:
+        ResponseRule: The first matching rule
+    """
+    if isinstance(response, Exception):
+        return TRANSPORT_ERROR
+    status = response.get('status')
+    msg = response_message(response)
+    for rule in rules:
+        if rule.matches(status, msg):
+            return rule
+    raise ValueError(f"No classifier rule matches status {status}: {msg}")
+
+
+def classify_message(message, rules=RESERVATION_RULES):
+    """Classify a stored failure message, e.g. from an outcome or the history"""
+    return classify({'status': None, 'msg': message or ''}, rules)
@@ -0,0 +1,193 @@
+"""
+@Author: Tianyi Zhang
+@Date: 2025/4/26
+@Description: Concurrent availability scan of all rooms with snapshot diffing
+"""
+from flask import current_app
+from app.models.room import Room
+from app.utils.slot_bitmap import intervals_to_masks, mask_to_ranges, encode_mask, time_mask, free_keys
+from datetime import datetime
+import asyncio
+import threading
+import time
+
+
+class RoomSnapshot:
+    """
+    Free 15-minute slots of every scanned room, one bitmask per room and day
+
+    Attributes:
+        rooms: ccom_id -> {ISO date -> mask}
+        names: ccom_id -> room name
+        errors: ccom_id -> error message for rooms that could not be scanned
+    """
+
+    def __init__(self, rooms, names, errors=None, taken_at=None, elapsed_ms=0.0, ttl=None):
+        self.rooms = rooms
+        self.names = names
+        self.errors = errors or {}
+        self.taken_at = taken_at or datetime.now()
+        self.elapsed_ms = elapsed_ms
+        self.ttl = ttl  # Seconds the snapshot is trusted for decisions, None for no limit
+
+    def is_fresh(self):
+        """Whether the snapshot is recent enough to rule rooms out"""
+        return self.ttl is None or (datetime.now() - self.taken_at).total_seconds() < self.ttl
+
+    def diff(self, previous):
+        """
+        Rooms whose free slots changed since `previous`
+
+        Rooms that failed to scan this time are not reported as changed.
+
+        Returns:
+            dict: ccom_id -> {ISO date -> (old mask, new mask)} for changed days only
+        """
+        old_rooms = previous.rooms if previous else {}
+        changes = {}
+        for ccom_id, days in self.rooms.items():
+            old_days = old_rooms.get(ccom_id, {})
+            changed = {
+                day: (old_days.get(day, 0), days.get(day, 0))
+                for day in set(days) | set(old_days)
+                if days.get(day, 0) != old_days.get(day, 0)
+            }
+            if changed:
+                changes[ccom_id] = changed
+        return changes
+
+    def free_rooms(self, date, start_time, end_time):
+        """
+        Rooms free for the whole of `start_time`-`end_time` on `date`
+
+        One bitwise test per room against the cached masks.
+
+        Returns:
+            list: ccom_ids of the free rooms
+        """
+        need = time_mask(start_time, end_time, cover=True)
+        return free_keys({ccom_id: days.get(date, 0) for ccom_id, days in self.rooms.items()}, need)
+
+    def to_dict(self, date=None):
+        """JSON form for the UI, optionally limited to one ISO date"""
+        rooms = {}
+        for ccom_id, days in self.rooms.items():
+            if date is not None:
+                days = {date: days[date]} if date in days else {}
+            rooms[ccom_id] = {
+                'name': self.names.get(ccom_id),
+                'days': {
+                    day: {'mask': encode_mask(mask), 'free': mask_to_ranges(mask)}
+                    for day, mask in sorted(days.items())
+                }
+            }
+
+        return {
+            'taken_at': self.taken_at.isoformat(),
+            'elapsed_ms': round(self.elapsed_ms, 1),
+            'rooms': rooms,
+            'errors': self.errors
+        }
+
+
+_current_snapshot = None
+_snapshot_lock = threading.Lock()
+
+
+def get_current_snapshot():
+    with _snapshot_lock:
+        return _current_snapshot
+
+
+def set_current_snapshot(snapshot):
+    global _current_snapshot
+    with _snapshot_lock:
+        _current_snapshot = snapshot
+
+
+class RoomScanner:
+    @staticmethod
+    def select_rooms(piano_only=True):
+        rooms = Room.query.order_by(Room.id).all()
+        if piano_only:
+            rooms = [room for room in rooms if "无钢琴" not in (room.instruments or "")]
+        return rooms
+
+    @staticmethod
+    async def fetch_all(client, rooms, max_concurrency):
+        """
+        Fetch the raw availability of every room concurrently over the shared pool
+
+        Returns:
+            dict: ccom_id -> raw API response, or the exception raised for that room
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def fetch(room):
+            async with semaphore:
+                try:
+                    return room.ccom_id, await client.get_reserve_information(int(room.ccom_id))
+                except Exception as e:
+                    return room.ccom_id, e
+
+        return dict(await asyncio.gather(*(fetch(room) for room in rooms)))
+
+    @staticmethod
+    def scan(client, rooms=None, piano_only=True, max_concurrency=None, publish=True):
+        """
+        Scan the availability of all rooms and diff it against the current snapshot
+
+        With `max_concurrency` at least the number of rooms, the scan takes
+        about one round trip instead of one per room.
+
+        Args:
+            client: Logged-in AsyncCCOMClient; availability is the same for every account
+            rooms: Rooms to scan (default: all piano rooms)
+            piano_only: Skip rooms without a piano when `rooms` is not given
+            max_concurrency: Requests in flight at once (default: SCAN_MAX_CONCURRENCY)
+            publish: Make the new snapshot the current one
+
+        Returns:
+            tuple: (RoomSnapshot, changes) where changes is RoomSnapshot.diff of the previous snapshot
+        """
+        if rooms is None:
+            rooms = RoomScanner.select_rooms(piano_only)
+        if max_concurrency is None:
+            max_concurrency = current_app.config.get('SCAN_MAX_CONCURRENCY', 32)
+
+        started = time.perf_counter()
+        responses = client.pool.run(RoomScanner.fetch_all(client, rooms, max(1, max_concurrency)))
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        masks, errors = {}, {}
+        for ccom_id, response in responses.items():
+            if isinstance(response, Exception):
+                errors[ccom_id] = str(response)
+            elif response.get('status') != 200:
+                errors[ccom_id] = response.get('msg') or f"status {response.get('status')}"
+            else:
+                masks[ccom_id] = intervals_to_masks((response.get('data') or {}).get('remainingTimeList') or [])
+
+        # A day another room has free slots on is inside the booking horizon, so a scanned room
+        # without free slots that day is fully booked rather than unknown
+        open_days = {day for days in masks.values() for day in days}
+        for days in masks.values():
+            for day in open_days - set(days):
+                days[day] = 0
+
+        # Keep the last known slots of rooms that failed this time
+        previous = get_current_snapshot()
+        if previous:
+            for ccom_id in errors:
+                if ccom_id in previous.rooms:
+                    masks[ccom_id] = previous.rooms[ccom_id]
+
+        snapshot = RoomSnapshot(masks, {room.ccom_id: room.name for room in rooms}, errors, elapsed_ms=elapsed_ms,
+                                ttl=current_app.config.get('SCAN_SNAPSHOT_TTL_SECONDS', 900))
+        changes = snapshot.diff(previous)
+        if publish:
+            set_current_snapshot(snapshot)
+
+        current_app.logger.info(f"Scanned {len(rooms)} rooms in {elapsed_ms:.0f}ms: "
+                                f"{len(changes)} changed, {len(errors)} failed")
+        return snapshot, changes
@@ -0,0 +1,216 @@
+"""
+@Author: Tianyi Zhang
+@Date: 2025/4/26
+@Description: Write-ahead journal of reservation runs for crash recovery
+"""
+from datetime import datetime
+from flask import current_app
+import json
+import os
+import threading
+import time
+
+
+class RunJournal:
+    """
+    Append-only JSON lines file recording every request and outcome of one run
+
+    A `send` record is appended before each placeAnOrder/cancel call, a `resp`
+    record when CCOM answers and an `outcome` record once a planned
+    reservation is finished. Records are only buffered in memory on the hot
+    path; a background thread writes and fsyncs them in batches every
+    RUN_JOURNAL_SYNC_MS, so a crash loses at most that much.
+
+    Once the run's results are committed the journal is marked as such and
+    removed; a journal left without that marker belongs to a run that died
+    in between and is replayed by `ReservationService.recover_journals`.
+    """
+
+    SUFFIX = '.jsonl'
+
+    # Journals of runs still in progress in this process, never replayed by recovery
+    _open_paths = set()
+    _open_lock = threading.Lock()
+
+    def __init__(self, path, target_date=None, sync_interval=0.2):
+        """
+        Args:
+            path: Journal file path
+            target_date: Target date of the run, written as the journal header
+            sync_interval: Seconds between batched writes to disk
+        """
+        self.path = path
+        self.sync_interval = sync_interval
+        self._buffer = []
+        self._lock = threading.Lock()  # Guards the buffer
+        self._io_lock = threading.Lock()  # Serializes writes to the file
+        self._file = open(path, 'a', encoding='utf-8')
+        self._closed = threading.Event()
+        with self._open_lock:
+            self._open_paths.add(os.path.abspath(path))
+
+        if target_date is not None:
+            self.record('run', date=target_date.isoformat())
+            self.sync()
+
+        self._flusher = threading.Thread(target=self._run_flusher, name='run-journal', daemon=True)
+        self._flusher.start()
+
+    @staticmethod
+    def directory():
+        """Get the journal directory, creating it if needed"""
+        path = current_app.config.get('RUN_JOURNAL_DIR') or os.path.join(current_app.instance_path, 'journal')
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    @classmethod
+    def start(cls, target_date):
+        """Open a new journal for a run booking `target_date`"""
+        name = f"run-{target_date.isoformat()}-{datetime.utcnow().strftime('%Y%m%d%H%M%S%f')}{cls.SUFFIX}"
+        return cls(os.path.join(cls.directory(), name), target_date,
+                   sync_interval=current_app.config.get('RUN_JOURNAL_SYNC_MS', 200) / 1000)
+
+    @staticmethod
+    def source_key(item):
+        return f"{item.source_type}:{item.source_id}"
+
+    def record(self, kind, **data):
+        """Buffer one record; it reaches the disk with the next batch"""
+        data['k'] = kind
+        data['t'] = round(time.time(), 3)
+        line = json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+        with self._lock:
+            self._buffer.append(line)
+
+    def record_send(self, item, start_timestamp=None, end_timestamp=None, attempt=0, order_id=None):
+        """Record that a reservation (or, with `order_id`, a cancellation) is about to be sent"""
+        data = {
+            'src': self.source_key(item),
+            'u': item.user_id,
+            'r': item.room_id,
+            'dev': item.room_ccom_id,
+            'span': f"{item.start_time}-{item.end_time}",
+            'n': attempt
+        }
+        if order_id is not None:
+            data['cancel'] = order_id
+        else:
+            data['st'] = start_timestamp
+            data['et'] = end_timestamp
+        self.record('send', **data)
+
+    def record_response(self, item, response, start_timestamp=None):
+        """Record CCOM's answer to the last send of `item`"""
+        response = response if isinstance(response, dict) else {'status': 0, 'msg': str(response)}
+        self.record('resp', src=self.source_key(item), st=start_timestamp,
+                    s=response.get('status'), m=response.get('msg'))
+
+    def record_outcome(self, outcome):
+        """Record the outcome of one dispatched planned reservation"""
+        item = outcome['item']
+        self.record(
+            'outcome',
+            src=self.source_key(item),
+            source_type=item.source_type,
+            source_id=item.source_id,
+            user_id=item.user_id,
+            room_id=item.room_id,
+            start_time=item.start_time,
+            end_time=item.end_time,
+            status=outcome['status'],
+            message=outcome['message']
+        )
+
+    def _write_pending(self, fsync):
+        with self._io_lock:
+            with self._lock:
+                lines, self._buffer = self._buffer, []
+            if self._file.closed:
+                return
+            if lines:
+                self._file.write('\n'.join(lines) + '\n')
+            self._file.flush()
+            if fsync and lines:
+                os.fsync(self._file.fileno())
+
+    def _run_flusher(self):
+        while not self._closed.wait(self.sync_interval):
+            try:
+                self._write_pending(fsync=True)
+            except (OSError, ValueError):
+                # The file was closed underneath us; close() writes whatever is left
+                return
+
+    def sync(self):
+        """Write buffered records and force them to disk"""
+        self._write_pending(fsync=True)
+
+    def close(self):
+        self._close_file()
+        self._release()
+
+    def _close_file(self):
+        self._closed.set()
+        self._write_pending(fsync=True)
+        with self._io_lock:
+            if not self._file.closed:
+                self._file.close()
+
+    def _release(self):
+        with self._open_lock:
+            self._open_paths.discard(os.path.abspath(self.path))
+
+    def commit(self):
+        """Mark the run's results as stored in the database and discard the journal"""
+        self.record('committed')
+        self._close_file()
+        try:
+            # Still registered as open, so recovery cannot have taken it
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        finally:
+            self._release()
+
+    @staticmethod
+    def read(path):
+        """
+        Read a journal, ignoring a torn last line
+
+        Returns:
+            dict: target_date (string or None), outcomes (list), sends (records grouped by
+                source key), responses (grouped by source key) and committed flag
+        """
+        journal = {'target_date': None, 'outcomes': [], 'sends': {}, 'responses': {}, 'committed': False}
+
+        with open(path, encoding='utf-8') as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                kind = entry.get('k')
+                if kind == 'run':
+                    journal['target_date'] = entry['date']
+                elif kind == 'outcome':
+                    journal['outcomes'].append(entry)
+                elif kind == 'send':
+                    journal['sends'].setdefault(entry['src'], []).append(entry)
+                elif kind == 'resp':
+                    journal['responses'].setdefault(entry['src'], []).append(entry)
+                elif kind == 'committed':
+                    journal['committed'] = True
+
+        return journal
+
+    @classmethod
+    def pending(cls):
+        """List journal files of runs whose results were never committed, except runs still in progress"""
+        directory = cls.directory()
+        with cls._open_lock:
+            open_paths = set(cls._open_paths)
+        return sorted(
+            path for path in (os.path.join(directory, name) for name in os.listdir(directory)
+                              if name.startswith('run-') and name.endswith(cls.SUFFIX))
+            if os.path.abspath(path) not in open_paths
+        )
@@ -0,0 +1,286 @@
+"""
+@Author: Tianyi Zhang
+@Date: 2025/4/26
+@Description: Per-request latency instrumentation of reservation runs
+"""
+from contextlib import contextmanager
+from app.services.run_journal import RunJournal
+from app.services.response_classifier import SUCCESS, SWITCH_ROOM
+from app.utils.time_utils import parse_hhmm, format_hhmm
+import contextvars
+import time
+
+_current_trace = contextvars.ContextVar('run_trace', default=None)
+_current_request = contextvars.ContextVar('run_trace_request', default=None)
+
+# Request timing fields summarized as percentiles
+TIMING_FIELDS = ('queue_ms', 'acquire_ms', 'sent_ms', 'server_ms', 'elapsed_ms')
+
+
+class RunTrace:
+    """
+    Timing of every reservation and cancel request sent during one run
+
+    The trace is made current inside the run's coroutine, so every task the
+    run spawns sees it without it being passed down. Each request is wrapped
+    in `traced_request`, and AsyncCCOMClient fills in the connection and
+    server timings of the wrapped request through httpx's trace hooks.
+
+    Instants are reported in milliseconds relative to the moment the server
+    opens the window, shifted by the estimated one-way latency: a request
+    with `sent_ms` of -3 reached the server about 3 ms before it opened.
+    Without a DispatchEngine they are relative to the start of the run.
+    """
+
+    def __init__(self, open_at=None, lead_ms=0.0):
+        """
+        Args:
+            open_at: time.perf_counter() instant requests are released at, i.e. the
+                DispatchEngine fire instant; None measures from the start of the run
+            lead_ms: How far ahead of the open instant the release was scheduled
+        """
+        self.started_at = time.perf_counter()
+        self.open_at = open_at
+        self.lead_ms = lead_ms
+        self.requests = []
+        self._item_started = {}  # Source key -> when a worker picked the item up
+
+    @classmethod
+    def for_dispatch(cls, dispatch):
+        if dispatch is None or dispatch.fire_deadline is None:
+            return cls()
+        return cls(dispatch.fire_deadline, dispatch.lead_ms)
+
+    def activate(self):
+        """Make this the trace of the calling task and of the tasks it spawns"""
+        _current_trace.set(self)
+
+    def relative_ms(self, instant):
+        """Convert a time.perf_counter() instant to milliseconds after the open"""
+        if instant is None:
+            return None
+        if self.open_at is None:
+            return round((instant - self.started_at) * 1000, 2)
+        # A request sent at the fire instant reaches the server `lead_ms` before the open
+        return round((instant - self.open_at) * 1000 - self.lead_ms, 2)
+
+    def item_started(self, item):
+        """Note that a scheduler worker picked up `item`"""
+        self._item_started[RunJournal.source_key(item)] = time.perf_counter()
+
+    @contextmanager
+    def request(self, item, kind, start_timestamp=None, attempt=0, lane=None):
+        """Record the timing of the request sent inside the block"""
+        record = {
+            'src': RunJournal.source_key(item),
+            'user': item.username,
+            'room': item.room_name,
+            'span': f"{item.start_time}-{item.end_time}",
+            'kind': kind,
+            'segment': _segment_time(item, start_timestamp),
+            'attempt': attempt,
+            'lane': lane,
+            'started': time.perf_counter()
+        }
+        token = _current_request.set(record)
+        try:
+            yield record
+        finally:
+            _current_request.reset(token)
+            record['finished'] = time.perf_counter()
+            self.requests.append(record)
+
+    def to_dict(self, released_at=None):
+        """
+        JSON form of the trace
+
+        Args:
+            released_at: time.perf_counter() instant the DispatchEngine released the requests
+
+        Returns:
+            dict: `requests` in send order and their `summary`
+        """
+        requests = sorted((self._export(record, released_at) for record in self.requests),
+                          key=lambda request: request['start_ms'])
+        return {'relative_to': 'open' if self.open_at is not None else 'start',
+                'requests': requests, 'summary': summarize(requests)}
+
+    def _export(self, record, released_at):
+        # Queue wait of a first send: from when it could have gone out (released and picked up by a
+        # worker) until it did, e.g. waiting for one of the user's slots; retries and racing copies
+        # are delayed on purpose
+        picked_up = self._item_started.get(record['src'])
+        queue_ms = None
+        if picked_up is not None and record['attempt'] == 0 and record['lane'] is None:
+            ready = max(picked_up, released_at if released_at is not None else self.started_at)
+            queue_ms = round(max(0.0, record['started'] - ready) * 1000, 2)
+        sent = record.get('sent_at') or record['started']
+        written = record.get('written_at')
+        answered = record.get('answered_at')
+        return {
+            'src': record['src'],
+            'user': record['user'],
+            'room': record['room'],
+            'span': record['span'],
+            'kind': record['kind'],
+            'segment': record['segment'],
+            'attempt': record['attempt'],
+            'lane': record['lane'],
+            'cold': record.get('cold', False),
+            'queue_ms': queue_ms,
+            'acquire_ms': round((sent - record['started']) * 1000, 2),
+            'start_ms': self.relative_ms(record['started']),
+            'sent_ms': self.relative_ms(sent),
+            'answered_ms': self.relative_ms(answered or record['finished']),
+            'server_ms': round((answered - written) * 1000, 2) if answered and written else None,
+            'elapsed_ms': round((record['finished'] - record['started']) * 1000, 2),
+            'status': record.get('status'),
+            'msg': record.get('msg'),
+            'rule': record.get('rule'),
+            'action': record.get('action')
+        }
+
+
+def _segment_time(item, start_timestamp):
+    """"HHMM" start of the segment of `item` beginning at `start_timestamp`"""
+    if start_timestamp is None or not item.segments:
+        return None
+    minutes = parse_hhmm(item.start_time) + (start_timestamp - item.segments[0][0]) // 60000
+    return format_hhmm(minutes % (24 * 60))
+
+
+@contextmanager
+def traced_request(item, kind, start_timestamp=None, attempt=0, lane=None):
+    """
+    Record the request sent inside the block in the current run's trace
+
+    Yields:
+        dict: The request's record, or None outside a traced run
+    """
+    trace = _current_trace.get()
+    if trace is None or item is None:
+        yield None
+        return
+    with trace.request(item, kind, start_timestamp, attempt, lane) as record:
+        yield record
+
+
+def note_response(record, response, rule):
+    """Add CCOM's answer (or the exception raised instead) and its classification to a record"""
+    if record is None:
+        return
+    if isinstance(response, Exception):
+        record['msg'] = str(response)
+    else:
+        record['status'] = response.get('status')
+        record['msg'] = response.get('msg')
+    record['rule'] = rule.name
+    record['action'] = rule.action
+
+
+def current_request():
+    """Record of the request the current task is sending, None outside a traced run"""
+    return _current_request.get()
+
+
+def http_trace_hook(record):
+    """
+    httpx `trace` extension filling in the connection timings of `record`
+
+    `sent_at` is when the request headers started going out (after a pooled
+    connection was acquired, or a new one connected), `written_at` when the
+    whole request was written and `answered_at` when the response headers arrived.
+    """
+    async def hook(event, info):
+        if event == 'connection.connect_tcp.started':
+            record['cold'] = True
+        elif event.endswith('.send_request_headers.started'):
+            record['sent_at'] = time.perf_counter()
+        elif event.endswith('.receive_response_headers.started'):
+            record['written_at'] = time.perf_counter()
+        elif event.endswith('.receive_response_headers.complete'):
+            record['answered_at'] = time.perf_counter()
+    return hook
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers, None if it is empty"""
+    values = sorted(value for value in values if value is not None)
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))]
+
+
+def summarize(requests):
+    """
+    Aggregate the request timings of a run
+
+    The median send time of booked requests against that of requests
+    rejected as taken tells latency losses from true contention: losing
+    requests that reached the server well after the winning ones lost to our
+    own latency, losing requests sent as early as the winners lost to other
+    users.
+    """
+    first = [request for request in requests if request['attempt'] == 0 and request['lane'] in (None, 0)]
+    by_rule = {}
+    for request in requests:
+        by_rule[request['rule'] or 'unknown'] = by_rule.get(request['rule'] or 'unknown', 0) + 1
+
+    first_sent = [request['sent_ms'] for request in first if request['sent_ms'] is not None]
+    return {
+        'requests': len(requests),
+        'retries': sum(1 for request in requests if request['attempt'] > 0),
+        'cold_connections': sum(1 for request in requests if request['cold']),
+        'first_sent_ms': min(first_sent) if first_sent else None,
+        'last_first_sent_ms': max(first_sent) if first_sent else None,
+        'by_rule': dict(sorted(by_rule.items())),
+        'percentiles': {
+            field: {'p50': percentile([request[field] for request in requests], 0.5),
+                    'p95': percentile([request[field] for request in requests], 0.95)}
+            for field in TIMING_FIELDS
+        },
+        'booked_sent_ms': percentile([request['sent_ms'] for request in requests
+                                      if request['action'] == SUCCESS], 0.5),
+        'rejected_sent_ms': percentile([request['sent_ms'] for request in requests
+                                        if request['action'] == SWITCH_ROOM], 0.5)
+    }
+
+
+def build_timeline(trace):
+    """
+    Lay the requests of a trace out as bars on a common time axis for the results page
+
+    Args:
+        trace: RunTrace.to_dict() output
+
+    Returns:
+        dict: `rows` with the bar offsets in percent of the axis, the axis bounds
+            and the position of the open instant, or None without requests
+    """
+    requests = (trace or {}).get('requests') or []
+    if not requests:
+        return None
+
+    low = min([0.0] + [request['start_ms'] for request in requests])
+    high = max([0.0] + [request['answered_ms'] for request in requests])
+    span = (high - low) or 1.0
+
+    def position(value):
+        return round((value - low) / span * 100, 2)
+
+    rows = []
+    for request in requests:
+        start = position(request['start_ms'])
+        sent = position(request['sent_ms'])
+        end = position(request['answered_ms'])
+        rows.append(dict(request, left_pct=start, acquire_pct=round(sent - start, 2),
+                         flight_pct=max(round(end - sent, 2), 0.3)))
+
+    return {
+        'rows': rows,
+        'min_ms': round(low, 1),
+        'max_ms': round(high, 1),
+        'zero_pct': position(0.0),
+        'relative_to': trace.get('relative_to'),
+        'summary': trace.get('summary')
+    }
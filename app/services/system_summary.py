@@ -0,0 +1,66 @@
+"""
+@Author: Tianyi Zhang
+@Date: 2025/4/26
+@Description: Cached system-wide counts for the about page and the admin dashboard
+"""
+from flask import current_app
+from sqlalchemy import case, func
+from app import db
+from app.models.user import User
+from app.models.room import Room
+from app.models.reservation import RecurringReservation, OneTimeReservation, ReservationHistory
+import threading
+import time
+
+
+class SystemSummary:
+    """
+    System-wide counts computed with aggregate SQL and kept for SYSTEM_SUMMARY_TTL_SECONDS
+
+    Reservation runs call `invalidate()` after storing their results so the
+    pages pick up new history without waiting for the TTL.
+    """
+
+    _value = None
+    _expires_at = 0
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        """Get the cached summary, recomputing it when it has expired"""
+        with cls._lock:
+            if cls._value is not None and time.time() < cls._expires_at:
+                return cls._value
+
+        value = cls.compute()
+        with cls._lock:
+            cls._value = value
+            cls._expires_at = time.time() + current_app.config.get('SYSTEM_SUMMARY_TTL_SECONDS', 300)
+        return value
+
+    @classmethod
+    def invalidate(cls):
+        with cls._lock:
+            cls._value = None
+            cls._expires_at = 0
+
+    @staticmethod
+    def compute():
+        """Count everything with one aggregate query per table"""
+        history = db.session.query(
+            func.count(ReservationHistory.id),
+            func.count(func.distinct(ReservationHistory.user_id)),
+            func.sum(case((ReservationHistory.status == 'successful', 1), else_=0)),
+            func.sum(case((ReservationHistory.status == 'failed', 1), else_=0))
+        ).one()
+
+        return {
+            'user_count': db.session.query(func.count(User.id)).scalar(),
+            'room_count': db.session.query(func.count(Room.id)).scalar(),
+            'recurring_count': db.session.query(func.count(RecurringReservation.id)).scalar(),
+            'one_time_count': db.session.query(func.count(OneTimeReservation.id)).scalar(),
+            'history_count': history[0],
+            'history_user_count': history[1],
+            'success_count': int(history[2] or 0),
+            'failure_count': int(history[3] or 0)
+        }
@@ -0,0 +1,120 @@
+"""
+@Author: Tianyi Zhang
+@Date: 2025/4/26
+@Description: Process-wide cache of validated CCOM tokens
+"""
+import threading
+import time
+
+
+class TokenEntry:
+    """Validation state of one user's token"""
+
+    def __init__(self, token, now):
+        self.token = token
+        self.first_seen = now  # Issue time if we logged in ourselves, otherwise a lower bound
+        self.validated_at = now
+        self.last_used = now
+        self.lifetime = None  # Observed lifetime of this user's previous token, in seconds
+
+    def age(self, now):
+        return now - self.first_seen
+
+
+class TokenCache:
+    """
+    Remember which CCOM tokens were recently confirmed valid
+
+    Tokens validated within the freshness window are trusted without another
+    basicInfo round trip. When a token is found to be invalid, its observed
+    lifetime is kept so that the replacement token is treated as stale
+    slightly before it is expected to expire.
+    """
+
+    # Fraction of the observed lifetime after which a token is no longer trusted
+    LIFETIME_SAFETY = 0.8
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(username):
+        return (username or '').lower()
+
+    def is_fresh(self, username, token, freshness):
+        """
+        Check whether `token` was validated recently enough to skip revalidation
+
+        Args:
+            username: CCOM username
+            token: Token about to be used
+            freshness: Freshness window in seconds
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(self._key(username))
+
+        if entry is None or entry.token != token:
+            return False
+        entry.last_used = now
+        if now - entry.validated_at > freshness:
+            return False
+        if entry.lifetime is not None and entry.age(now) > entry.lifetime * self.LIFETIME_SAFETY:
+            return False
+        return True
+
+    def mark_valid(self, username, token):
+        """Record that `token` was just confirmed valid (or just issued)"""
+        now = time.time()
+        key = self._key(username)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.token != token:
+                lifetime = entry.lifetime if entry else None
+                entry = TokenEntry(token, now)
+                entry.lifetime = lifetime
+                self._entries[key] = entry
+            entry.validated_at = now
+            entry.last_used = now
+
+    def mark_invalid(self, username, token):
+        """Record that `token` was rejected, remembering how long it lasted"""
+        now = time.time()
+        key = self._key(username)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.token == token:
+                entry.lifetime = entry.age(now)
+                entry.token = None
+
+    def due_for_refresh(self, freshness, max_idle=3600):
+        """
+        List usernames whose token will stop being fresh soon
+
+        Args:
+            freshness: Freshness window in seconds
+            max_idle: Tokens not used for this many seconds are left to expire
+
+        Returns:
+            list: (username, token) pairs to revalidate
+        """
+        now = time.time()
+        due = []
+        with self._lock:
+            for key, entry in self._entries.items():
+                if entry.token is None or now - entry.last_used > max_idle:
+                    continue
+                stale_soon = now - entry.validated_at > freshness * self.LIFETIME_SAFETY
+                expiring = entry.lifetime is not None and entry.age(now) > entry.lifetime * self.LIFETIME_SAFETY ** 2
+                if stale_soon or expiring:
+                    due.append((key, entry.token))
+        return due
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Shared by every CCOM client in the process
+token_cache = TokenCache()
@@ -0,0 +1,106 @@
+"""
+@Author: Tianyi Zhang
+@Date: 2025/4/26
+@Description: Maintenance of the precomputed per-user reservation statistics
+"""
+from sqlalchemy import func
+from app import db
+from app.models.reservation import ReservationHistory, UserReservationStats
+
+
+class UserStatsService:
+    @staticmethod
+    def record(histories):
+        """
+        Fold newly written history entries into the users' statistics
+
+        Must run in the same transaction as the history entries; only the
+        statistics rows of the affected users are loaded.
+
+        Args:
+            histories: ReservationHistory entries (or objects with the same attributes)
+        """
+        user_ids = {history.user_id for history in histories}
+        if not user_ids:
+            return
+
+        stats = {
+            row.user_id: row
+            for row in UserReservationStats.query.filter(UserReservationStats.user_id.in_(user_ids)).all()
+        }
+
+        for history in histories:
+            row = stats.get(history.user_id)
+            if row is None:
+                row = stats[history.user_id] = UserReservationStats(
+                    user_id=history.user_id, successful_count=0, failed_count=0)
+                db.session.add(row)
+            row.add(history.status, history.room_id, history.reservation_date)
+
+    @staticmethod
+    def ensure_built():
+        """
+        Build the statistics from the history if the table is still empty
+
+        Run at startup, before any new outcome is recorded, so a deployment
+        upgraded with existing history does not start from zero.
+
+        Returns:
+            int: Number of users with rebuilt statistics, 0 if nothing was done
+        """
+        if UserReservationStats.query.first() is not None or ReservationHistory.query.first() is None:
+            return 0
+        return UserStatsService.rebuild()
+
+    @staticmethod
+    def rebuild():
+        """
+        Recompute every user's statistics from the full history
+
+        Uses portable aggregate queries; weekdays are derived in Python so the
+        result is the same on MySQL and SQLite.
+
+        Returns:
+            int: Number of users with statistics
+        """
+        stats = {}
+
+        def row(user_id):
+            if user_id not in stats:
+                stats[user_id] = UserReservationStats(user_id=user_id, successful_count=0, failed_count=0,
+                                                      room_counts={}, weekday_counts=[0] * 7)
+            return stats[user_id]
+
+        status_counts = db.session.query(
+            ReservationHistory.user_id, ReservationHistory.status, func.count(ReservationHistory.id)
+        ).group_by(ReservationHistory.user_id, ReservationHistory.status).all()
+        for user_id, status, count in status_counts:
+            if status == 'successful':
+                row(user_id).successful_count = count
+            else:
+                row(user_id).failed_count += count
+
+        room_counts = db.session.query(
+            ReservationHistory.user_id, ReservationHistory.room_id, func.count(ReservationHistory.id)
+        ).filter(ReservationHistory.status == 'successful').group_by(
+            ReservationHistory.user_id, ReservationHistory.room_id).all()
+        for user_id, room_id, count in room_counts:
+            row(user_id).room_counts[str(room_id)] = count
+
+        date_counts = db.session.query(
+            ReservationHistory.user_id, ReservationHistory.reservation_date, func.count(ReservationHistory.id)
+        ).filter(ReservationHistory.status == 'successful').group_by(
+            ReservationHistory.user_id, ReservationHistory.reservation_date).all()
+        for user_id, reservation_date, count in date_counts:
+            row(user_id).weekday_counts[reservation_date.weekday()] += count
+
+        for user_stats in stats.values():
+            if user_stats.room_counts:
+                user_stats.most_used_room_id = int(max(user_stats.room_counts, key=user_stats.room_counts.get))
+            if any(user_stats.weekday_counts):
+                user_stats.most_used_day = max(range(7), key=lambda day: user_stats.weekday_counts[day])
+
+        UserReservationStats.query.delete()
+        db.session.add_all(stats.values())
+        db.session.commit()
+        return len(stats)
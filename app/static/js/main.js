@@ -141,6 +141,30 @@ function checkRoomAvailability(roomId, date) {
         });
 }
 
+/**
+ * Normalize availability into {start, end, minutes} ranges ("HHMM" strings).
+ * Uses the free ranges the server computed for the selected date, falling
+ * back to the raw remainingTimeList timestamps.
+ */
+function availabilitySlots(data) {
+    const toMinutes = value => parseInt(value.slice(0, 2), 10) * 60 + parseInt(value.slice(2), 10);
+
+    if (data.free) {
+        return data.free.map(([start, end]) => ({ start, end, minutes: toMinutes(end) - toMinutes(start) }));
+    }
+
+    const pad = value => value.toString().padStart(2, '0');
+    return (data.remainingTimeList || []).map(slot => {
+        const startTime = new Date(slot.startTime);
+        const endTime = new Date(slot.endTime);
+        return {
+            start: pad(startTime.getHours()) + pad(startTime.getMinutes()),
+            end: pad(endTime.getHours()) + pad(endTime.getMinutes()),
+            minutes: (endTime - startTime) / (1000 * 60)
+        };
+    });
+}
+
 /**
  * Display room availability data
  */
@@ -151,7 +175,8 @@ function displayAvailability(data) {
     // Clear previous content
     container.innerHTML = '';
 
-    if (!data.remainingTimeList || data.remainingTimeList.length === 0) {
+    const slots = availabilitySlots(data);
+    if (slots.length === 0) {
         container.innerHTML = '<div class="alert alert-info">No availability information found for this room on the selected date.</div>';
         return;
     }
@@ -175,26 +200,20 @@ function displayAvailability(data) {
     // Table body
     const tbody = document.createElement('tbody');
 
-    data.remainingTimeList.forEach(slot => {
+    slots.forEach(slot => {
         const row = document.createElement('tr');
 
-        // Convert timestamps to time strings
-        const startTime = new Date(slot.startTime);
-        const endTime = new Date(slot.endTime);
-
-        // Format times as HH:MM
-        const startHour = startTime.getHours().toString().padStart(2, '0');
-        const startMinute = startTime.getMinutes().toString().padStart(2, '0');
-        const endHour = endTime.getHours().toString().padStart(2, '0');
-        const endMinute = endTime.getMinutes().toString().padStart(2, '0');
+        const startHour = slot.start.slice(0, 2);
+        const startMinute = slot.start.slice(2);
+        const endHour = slot.end.slice(0, 2);
+        const endMinute = slot.end.slice(2);
 
         const startTimeStr = `${startHour}:${startMinute}`;
         const endTimeStr = `${endHour}:${endMinute}`;
 
         // Calculate duration in hours and minutes
-        const durationMinutes = (endTime - startTime) / (1000 * 60);
-        const hours = Math.floor(durationMinutes / 60);
-        const minutes = durationMinutes % 60;
+        const hours = Math.floor(slot.minutes / 60);
+        const minutes = slot.minutes % 60;
         const durationStr = `${hours}h ${minutes}m`;
 
         // Populate the row
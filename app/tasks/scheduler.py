@@ -4,9 +4,12 @@
 @Description: Improved scheduler to support parallel processing of reservations
 """
 from flask import current_app
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytz
 from app.services.reservation_service import ReservationService
+from app.services.async_ccom_client import CCOMConnectionPool
+from app.services.dispatch_engine import DispatchEngine
+from app.services.reservation_plan import ReservationPlanner, set_current_plan
 from app import db
 from flask import Flask
 
@@ -19,13 +22,17 @@ def initialize_scheduler(scheduler, app):
     global flask_app
     flask_app = app
 
-    # Schedule daily reservation task at 21:30 Beijing time
+    # Schedule daily reservation task shortly before 21:30 Beijing time so that all
+    # preparation is done by the time the dispatch engine releases the requests
+    prepare_at = datetime.strptime(app.config['RESERVATION_OPEN_TIME'], '%H%M') - timedelta(
+        seconds=app.config.get('DISPATCH_PREPARE_SECONDS', 45))
     scheduler.add_job(
         id='execute_reservations',
         func=execute_scheduled_reservations,
         trigger='cron',
-        hour=21,
-        minute=30,
+        hour=prepare_at.hour,
+        minute=prepare_at.minute,
+        second=prepare_at.second,
         timezone=pytz.timezone('Asia/Shanghai')
     )
 
@@ -39,6 +46,14 @@ def initialize_scheduler(scheduler, app):
         timezone=pytz.timezone('Asia/Shanghai')
     )
 
+    # Keep recently used CCOM tokens validated in the background
+    scheduler.add_job(
+        id='refresh_token_cache',
+        func=execute_token_refresh,
+        trigger='interval',
+        seconds=app.config.get('TOKEN_REFRESH_INTERVAL_SECONDS', 120)
+    )
+
     # Add a test task that runs every minute (for development)
     if app.config.get('DEBUG', False):
         scheduler.add_job(
@@ -53,7 +68,10 @@ def initialize_scheduler(scheduler, app):
 
 
 def execute_pre_login():
-    """Perform pre-login to refresh tokens before the actual reservation process"""
+    """
+    Perform pre-login to refresh tokens and build the reservation plan
+    before the actual reservation process
+    """
     # Use the global app reference instead of trying to get current_app
     global flask_app
 
@@ -80,6 +98,21 @@ def execute_pre_login():
                 f"{results['failed']} failed"
             )
 
+            # The plan checks daily limits against history, so store interrupted runs first
+            results['recovery'] = ReservationService.recover_journals()
+
+            # Materialize everything the reservation job will send
+            plan = ReservationPlanner.build_plan(verified_user_ids=results['verified_user_ids'])
+            set_current_plan(plan)
+            results['planned'] = len(plan)
+
+            # Cancellations become lookups in these order lists instead of fetching them at the window
+            results['prefetched_orders'] = ReservationService.prefetch_orders(plan)
+
+            # Warm up one connection per planned request and keep them open until the window
+            # Hot slots may be sent over several connections, so warm one per suggested fan-out
+            results['warm_connections'] = prewarm_connections(sum(item.fanout for item in plan))
+
             return results
 
         except Exception as e:
@@ -87,6 +120,59 @@ def execute_pre_login():
             return {'error': str(e)}
 
 
+def execute_token_refresh():
+    """Proactively revalidate cached CCOM tokens before they go stale"""
+    if not flask_app:
+        print("ERROR: Flask app reference not set for scheduler job")
+        return {'error': 'Flask app reference not set'}
+
+    with flask_app.app_context():
+        try:
+            results = ReservationService.refresh_cached_tokens()
+            if results['checked']:
+                flask_app.logger.info(
+                    f"Token refresh completed: {results['checked']} checked, "
+                    f"{results['renewed']} renewed, {results['failed']} failed"
+                )
+            return results
+        except Exception as e:
+            flask_app.logger.error(f"Error in token refresh: {str(e)}")
+            return {'error': str(e)}
+
+
+def prewarm_connections(count):
+    """
+    Resolve the CCOM host, open `count` persistent connections and keep them
+    alive with periodic probes until shortly after the window opens
+
+    Returns:
+        int: Number of connections established
+    """
+    if count <= 0:
+        return 0
+
+    config = flask_app.config
+    pool = CCOMConnectionPool.get()
+
+    try:
+        addresses = pool.pin_dns(ttl=config.get('CCOM_DNS_CACHE_SECONDS', 600))
+        flask_app.logger.info(f"Pinned DNS for {config['CCOM_API_ROOT']}: {', '.join(addresses)}")
+    except Exception as e:
+        flask_app.logger.error(f"DNS pre-resolution failed: {str(e)}")
+
+    warmed = 0
+    try:
+        warmed = pool.prewarm(count)
+        flask_app.logger.info(f"Pre-warmed {warmed}/{count} connections")
+
+        until = DispatchEngine().open_instant().timestamp() + 60
+        pool.start_keepalive(count, until, interval=config.get('CCOM_KEEPALIVE_PROBE_SECONDS', 20))
+    except Exception as e:
+        flask_app.logger.error(f"Connection pre-warming failed: {str(e)}")
+
+    return warmed
+
+
 def execute_scheduled_reservations():
     """Execute all pending reservations for tomorrow using parallel processing"""
     # Use the global app reference instead of trying to get current_app
@@ -100,20 +186,22 @@ def execute_scheduled_reservations():
         flask_app.logger.info("Starting scheduled reservation execution")
 
         try:
-            # Calculate the number of workers based on server resources
-            import multiprocessing
-            max_workers = min(multiprocessing.cpu_count() + 1, 16)  # Cap at 16 workers
+            # Calibrate against the server clock and arm the release barrier
+            dispatch = DispatchEngine(pool=CCOMConnectionPool.get())
+            dispatch.calibrate()
+            dispatch.arm()
 
-            # Execute all reservations with parallel processing
+            # Execute all reservations from one shared queue; concurrency is sized
+            # from the number of requests and the observed server latency
             # Notifications will be sent directly in the reservation process
-            results = ReservationService.execute_reservations(max_workers=max_workers)
+            results = ReservationService.execute_reservations(dispatch=dispatch)
 
             # Log results
             flask_app.logger.info(
                 f"Reservation execution completed: "
                 f"{results['total_successful']} successful, "
                 f"{results['total_failed']} failed. "
-                f"Using {max_workers} worker threads."
+                f"Using {results['concurrency']['workers']} concurrent workers."
             )
 
             return results
@@ -0,0 +1,50 @@
+"""
+@Author: Tianyi Zhang
+@Date: 2025/4/26
+@Description: Process-wide DNS cache for pinned hosts
+"""
+import socket
+import threading
+import time
+
+_original_getaddrinfo = socket.getaddrinfo
+_pinned = {}  # (host, port) -> (expires_at, addrinfo list)
+_lock = threading.Lock()
+
+
+def _cached_getaddrinfo(host, port, family=0, type=0, proto=0, flags=0):
+    with _lock:
+        entry = _pinned.get((host, port))
+
+    if entry is None or entry[0] < time.time():
+        return _original_getaddrinfo(host, port, family, type, proto, flags)
+
+    results = entry[1]
+    if family:
+        results = [r for r in results if r[0] == family]
+    if type:
+        results = [r for r in results if r[1] == type]
+    return results or _original_getaddrinfo(host, port, family, type, proto, flags)
+
+
+def pin_host(host, port, ttl=600):
+    """
+    Resolve a host once and serve later lookups for it from memory
+
+    Only pinned (host, port) pairs are affected; every other lookup goes to
+    the system resolver as usual.
+
+    Args:
+        host: Host name to resolve
+        port: Port number used by the connections
+        ttl: Seconds to keep the cached addresses
+
+    Returns:
+        list: Resolved IP addresses
+    """
+    results = _original_getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    with _lock:
+        _pinned[(host, port)] = (time.time() + ttl, results)
+        socket.getaddrinfo = _cached_getaddrinfo
+
+    return sorted({r[4][0] for r in results})
@@ -55,5 +55,12 @@ class ReservationLimitExceeded(ApiError):
 class DurationLimitExceeded(ApiError):
     """Exception raised when a reservation exceeds the maximum duration"""
     def __init__(self, message="Reservation duration exceeds the maximum allowed"):
+        self.message = message
+        super().__init__(self.message)
+
+
+class ReservationConflict(ApiError):
+    """Exception raised when a reservation overlaps another reservation of the same user"""
+    def __init__(self, message="Reservation overlaps one of your other reservations"):
         self.message = message
         super().__init__(self.message)
\ No newline at end of file
@@ -0,0 +1,110 @@
+"""
+@Author: Tianyi Zhang
+@Date: 2025/4/26
+@Description: Keyset (cursor) pagination for large, append-mostly tables
+"""
+from sqlalchemy import and_, or_
+from datetime import date, datetime
+import base64
+import binascii
+import json
+
+
+class KeysetPage:
+    """One page of a keyset-paginated query"""
+
+    def __init__(self, items, next_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+def _dump(value):
+    if isinstance(value, datetime):
+        return {'dt': value.isoformat()}
+    if isinstance(value, date):
+        return {'d': value.isoformat()}
+    return value
+
+
+def _load(value):
+    if isinstance(value, dict):
+        if 'dt' in value:
+            return datetime.fromisoformat(value['dt'])
+        if 'd' in value:
+            return date.fromisoformat(value['d'])
+    return value
+
+
+def encode_cursor(values):
+    """Encode the sort key of the last row of a page as an opaque URL-safe string"""
+    raw = json.dumps([_dump(value) for value in values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, length):
+    """
+    Decode a cursor produced by `encode_cursor`
+
+    Returns:
+        list or None: The sort key values, or None if the cursor is missing or malformed
+    """
+    if not cursor:
+        return None
+
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = [_load(value) for value in json.loads(raw)]
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        return None
+
+    return values if len(values) == length else None
+
+
+def _after(keys, values):
+    """
+    Condition selecting the rows strictly after `values` in the order given by `keys`
+
+    Expanded into OR/AND terms instead of a row-value comparison so that
+    keys may mix ascending and descending columns.
+    """
+    (column, descending), value = keys[0], values[0]
+    beyond = column < value if descending else column > value
+    if len(keys) == 1:
+        return beyond
+    return or_(beyond, and_(column == value, _after(keys[1:], values[1:])))
+
+
+def keyset_paginate(query, keys, cursor=None, per_page=20):
+    """
+    Fetch the page of `query` following `cursor`
+
+    The cost of a page does not depend on how deep it is, as long as an index
+    covers the filter columns followed by the keys.
+
+    Args:
+        query: Filtered query without ordering
+        keys: (column, descending) pairs; the last key must be unique (e.g. the primary key)
+        cursor: Cursor from a previous page's `next_cursor`, or None for the first page
+        per_page: Page size
+
+    Returns:
+        KeysetPage: The items and the cursor of the next page (None on the last page)
+    """
+    values = decode_cursor(cursor, len(keys))
+    if values is not None:
+        query = query.filter(_after(keys, values))
+
+    query = query.order_by(*[column.desc() if descending else column.asc() for column, descending in keys])
+    items = query.limit(per_page + 1).all()
+
+    next_cursor = None
+    if len(items) > per_page:
+        items = items[:per_page]
+        last = items[-1]
+        next_cursor = encode_cursor([getattr(last, column.key) for column, _ in keys])
+
+    return KeysetPage(items, next_cursor)
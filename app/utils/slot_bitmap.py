@@ -0,0 +1,125 @@
+"""
+@Author: Tianyi Zhang
+@Date: 2025/4/26
+@Description: Compact day bitmaps of 15-minute slots
+
+Bit i of a mask stands for the slot starting at i * 15 minutes after
+midnight, so set operations on time ranges are single integer operations:
+`a | b` is the union, `a & b` the intersection, `need & ~free == 0`
+means `free` covers `need`.
+"""
+from datetime import datetime, timedelta
+from app.utils.time_utils import BEIJING_TIMEZONE, parse_hhmm, format_hhmm
+
+SLOT_MINUTES = 15
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES
+FULL_DAY = (1 << SLOTS_PER_DAY) - 1
+
+
+def minute_mask(start_minute, end_minute):
+    """Mask of the slots fully inside [start_minute, end_minute) of a day"""
+    first = -(-start_minute // SLOT_MINUTES)  # Round up: a partly covered slot is not free
+    last = end_minute // SLOT_MINUTES
+    if last <= first:
+        return 0
+    return ((1 << (last - first)) - 1) << first
+
+
+def time_mask(start_time, end_time, cover=False):
+    """
+    Mask of a "HHMM" time range on one day
+
+    Args:
+        start_time: Start time string (e.g., "1400")
+        end_time: End time string (e.g., "1700"); an end at or before the start runs to midnight
+        cover: Include partly covered slots (for occupied ranges) instead of only fully covered ones
+
+    Returns:
+        int: Slot mask
+    """
+    start_minute = parse_hhmm(start_time)
+    end_minute = parse_hhmm(end_time)
+    if end_minute <= start_minute:
+        end_minute = 24 * 60
+
+    if cover:
+        start_minute -= start_minute % SLOT_MINUTES
+        end_minute = -(-end_minute // SLOT_MINUTES) * SLOT_MINUTES
+    return minute_mask(start_minute, min(end_minute, 24 * 60))
+
+
+def covers(free, need):
+    """True if every slot of `need` is set in `free`"""
+    return need & ~free == 0
+
+
+def free_keys(masks, need):
+    """
+    Keys of `masks` whose mask covers `need`, e.g. the rooms free for a whole range
+
+    Args:
+        masks: key -> mask, e.g. ccom_id -> free slots of that room on one day
+        need: Mask that has to be free
+    """
+    return [key for key, mask in masks.items() if need & ~mask == 0]
+
+
+def intervals_to_masks(intervals, tz=BEIJING_TIMEZONE):
+    """
+    Convert CCOM `remainingTimeList` entries into per-day slot masks
+
+    Args:
+        intervals: Dicts with `startTime`/`endTime` millisecond timestamps
+        tz: Timezone the days are counted in
+
+    Returns:
+        dict: ISO date -> mask of the fully free slots on that day
+    """
+    masks = {}
+    for interval in intervals:
+        start = datetime.fromtimestamp(interval['startTime'] / 1000, tz)
+        end = datetime.fromtimestamp(interval['endTime'] / 1000, tz)
+
+        # An interval may cross midnight; split it per day
+        while start < end:
+            day_end = datetime.combine(start.date() + timedelta(days=1), datetime.min.time(), tz)
+            chunk_end = min(end, day_end)
+            start_minute = start.hour * 60 + start.minute + (1 if start.second or start.microsecond else 0)
+            end_minute = 24 * 60 if chunk_end == day_end else chunk_end.hour * 60 + chunk_end.minute
+
+            mask = minute_mask(start_minute, end_minute)
+            if mask:
+                key = start.date().isoformat()
+                masks[key] = masks.get(key, 0) | mask
+            start = chunk_end
+
+    return masks
+
+
+def mask_to_ranges(mask):
+    """
+    List the contiguous runs of set slots as ("HHMM", "HHMM") pairs
+
+    An end of midnight is written "2400".
+    """
+    ranges = []
+    slot = 0
+    while mask >> slot:
+        if not (mask >> slot) & 1:
+            # Skip the whole run of clear slots at once
+            slot += ((mask >> slot) & -(mask >> slot)).bit_length() - 1
+            continue
+        run = (~(mask >> slot) & ((mask >> slot) + 1)).bit_length() - 1
+        ranges.append((_slot_time(slot), _slot_time(slot + run)))
+        slot += run
+    return ranges
+
+
+def _slot_time(slot):
+    return format_hhmm(slot * SLOT_MINUTES)
+
+
+def encode_mask(mask):
+    """Fixed-width hex form of a mask for JSON"""
+    return f'{mask:0{SLOTS_PER_DAY // 4}x}'
+
@@ -7,6 +7,7 @@ from datetime import datetime, timedelta, timezone
 import pytz
 from flask import current_app
 import requests
+import time
 
 # Constants
 BEIJING_TIMEZONE = timezone(timedelta(hours=8))
@@ -17,6 +18,33 @@ def get_current_time(tz=BEIJING_TIMEZONE):
     return datetime.now(tz)
 
 
+def parse_hhmm(value):
+    """
+    Parse a time string into minutes since midnight
+
+    Args:
+        value: Time string (e.g., "1400" or "14:00")
+
+    Returns:
+        int: Minutes since midnight; "2400" (midnight as an end time) is 1440
+
+    Raises:
+        ValueError: If the value is not a valid time of day
+    """
+    digits = value.replace(':', '')
+    if len(digits) != 4 or not digits.isdigit():
+        raise ValueError(f"Invalid time: {value!r}")
+    hours, minutes = int(digits[:2]), int(digits[2:])
+    if minutes >= 60 or hours > 24 or (hours == 24 and minutes):
+        raise ValueError(f"Invalid time: {value!r}")
+    return hours * 60 + minutes
+
+
+def format_hhmm(minutes):
+    """Format minutes since midnight as a time string (e.g., 840 -> "1400", 1440 -> "2400")"""
+    return f'{minutes // 60:02d}{minutes % 60:02d}'
+
+
 def convert_to_timestamp(input_time, add_day=False):
     """
     Convert a time string or datetime to a timestamp
@@ -32,7 +60,7 @@ def convert_to_timestamp(input_time, add_day=False):
         target_datetime = input_time
     else:
         current_time = get_current_time()
-        hour, minute = map(int, [input_time[:2], input_time[2:]])
+        hour, minute = divmod(parse_hhmm(input_time), 60)
         target_datetime = datetime(
             year=current_time.year,
             month=current_time.month,
@@ -66,8 +94,9 @@ def split_time(start_time, end_time, segment_hours=3):
     current_date = get_current_time().date()
     next_date = current_date + timedelta(days=1)
 
-    start_datetime = datetime.combine(next_date, datetime.strptime(start_time, '%H%M').time())
-    end_datetime = datetime.combine(next_date, datetime.strptime(end_time, '%H%M').time())
+    midnight = datetime.combine(next_date, datetime.min.time())
+    start_datetime = midnight + timedelta(minutes=parse_hhmm(start_time))
+    end_datetime = midnight + timedelta(minutes=parse_hhmm(end_time))
 
     segments = []
     while start_datetime < end_datetime:
@@ -111,15 +140,12 @@ def calculate_duration_hours(start_time, end_time):
     Returns:
         float: Duration in hours
     """
-    start_hour, start_minute = int(start_time[:2]), int(start_time[2:])
-    end_hour, end_minute = int(end_time[:2]), int(end_time[2:])
+    start_minutes = parse_hhmm(start_time)
+    end_minutes = parse_hhmm(end_time)
 
     # Handle cases where end time is on the next day
-    if end_hour < start_hour or (end_hour == start_hour and end_minute < start_minute):
-        end_hour += 24
-
-    start_minutes = start_hour * 60 + start_minute
-    end_minutes = end_hour * 60 + end_minute
+    if end_minutes < start_minutes:
+        end_minutes += 24 * 60
 
     return (end_minutes - start_minutes) / 60
 
@@ -155,6 +181,27 @@ def get_day_name(day_of_week):
     return days[day_of_week]
 
 
+def precise_sleep_until(deadline, spin_seconds=0.005):
+    """
+    Block until a time.perf_counter() deadline with sub-millisecond precision
+
+    Sleeps coarsely until shortly before the deadline and busy-waits on the
+    monotonic clock for the final stretch, since time.sleep() can overshoot
+    by several milliseconds.
+
+    Args:
+        deadline: Target value of time.perf_counter()
+        spin_seconds: Length of the final busy-wait window in seconds
+    """
+    remaining = deadline - time.perf_counter()
+    if remaining > spin_seconds:
+        time.sleep(remaining - spin_seconds)
+
+    while time.perf_counter() < deadline:
+        # Release the GIL so the event loop thread can keep sending meanwhile
+        time.sleep(0)
+
+
 class ServerTimeHelper:
     """Helper class to interact with the server time"""
 
@@ -170,6 +217,61 @@ class ServerTimeHelper:
             return server_time_utc
         raise ValueError("Unable to retrieve server time")
 
+    def measure_clock(self, max_duration=2.5):
+        """
+        Estimate the server clock offset and round-trip time
+
+        The Date header only has one-second resolution, so the server is probed
+        back-to-back over a keep-alive connection until its second ticks over. The
+        tick happened between the midpoints of the last two probes, which pins the
+        offset down to roughly half a round trip.
+
+        Args:
+            max_duration: Maximum number of seconds to spend probing
+
+        Returns:
+            dict: {'offset_ms': server minus local clock, 'rtt_ms': median round trip}
+        """
+        session = requests.Session()
+        rtts = []
+        previous = None
+        offset = None
+        deadline = time.perf_counter() + max_duration
+
+        try:
+            while time.perf_counter() < deadline:
+                sent = time.time()
+                response = session.head(self.server_url, timeout=5)
+                received = time.time()
+                rtts.append(received - sent)
+
+                date_str = response.headers.get('Date')
+                if not date_str:
+                    raise ValueError("Unable to retrieve server time")
+                server_second = datetime.strptime(date_str, '%a, %d %b %Y %H:%M:%S GMT').replace(
+                    tzinfo=timezone.utc).timestamp()
+                midpoint = (sent + received) / 2
+
+                if previous is not None and server_second > previous[0]:
+                    # The server crossed `server_second` between the two probes
+                    offset = server_second - (previous[1] + midpoint) / 2
+                    break
+                previous = (server_second, midpoint)
+        finally:
+            session.close()
+
+        if not rtts:
+            raise ValueError("Unable to probe server time")
+
+        rtts.sort()
+        rtt = rtts[len(rtts) // 2]
+
+        if offset is None:
+            # No tick observed: fall back to whole-second precision
+            offset = previous[0] + 0.5 - previous[1]
+
+        return {'offset_ms': offset * 1000, 'rtt_ms': rtt * 1000}
+
     def measure_latency(self):
         """Measure the one-way latency to the server in milliseconds"""
         response = requests.get(self.server_url)
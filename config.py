@@ -25,17 +25,70 @@ class Config:
     CCOM_API_UA = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/98.0.4758.109 Safari"
     BEIJING_TIMEZONE_OFFSET = 8  # UTC+8
 
+    # Shared CCOM connection pool
+    CCOM_POOL_MAX_CONNECTIONS = 200
+    CCOM_POOL_KEEPALIVE_SECONDS = 120
+    CCOM_REQUEST_TIMEOUT = 10  # Seconds
+    CCOM_DNS_CACHE_SECONDS = 600
+    CCOM_KEEPALIVE_PROBE_SECONDS = 20  # Interval between keep-alive probes before the window opens
+
+    # Token cache settings
+    TOKEN_FRESHNESS_SECONDS = 600  # Trust a validated token for this long without revalidating
+    TOKEN_REFRESH_INTERVAL_SECONDS = 120  # How often the background job revalidates cached tokens
+
+    # Room availability shown in the reservation forms, shared by all users
+    AVAILABILITY_CACHE_TTL_SECONDS = 30
+    SCAN_MAX_CONCURRENCY = 32  # Rooms fetched at once by the full availability scan
+    SCAN_SNAPSHOT_TTL_SECONDS = 900  # Fallback rooms are only ruled out by a scan younger than this
+
     # APScheduler configuration
     SCHEDULER_API_ENABLED = True
     SCHEDULER_TIMEZONE = "Asia/Shanghai"
 
     # Notification settings
     NOTIFICATION_ENABLED = True
+    NOTIFICATION_WORKERS = 4  # Background threads delivering queued notifications
+    NOTIFICATION_PER_KEY_CONCURRENCY = 1  # Concurrent deliveries to one push key
+    NOTIFICATION_MAX_RETRIES = 3
+    NOTIFICATION_RETRY_BACKOFF = 1.0  # Seconds before the first retry, doubled on every further retry
+    NOTIFICATION_TIMEOUT = 10  # Seconds
+    NOTIFICATION_DIGEST = True  # One push per user and run instead of one per reservation
 
     # Reservation settings
     MAX_DAILY_RESERVATIONS = 2
     MAX_RESERVATION_HOURS = 3
     RESERVATION_OPEN_TIME = "2130"  # 9:30 PM Beijing time
+    FALLBACK_MAX_CANDIDATES = 5  # Fallback rooms tried after the requested room is taken
+
+    # Dispatch timing settings
+    DISPATCH_PREPARE_SECONDS = 45  # Start preparing requests this long before the window opens
+    DISPATCH_SPIN_MS = 5  # Busy-wait window before the fire instant
+    DISPATCH_LEAD_MS = 0  # Extra margin to send ahead of the computed fire instant
+    DISPATCH_MAX_CONCURRENCY = 200  # Upper bound on concurrent requests (keep <= CCOM_POOL_MAX_CONNECTIONS)
+    DISPATCH_TARGET_WINDOW_MS = 50  # Without a release barrier, every item should be done within this window
+    DISPATCH_FAIRNESS = 'round_robin'  # 'round_robin' interleaves users, 'fifo' keeps plan order
+    DISPATCH_PARALLEL_SEGMENTS = True  # Send all segments of a reservation over 3 hours at once
+    DISPATCH_USER_MAX_IN_FLIGHT = 2  # Segments of one user sent at the same time (0 for no bound)
+
+    # Local journal of run outcomes, replayed if a run dies before storing them (default: instance/journal)
+    RUN_JOURNAL_DIR = os.environ.get('RUN_JOURNAL_DIR')
+    RUN_JOURNAL_SYNC_MS = 200  # Buffered journal records are written and fsynced in batches this often
+    RUN_TRACE_ENABLED = True  # Record the timing of every request of a run for the timeline report
+    RUN_TRACE_KEEP = 30  # Runs whose results and request timing are kept
+
+    # Room contention index settings
+    CONTENTION_DECAY = 0.3  # Weight of the latest run in the contention statistics
+    CONTENTION_HOT_THRESHOLD = 0.5  # Contention score from which a slot counts as hot
+    DISPATCH_CONTENTION_FANOUT = 1  # Warm connections suggested for hot slots (1 disables fan-out)
+    DISPATCH_RACE_ENABLED = False  # Send hot slots over DISPATCH_CONTENTION_FANOUT connections at once
+    DISPATCH_RACE_STAGGER_MS = 3  # Gap between the racing copies, centred on the fire instant
+
+    # Cached system summary shown on the about page and admin dashboard
+    SYSTEM_SUMMARY_TTL_SECONDS = 300
+
+    # History page sizes (cursor-paginated)
+    HISTORY_PAGE_SIZE = 50  # Rows per page of a user's history, and per infinite-scroll request
+    ADMIN_HISTORY_PAGE_SIZE = 20  # Rows per page of the admin history
 
     # Session settings
     PERMANENT_SESSION_LIFETIME = timedelta(days=7)
\ No newline at end of file
@@ -0,0 +1,44 @@
+"""Add composite indexes for reservation history access paths
+
+Revision ID: 3f1c2a7d9b04
+Revises: 
+Create Date: 2025-04-26 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a7d9b04'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+INDEXES = (
+    ('ix_reservation_history_user_status_date', ['user_id', 'status', 'reservation_date']),
+    ('ix_reservation_history_user_date', ['user_id', 'reservation_date', 'start_time']),
+    ('ix_reservation_history_created_at', ['created_at']),
+    ('ix_reservation_history_date', ['reservation_date']),
+)
+
+
+def existing_indexes():
+    inspector = sa.inspect(op.get_bind())
+    return {index['name'] for index in inspector.get_indexes('reservation_history')}
+
+
+def upgrade():
+    # Databases created by db.create_all() after this change already have the indexes
+    existing = existing_indexes()
+    for name, columns in INDEXES:
+        if name not in existing:
+            op.create_index(name, 'reservation_history', columns, unique=False)
+
+
+def downgrade():
+    existing = existing_indexes()
+    for name, _ in reversed(INDEXES):
+        if name in existing:
+            op.drop_index(name, table_name='reservation_history')
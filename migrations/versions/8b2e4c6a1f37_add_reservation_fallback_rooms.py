@@ -0,0 +1,45 @@
+"""Add fallback rooms to recurring and one-time reservations
+
+Revision ID: 8b2e4c6a1f37
+Revises: 3f1c2a7d9b04
+Create Date: 2025-04-26 13:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b2e4c6a1f37'
+down_revision = '3f1c2a7d9b04'
+branch_labels = None
+depends_on = None
+
+
+TABLES = ('recurring_reservations', 'one_time_reservations')
+
+
+def existing_columns(table):
+    inspector = sa.inspect(op.get_bind())
+    return {column['name'] for column in inspector.get_columns(table)}
+
+
+def upgrade():
+    # Databases created by db.create_all() after this change already have the columns
+    for table in TABLES:
+        existing = existing_columns(table)
+        with op.batch_alter_table(table) as batch_op:
+            if 'fallback_room_ids' not in existing:
+                batch_op.add_column(sa.Column('fallback_room_ids', sa.JSON(), nullable=True))
+            if 'fallback_partition' not in existing:
+                batch_op.add_column(sa.Column('fallback_partition', sa.String(length=64), nullable=True))
+
+
+def downgrade():
+    for table in TABLES:
+        existing = existing_columns(table)
+        with op.batch_alter_table(table) as batch_op:
+            if 'fallback_partition' in existing:
+                batch_op.drop_column('fallback_partition')
+            if 'fallback_room_ids' in existing:
+                batch_op.drop_column('fallback_room_ids')
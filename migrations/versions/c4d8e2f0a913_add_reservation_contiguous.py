@@ -0,0 +1,39 @@
+"""Add the all-or-nothing flag to recurring and one-time reservations
+
+Revision ID: c4d8e2f0a913
+Revises: 8b2e4c6a1f37
+Create Date: 2025-04-26 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4d8e2f0a913'
+down_revision = '8b2e4c6a1f37'
+branch_labels = None
+depends_on = None
+
+
+TABLES = ('recurring_reservations', 'one_time_reservations')
+
+
+def existing_columns(table):
+    inspector = sa.inspect(op.get_bind())
+    return {column['name'] for column in inspector.get_columns(table)}
+
+
+def upgrade():
+    # Databases created by db.create_all() after this change already have the column
+    for table in TABLES:
+        if 'contiguous' not in existing_columns(table):
+            with op.batch_alter_table(table) as batch_op:
+                batch_op.add_column(sa.Column('contiguous', sa.Boolean(), nullable=True, server_default=sa.false()))
+
+
+def downgrade():
+    for table in TABLES:
+        if 'contiguous' in existing_columns(table):
+            with op.batch_alter_table(table) as batch_op:
+                batch_op.drop_column('contiguous')
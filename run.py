@@ -16,11 +16,16 @@ load_dotenv(os.path.join(basedir, '.env'))
 from app import create_app, db
 from app.models.user import User
 from app.models.room import Room
-from app.models.reservation import RecurringReservation, OneTimeReservation, ReservationHistory
+from app.models.reservation import RecurringReservation, OneTimeReservation, ReservationHistory, RoomContention, \
+    UserReservationStats
+from app.services.user_stats import UserStatsService
+from app.services.contention_index import ContentionIndex
 
 app = create_app()
 with app.app_context():
     db.create_all()
+    UserStatsService.ensure_built()
+    ContentionIndex.ensure_built()
 
 
 # Create CLI commands
@@ -67,6 +72,112 @@ def import_rooms(csv_file):
         click.echo('Failed to import rooms. Check the application logs for details.')
 
 
+@app.cli.command('show-plan')
+@click.option('--date', 'target_date', default=None, help='Target date (YYYY-MM-DD), default: tomorrow')
+def show_plan(target_date):
+    """Build the reservation plan without sending anything and print it"""
+    from datetime import datetime
+    from app.services.reservation_plan import ReservationPlanner
+
+    if target_date:
+        target_date = datetime.strptime(target_date, '%Y-%m-%d').date()
+
+    plan = ReservationPlanner.build_plan(target_date)
+    click.echo(plan.dump())
+
+
+@app.cli.command('recover-runs')
+@click.option('--no-reconcile', is_flag=True, help='Do not check the CCOM order lists of interrupted reservations')
+def recover_runs(no_reconcile):
+    """Replay the journals of interrupted reservation runs into the history"""
+    from app.services.reservation_service import ReservationService
+
+    results = ReservationService.recover_journals(reconcile=not no_reconcile)
+    click.echo(f"Journals: {results['journals']}, recovered outcomes: {results['recovered']}, "
+               f"interrupted reservations: {results['reconciled']}")
+    for error in results['errors']:
+        click.echo(f'Error: {error}')
+
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats():
+    """Recompute the per-user dashboard statistics from the full reservation history"""
+    count = UserStatsService.rebuild()
+    click.echo(f'Rebuilt statistics for {count} users.')
+
+
+@app.cli.command('rebuild-contention')
+def rebuild_contention():
+    """Recompute the room contention index from the full reservation history"""
+    count = ContentionIndex.rebuild()
+    click.echo(f'Rebuilt contention statistics for {count} slots.')
+
+
+@app.cli.command('scan-rooms')
+@click.argument('username')
+@click.option('--all-rooms', is_flag=True, help='Also scan rooms without a piano')
+def scan_rooms(username, all_rooms):
+    """Scan the free slots of all rooms concurrently using USERNAME's CCOM account"""
+    from app.services.async_ccom_client import AsyncCCOMClient
+    from app.services.room_scanner import RoomScanner
+    from app.utils.slot_bitmap import mask_to_ranges
+
+    user = User.query.filter_by(username=username).first()
+    if not user:
+        click.echo(f'User {username} not found.')
+        return
+
+    client = AsyncCCOMClient(user.username, user.get_ccom_password(), user.ccom_token)
+    if not client.pool.run(client.soft_login()):
+        click.echo('Failed to log in to CCOM.')
+        return
+
+    snapshot, changes = RoomScanner.scan(client, piano_only=not all_rooms)
+    click.echo(f"Scanned {len(snapshot.rooms)} rooms in {snapshot.elapsed_ms:.0f}ms, {len(snapshot.errors)} failed")
+    for ccom_id, days in sorted(snapshot.rooms.items()):
+        for day, mask in sorted(days.items()):
+            free = ', '.join(f'{start}-{end}' for start, end in mask_to_ranges(mask))
+            click.echo(f"{snapshot.names.get(ccom_id, ccom_id)} {day}: {free or '-'}")
+    for ccom_id, error in snapshot.errors.items():
+        click.echo(f"Error {snapshot.names.get(ccom_id, ccom_id)}: {error}")
+
+
+@app.cli.command('export-history')
+@click.option('--format', 'export_format', type=click.Choice(['csv', 'jsonl']), default='csv', show_default=True)
+@click.option('--output', '-o', type=click.Path(dir_okay=False), default=None, help='Output file (default: stdout)')
+@click.option('--user-id', type=int, default=None, help='Only export this user')
+@click.option('--status', type=click.Choice(['successful', 'failed']), default=None, help='Only export this status')
+@click.option('--date-from', type=click.DateTime(formats=['%Y-%m-%d']), default=None, help='First reservation date')
+@click.option('--date-to', type=click.DateTime(formats=['%Y-%m-%d']), default=None, help='Last reservation date')
+def export_history(export_format, output, user_id, status, date_from, date_to):
+    """Stream the reservation history, joined with user and room names, as CSV or JSON Lines"""
+    from app.services.history_export import HistoryExporter
+
+    exporter = HistoryExporter(user_id=user_id, status=status,
+                               date_from=date_from.date() if date_from else None,
+                               date_to=date_to.date() if date_to else None)
+
+    with click.open_file(output or '-', 'wb') as f:
+        for chunk in exporter.chunks(export_format):
+            f.write(chunk.encode('utf-8'))
+
+
+@app.cli.command('benchmark-history')
+@click.option('--rows', default=200000, show_default=True, help='Number of synthetic history entries')
+@click.option('--repeat', default=5, show_default=True, help='Runs per query; the median is reported')
+def benchmark_history(rows, repeat):
+    """Time the reservation history queries on a synthetic history, without and with indexes"""
+    from app.services.history_benchmark import HistoryBenchmark
+
+    results = HistoryBenchmark(rows=rows, repeat=repeat).run()
+    click.echo(f"Seeded {results['rows']} history entries in {results['seed_seconds']:.1f}s")
+    click.echo(f"{'query':20s} {'before':>10s} {'after':>10s}")
+    for name, timing in results['queries'].items():
+        click.echo(f"{name:20s} {timing['before_ms']:8.2f}ms {timing['after_ms']:8.2f}ms")
+    for name, timing in results['queries'].items():
+        click.echo(f"{name}: {timing['plan']}")
+
+
 @app.cli.command('list-routes')
 def list_routes():
     """List all available routes"""
@@ -94,7 +205,9 @@ def make_shell_context():
         'Room': Room,
         'RecurringReservation': RecurringReservation,
         'OneTimeReservation': OneTimeReservation,
-        'ReservationHistory': ReservationHistory
+        'ReservationHistory': ReservationHistory,
+        'RoomContention': RoomContention,
+        'UserReservationStats': UserReservationStats
     }
 
 